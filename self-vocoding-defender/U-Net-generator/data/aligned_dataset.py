@@ -44,7 +44,7 @@ class AlignedDataset(BaseDataset):
         self.input_nc = self.opt.output_nc if self.opt.direction == 'BtoA' else self.opt.input_nc
         self.output_nc = self.opt.input_nc if self.opt.direction == 'BtoA' else self.opt.output_nc
 
-        self.stft = fixed_STFT(1024, 256, 1024)
+        self.stft = fixed_STFT(1024, 256, 1024, backend=opt.stft_backend)
 
     def __getitem__(self, index):
         """Return a data point and its metadata information.
@@ -335,10 +335,57 @@ def window_sumsquare(window, n_frames, hop_length=200, win_length=800,
         x[sample:min(n, sample + n_fft)] += win_sq[:max(0, min(n_fft, n - sample))]
     return x
 
+
+STFT_BACKENDS = ('conv', 'fft')
+
+
+def fft_forward(input_data, filter_length, hop_length, fft_window):
+    """
+    FFT counterpart of the strided conv1d against forward_basis.
+
+    PARAMS
+    ------
+    input_data: reflect-padded signal of shape (B, T)
+    fft_window: window zero-padded to filter_length
+
+    RETURNS
+    -------
+    real_part, imag_part: torch.FloatTensor of shape (B, filter_length/2 + 1, n_frames)
+    """
+    spec = torch.stft(input_data, filter_length, hop_length=hop_length,
+                      win_length=filter_length, window=fft_window,
+                      center=False, return_complex=True)
+    return spec.real, spec.imag
+
+
+def fft_inverse(real_part, imag_part, filter_length, hop_length, fft_window):
+    """
+    FFT counterpart of the conv_transpose1d against inverse_basis.
+
+    The pinv of the stacked real/imag Fourier basis is exactly irfft (the
+    imaginary parts of the DC and Nyquist bins are ignored), so each frame is
+    irfft'd, windowed, divided by the hop ratio like the pinv basis, and
+    overlap-added with fold. The envelope correction is left to the caller.
+
+    RETURNS
+    -------
+    torch.FloatTensor of shape (B, 1, filter_length + hop_length * (n_frames - 1))
+    """
+    frames = torch.fft.irfft(torch.complex(real_part, imag_part), n=filter_length, dim=1)
+    frames = frames * (fft_window * (float(hop_length) / filter_length)).view(1, -1, 1)
+    n_frames = frames.size(-1)
+    inverse_transform = F.fold(
+        frames,
+        output_size=(1, filter_length + hop_length * (n_frames - 1)),
+        kernel_size=(1, filter_length),
+        stride=(1, hop_length))
+    return inverse_transform.view(frames.size(0), 1, -1)
+
+
 class STFT(torch.nn.Module):
     """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft"""
     def __init__(self, filter_length=800, hop_length=200, win_length=800,
-                 window='hann'):
+                 window='hann', backend='conv'):
         super(STFT, self).__init__()
         self.filter_length = filter_length
         self.hop_length = hop_length
@@ -366,9 +413,15 @@ class STFT(torch.nn.Module):
             # window the bases
             forward_basis *= fft_window
             inverse_basis *= fft_window
+        else:
+            fft_window = torch.ones(filter_length)
 
+        assert backend in STFT_BACKENDS, "unknown STFT backend: {}".format(backend)
+        self.backend = backend
         self.register_buffer('forward_basis', forward_basis.float()) # register_buffer requires_grad is False
         self.register_buffer('inverse_basis', inverse_basis.float())
+        # only used by the fft backend; kept out of the state_dict so checkpoints are unchanged
+        self.register_buffer('fft_window', fft_window, persistent=False)
 
     def transform(self, input_data):
         num_batches = input_data.size(0)
@@ -384,15 +437,19 @@ class STFT(torch.nn.Module):
             mode='reflect')
         input_data = input_data.squeeze(1)
 
-        forward_transform = F.conv1d(
-            input_data,
-            Variable(self.forward_basis, requires_grad=False),
-            stride=self.hop_length,
-            padding=0)
+        if self.backend == 'fft':
+            real_part, imag_part = fft_forward(
+                input_data.squeeze(1), self.filter_length, self.hop_length, self.fft_window)
+        else:
+            forward_transform = F.conv1d(
+                input_data,
+                Variable(self.forward_basis, requires_grad=False),
+                stride=self.hop_length,
+                padding=0)
 
-        cutoff = int((self.filter_length / 2) + 1)
-        real_part = forward_transform[:, :cutoff, :]
-        imag_part = forward_transform[:, cutoff:, :]
+            cutoff = int((self.filter_length / 2) + 1)
+            real_part = forward_transform[:, :cutoff, :]
+            imag_part = forward_transform[:, cutoff:, :]
 
         magnitude = torch.sqrt(real_part**2 + imag_part**2)
         phase = torch.autograd.Variable(
@@ -401,14 +458,19 @@ class STFT(torch.nn.Module):
         return magnitude, phase
 
     def inverse(self, magnitude, phase):
-        recombine_magnitude_phase = torch.cat(
-            [magnitude*torch.cos(phase), magnitude*torch.sin(phase)], dim=1)
+        if self.backend == 'fft':
+            inverse_transform = fft_inverse(
+                magnitude*torch.cos(phase), magnitude*torch.sin(phase),
+                self.filter_length, self.hop_length, self.fft_window)
+        else:
+            recombine_magnitude_phase = torch.cat(
+                [magnitude*torch.cos(phase), magnitude*torch.sin(phase)], dim=1)
 
-        inverse_transform = F.conv_transpose1d(
-            recombine_magnitude_phase,
-            Variable(self.inverse_basis, requires_grad=False),
-            stride=self.hop_length,
-            padding=0)
+            inverse_transform = F.conv_transpose1d(
+                recombine_magnitude_phase,
+                Variable(self.inverse_basis, requires_grad=False),
+                stride=self.hop_length,
+                padding=0)
 
         if self.window is not None:
             window_sum = window_sumsquare(
@@ -448,11 +510,11 @@ def _mel_to_linear_matrix(sr, n_fft, n_mels, mel_fmin, mel_fmax):
 class TacotronSTFT(torch.nn.Module):
     def __init__(self, filter_length=1024, hop_length=256, win_length=1024,
                  n_mel_channels=80, sampling_rate=22050, mel_fmin=0.0,
-                 mel_fmax=8000.0):
+                 mel_fmax=8000.0, backend='conv'):
         super(TacotronSTFT, self).__init__()
         self.n_mel_channels = n_mel_channels
         self.sampling_rate = sampling_rate
-        self.stft_fn = STFT(filter_length, hop_length, win_length)
+        self.stft_fn = STFT(filter_length, hop_length, win_length, backend=backend)
         mel_basis = librosa_mel_fn(
             sampling_rate, filter_length, n_mel_channels, mel_fmin, mel_fmax)
         mel_basis = torch.from_numpy(mel_basis).float()
@@ -533,7 +595,7 @@ class TacotronSTFT(torch.nn.Module):
 class fixed_STFT(torch.nn.Module):
     """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft"""
     def __init__(self, filter_length=800, hop_length=200, win_length=800,
-                 window='hann'):
+                 window='hann', backend='conv'):
         super(fixed_STFT, self).__init__()
         self.filter_length = filter_length
         self.hop_length = hop_length
@@ -561,9 +623,15 @@ class fixed_STFT(torch.nn.Module):
             # window the bases
             forward_basis *= fft_window
             inverse_basis *= fft_window
+        else:
+            fft_window = torch.ones(filter_length)
 
+        assert backend in STFT_BACKENDS, "unknown STFT backend: {}".format(backend)
+        self.backend = backend
         self.register_buffer('forward_basis', forward_basis.float()) # register_buffer requires_grad is False
         self.register_buffer('inverse_basis', inverse_basis.float())
+        # only used by the fft backend; kept out of the state_dict so checkpoints are unchanged
+        self.register_buffer('fft_window', fft_window, persistent=False)
 
     def transform(self, input_data):
         # num_batches = input_data.size(0)
@@ -580,15 +648,19 @@ class fixed_STFT(torch.nn.Module):
             mode='reflect')
         input_data = input_data.squeeze(1)
 
-        forward_transform = F.conv1d(
-            input_data,
-            Variable(self.forward_basis, requires_grad=False),
-            stride=self.hop_length,
-            padding=0)
+        if self.backend == 'fft':
+            real_part, imag_part = fft_forward(
+                input_data.squeeze(1), self.filter_length, self.hop_length, self.fft_window)
+        else:
+            forward_transform = F.conv1d(
+                input_data,
+                Variable(self.forward_basis, requires_grad=False),
+                stride=self.hop_length,
+                padding=0)
 
-        cutoff = int((self.filter_length / 2) + 1)
-        real_part = forward_transform[:, :cutoff, :]
-        imag_part = forward_transform[:, cutoff:, :]
+            cutoff = int((self.filter_length / 2) + 1)
+            real_part = forward_transform[:, :cutoff, :]
+            imag_part = forward_transform[:, cutoff:, :]
 
         magnitude = torch.sqrt(real_part**2 + imag_part**2)
         phase = torch.autograd.Variable(
@@ -597,14 +669,19 @@ class fixed_STFT(torch.nn.Module):
         return magnitude, phase
 
     def inverse(self, magnitude, phase):
-        recombine_magnitude_phase = torch.cat(
-            [magnitude*torch.cos(phase), magnitude*torch.sin(phase)], dim=1)
-
-        inverse_transform = F.conv_transpose1d(
-            recombine_magnitude_phase,
-            Variable(self.inverse_basis, requires_grad=False),
-            stride=self.hop_length,
-            padding=0)
+        if self.backend == 'fft':
+            inverse_transform = fft_inverse(
+                magnitude*torch.cos(phase), magnitude*torch.sin(phase),
+                self.filter_length, self.hop_length, self.fft_window)
+        else:
+            recombine_magnitude_phase = torch.cat(
+                [magnitude*torch.cos(phase), magnitude*torch.sin(phase)], dim=1)
+
+            inverse_transform = F.conv_transpose1d(
+                recombine_magnitude_phase,
+                Variable(self.inverse_basis, requires_grad=False),
+                stride=self.hop_length,
+                padding=0)
 
         if self.window is not None:
             window_sum = window_sumsquare(
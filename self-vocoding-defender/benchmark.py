@@ -0,0 +1,257 @@
+import time
+import logging
+import argparse
+import numpy as np
+import torch
+from distortions.frequency import fixed_STFT, TacotronSTFT, STFT_BACKENDS
+
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def timeit(fn, repeats, warmup=3):
+    """
+    RETURNS
+    -------
+    mean wall-clock time of fn() in milliseconds
+    """
+    for _ in range(warmup):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def bench_stft(args):
+    # analysis -> synthesis round trip as done by the Encoder and the wave-domain distortions
+    x = torch.randn(args.batch_size, 1, int(args.seconds * args.sr), device=device)
+    num_samples = x.shape[2]
+    for backend in args.backends:
+        stft = fixed_STFT(args.n_fft, args.hop, args.n_fft, backend=backend).to(device)
+
+        def phase_path():
+            spect, phase = stft.transform(x)
+            return stft.inverse(spect, phase, num_samples)
+
+        def phasor_path():
+            spect, phasor = stft.transform_phasor(x)
+            return stft.inverse_phasor(spect, phasor, num_samples)
+
+        with torch.no_grad():
+            err = (phase_path() - phasor_path()).abs().max().item()
+            t_phase = timeit(phase_path, args.repeats)
+            t_phasor = timeit(phasor_path, args.repeats)
+        logging.info("stft backend={} B={} T={}: phase {:.2f} ms, phasor {:.2f} ms ({:.2f}x), max abs diff {:.2e}".format(
+            backend, args.batch_size, num_samples, t_phase, t_phasor, t_phase / t_phasor, err))
+
+
+def test_signal(batch_size, seconds, sr):
+    # harmonic sweeps with a slow amplitude envelope, a rough stand-in for voiced speech
+    t = torch.arange(int(seconds * sr), device=device) / sr
+    f0 = 100 + 50 * torch.rand(batch_size, 1, device=device) + 40 * torch.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * torch.cumsum(f0, dim=1) / sr
+    y = sum(torch.sin(k * phase) / k for k in range(1, 20))
+    y = y * (0.6 + 0.4 * torch.sin(2 * np.pi * 2 * t)) + 0.01 * torch.randn_like(y)
+    return y / y.abs().max(dim=1, keepdim=True)[0]
+
+
+def spectral_convergence(stft, y, magnitudes):
+    # griffin_lim peak-normalizes its output, so compare at the best-fitting scale
+    rebuilt, _ = stft.transform(y)
+    rebuilt = rebuilt * (rebuilt * magnitudes).sum() / (rebuilt * rebuilt).sum()
+    return (torch.norm(rebuilt - magnitudes) / torch.norm(magnitudes)).item()
+
+
+def bench_griffin_lim(args):
+    mel_transform = TacotronSTFT(args.n_fft, args.hop, args.n_fft, backend=args.backend).to(device)
+    y = test_signal(args.batch_size, args.seconds, args.sr)
+    with torch.no_grad():
+        y_mel = mel_transform.mel_spectrogram(y)
+        target = torch.matmul(mel_transform.mel_to_linear_basis, mel_transform.spectral_de_normalize(y_mel))
+        _, init_phase = mel_transform.stft_fn.transform_phasor(y)
+        for name, kwargs in [("griffin-lim", dict(momentum=0.)),
+                             ("fast griffin-lim", dict(momentum=args.momentum)),
+                             ("fast griffin-lim, warm start", dict(momentum=args.momentum, init_phase=init_phase))]:
+            for n_iters in args.n_iters:
+                torch.manual_seed(0)
+                out = mel_transform.griffin_lim(y_mel, n_iters=n_iters, **kwargs)
+                t = timeit(lambda: mel_transform.griffin_lim(y_mel, n_iters=n_iters, **kwargs), args.repeats, warmup=1)
+                logging.info("{:<30} n_iters={:<3} {:8.1f} ms  spectral convergence {:.4f}".format(
+                    name, n_iters, t, spectral_convergence(mel_transform.stft_fn, out, target)))
+
+
+def saved_tensor_bytes(fn):
+    """
+    RETURNS
+    -------
+    output of fn() and the bytes of the distinct tensors autograd saved for backward while running it
+    """
+    storages = {}
+
+    def pack(tensor):
+        storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        out = fn()
+    return out, sum(storages.values())
+
+
+def bench_griffin_lim_memory(args):
+    mel_transform = TacotronSTFT(args.n_fft, args.hop, args.n_fft, backend=args.backend).to(device)
+    y = test_signal(args.batch_size, args.seconds, args.sr)
+    with torch.no_grad():
+        y_mel = mel_transform.mel_spectrogram(y)
+    for grad_iters, checkpoint_segments in [(0, 0), (args.n_iters, 0), (args.n_iters, args.segments),
+                                             (args.truncate, 0), (args.truncate, args.segments)]:
+        magnitudes = y_mel.clone().requires_grad_(True)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        out, saved = saved_tensor_bytes(lambda: mel_transform.griffin_lim(
+            magnitudes, n_iters=args.n_iters, momentum=args.momentum,
+            grad_iters=grad_iters, checkpoint_segments=checkpoint_segments))
+        out.pow(2).sum().backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            peak = "{:8.1f} MB".format((torch.cuda.max_memory_allocated() - base) / 2**20)
+        else:
+            peak = "n/a"
+        logging.info("grad_iters={:<3} checkpoint_segments={:<2} saved for backward {:8.1f} MB  peak {}  fwd+bwd {:7.1f} ms".format(
+            grad_iters, checkpoint_segments, saved / 2**20, peak, (time.perf_counter() - start) * 1000))
+
+
+def bench_surrogate(args):
+    from model.surrogate import VocoderSurrogate, load_surrogate
+    mel_transform = TacotronSTFT(args.n_fft, args.hop, args.n_fft, backend=args.backend).to(device)
+    if args.checkpoint:
+        surrogate = load_surrogate(args.checkpoint, device, backend=args.backend)
+    else:
+        surrogate = VocoderSurrogate(args.n_fft, args.hop, args.n_fft, backend=args.backend).to(device)
+        for param in surrogate.parameters():
+            param.requires_grad = False
+    y = test_signal(args.batch_size, args.seconds, args.sr).unsqueeze(1)
+
+    def griffin_lim_branch():
+        # what Decoder.forward runs when global_step > vocoder_step, with a backward pass to y
+        y_in = y.clone().requires_grad_(True)
+        y_mel = mel_transform.mel_spectrogram(y_in.squeeze(1))
+        mel_transform.griffin_lim(y_mel, n_iters=args.n_iters).sum().backward()
+
+    def surrogate_branch():
+        y_in = y.clone().requires_grad_(True)
+        mel_transform.wav_norm(surrogate(y_in).squeeze(1)).sum().backward()
+
+    t_gl = timeit(griffin_lim_branch, args.repeats, warmup=1)
+    t_surrogate = timeit(surrogate_branch, args.repeats, warmup=1)
+    logging.info("B={} {:.1f} s: mel + griffin-lim({}) {:.1f} ms, surrogate {:.1f} ms ({:.1f}x), fwd+bwd".format(
+        args.batch_size, args.seconds, args.n_iters, t_gl, t_surrogate, t_gl / t_surrogate))
+
+
+def load_generator(checkpoint):
+    # the V1 HiFi-GAN of get_vocoder; randomly initialised if no checkpoint is given (same cost)
+    import json
+    import hifigan
+    with open("hifigan/config.json", "r") as f:
+        h = hifigan.AttrDict(json.load(f))
+    generator = hifigan.Generator(h)
+    if checkpoint:
+        generator.load_state_dict(torch.load(checkpoint, map_location="cpu")["generator"])
+    generator.eval()
+    generator.remove_weight_norm()
+    for param in generator.parameters():
+        param.requires_grad = False
+    return generator.to(device), h
+
+
+def bench_hifigan(args):
+    from hifigan import optimize_generator
+    generator, h = load_generator(args.checkpoint)
+    mel = torch.randn(args.batch_size, h.num_mels, int(args.seconds * h.sampling_rate / h.hop_size), device=device)
+    seconds = args.batch_size * mel.shape[2] * h.hop_size / h.sampling_rate
+    models = {"generator": generator}
+    for mode in args.modes:
+        for fuse in [False, True]:
+            models["{}{}".format(mode, ", fused" if fuse else "")] = optimize_generator(generator, mode=mode, fuse=fuse)
+    with torch.no_grad():
+        reference = generator(mel)
+        for threads in args.thread_counts:
+            torch.set_num_threads(threads)
+            for name, model in models.items():
+                err = (model(mel) - reference).abs().max().item()
+                t = timeit(lambda: model(mel), args.repeats, warmup=1)
+                logging.info("threads={:<3} {:<16} {:8.1f} ms  RTF {:.3f}  max abs diff {:.1e}".format(
+                    threads, name, t, t / 1000 / seconds, err))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads, 0 keeps the default")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("stft", help="phase vs phasor STFT round trip")
+    p.add_argument("--batch_size", type=int, default=8)
+    p.add_argument("--seconds", type=float, default=4.0)
+    p.add_argument("--sr", type=int, default=22050)
+    p.add_argument("--n_fft", type=int, default=1024)
+    p.add_argument("--hop", type=int, default=256)
+    p.add_argument("--backends", nargs="+", default=list(STFT_BACKENDS), choices=STFT_BACKENDS)
+    p.set_defaults(func=bench_stft)
+
+    p = subparsers.add_parser("griffin_lim", help="Griffin-Lim vs Fast Griffin-Lim")
+    p.add_argument("--batch_size", type=int, default=4)
+    p.add_argument("--seconds", type=float, default=2.0)
+    p.add_argument("--sr", type=int, default=22050)
+    p.add_argument("--n_fft", type=int, default=1024)
+    p.add_argument("--hop", type=int, default=256)
+    p.add_argument("--backend", default="conv", choices=STFT_BACKENDS)
+    p.add_argument("--momentum", type=float, default=0.99)
+    p.add_argument("--n_iters", type=int, nargs="+", default=[8, 16, 32, 60])
+    p.set_defaults(func=bench_griffin_lim)
+
+    p = subparsers.add_parser("griffin_lim_memory", help="memory of backprop through Griffin-Lim")
+    p.add_argument("--batch_size", type=int, default=4)
+    p.add_argument("--seconds", type=float, default=4.0)
+    p.add_argument("--sr", type=int, default=22050)
+    p.add_argument("--n_fft", type=int, default=1024)
+    p.add_argument("--hop", type=int, default=256)
+    p.add_argument("--backend", default="conv", choices=STFT_BACKENDS)
+    p.add_argument("--momentum", type=float, default=0.99)
+    p.add_argument("--n_iters", type=int, default=60)
+    p.add_argument("--truncate", type=int, default=8, help="grad_iters of the truncated runs")
+    p.add_argument("--segments", type=int, default=6, help="checkpoint_segments of the checkpointed runs")
+    p.set_defaults(func=bench_griffin_lim_memory)
+
+    p = subparsers.add_parser("surrogate", help="vocoding simulation vs learned surrogate, per training step")
+    p.add_argument("--batch_size", type=int, default=4)
+    p.add_argument("--seconds", type=float, default=4.0)
+    p.add_argument("--sr", type=int, default=22050)
+    p.add_argument("--n_fft", type=int, default=1024)
+    p.add_argument("--hop", type=int, default=256)
+    p.add_argument("--backend", default="conv", choices=STFT_BACKENDS)
+    p.add_argument("--n_iters", type=int, default=60)
+    p.add_argument("--checkpoint", type=str, default="", help="trained surrogate, an untrained one of the default size if empty")
+    p.set_defaults(func=bench_surrogate)
+
+    p = subparsers.add_parser("hifigan", help="real-time factor of HiFi-GAN and its optimized inference graphs")
+    p.add_argument("--batch_size", type=int, default=1)
+    p.add_argument("--seconds", type=float, default=4.0)
+    p.add_argument("--thread_counts", type=int, nargs="+", default=[1, 4, 16])
+    p.add_argument("--modes", nargs="+", default=["eager", "script", "compile"], choices=["eager", "script", "compile"])
+    p.add_argument("--checkpoint", type=str, default="", help="generator checkpoint, random weights if empty")
+    p.set_defaults(func=bench_hifigan)
+
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    logging.info("device: {}, threads: {}".format(device, torch.get_num_threads()))
+    args.func(args)
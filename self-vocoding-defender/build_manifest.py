@@ -0,0 +1,36 @@
+import os
+import yaml
+import logging
+import argparse
+from collections import Counter
+from dataset.data import build_manifest, read_manifest, MANIFEST_NAME
+
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+
+def main(args, train_config):
+    dirs = [os.path.join(train_config["path"]["raw_path"], flag) for flag in args.flags] + args.dirs
+    workers = args.workers if args.workers is not None else train_config.get("loader", {}).get("preload_workers", 0)
+    for dataset_path in dirs:
+        num_files, skipped = build_manifest(dataset_path, num_workers=workers)
+        for path in skipped:
+            logging.warning("skipped {}: unreadable header or no frames".format(path))
+        files = read_manifest(os.path.join(dataset_path, MANIFEST_NAME))
+        seconds = sum(num_frames / sr for _, num_frames, sr, _ in files)
+        rates = Counter(sr for _, _, sr, _ in files)
+        channels = Counter(ch for _, _, _, ch in files)
+        logging.info("{}: {} files, {:.1f} h, sample rates {}, channels {}, {} skipped".format(
+            dataset_path, num_files, seconds / 3600, dict(rates), dict(channels), len(skipped)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="write the manifest.tsv (path, frames, sample rate, channels) of dataset directories")
+    parser.add_argument("-t", "--train_config", type=str, default="config/train.yaml", help="path to train.yaml")
+    parser.add_argument("--flags", nargs="*", default=["train", "val"], help="splits under path.raw_path")
+    parser.add_argument("--dirs", nargs="*", default=[], help="other directories, e.g. the wavs of embed_and_save.py / extract.py")
+    parser.add_argument("--workers", type=int, default=None, help="probing processes, loader.preload_workers if not given")
+    args = parser.parse_args()
+
+    train_config = yaml.load(open(args.train_config, "r"), Loader=yaml.FullLoader)
+    main(args, train_config)
@@ -1,13 +1,365 @@
 from concurrent.futures import process
 import os
+import re
 import torch
 import julius
 import torchaudio
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
 import random
 import librosa
 from boltons import fileutils
 import numpy as np
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from rich.progress import track
+from .resample_cache import ResampleCache, resample
+
+
+def _init_preload_worker():
+    # one decode per process, intra-op threads would only oversubscribe the cores
+    torch.set_num_threads(1)
+
+
+def cut_length(length, sr, sample_rate, max_len, rng):
+    """
+    Length after the random cut of the preloading datasets: a file longer
+    than max_len samples at its own rate sr is cut to rng.randint(5*sr,
+    max_len) of them. `length` is counted at sample_rate, the rate it is
+    stored at, and so is the result.
+    """
+    if max_len and length * sr > max_len * sample_rate:
+        return min(length, int(np.ceil(rng.randint(5*sr, max_len) * sample_rate / sr)))
+    return length
+
+
+def read_crop(path, num_frames, sr, max_len, rng):
+    """
+    Random crop of a file of num_frames frames at rate sr: the whole file
+    up to max_len frames, otherwise rng.randint(5*sr, max_len) of them at an
+    offset drawn from rng. Only that frame range is decoded (torchaudio.load
+    with frame_offset / num_frames seeks in WAV / FLAC).
+
+    RETURNS
+    -------
+    (first channel of the crop, of shape (1, T), sample rate of the file)
+    """
+    offset, length = 0, num_frames
+    if max_len and num_frames > max_len:
+        length = rng.randint(5*sr, max_len)
+        offset = rng.randint(0, num_frames - length)
+    wav, sr = torchaudio.load(path, frame_offset=offset, num_frames=length)
+    return wav[0,:].view(1,-1), sr
+
+
+def load_resampled(cache, path, max_len, or_sample_rate, sample_rate, backend, rng):
+    """
+    One file cropped and resampled for the wav datasets. With backend
+    "torchaudio" and no cache directory the file is cropped (files longer
+    than max_len to rng.randint(5*sr, max_len) samples), then resampled from
+    or_sample_rate. Otherwise the whole file is resampled through the
+    ResampleCache `cache`, with backend "torchaudio" (Resample from
+    or_sample_rate) or "librosa" (librosa.load at sample_rate), then cropped
+
+    RETURNS
+    -------
+    (wav of shape (1, T), sample rate of the file)
+    """
+    if backend == "torchaudio" and not cache.cache_dir:
+        # no entry to write: crop first, so long files are not resampled whole
+        wav, sr = torchaudio.load(path)
+        if max_len and wav.shape[1] > max_len:
+            wav = wav[:, :rng.randint(5*sr, max_len)]
+        return resample(wav, or_sample_rate, sample_rate), sr
+    wav, sr = cache.load(path, or_sample_rate, sample_rate, backend)
+    if backend == "librosa":
+        if max_len and wav.shape[1] > max_len:
+            wav = wav[:, :rng.randint(5*sr, max_len)]
+        return wav, sr
+    return wav[:, :cut_length(wav.shape[1], sr, sample_rate, max_len, rng)], sr
+
+
+def _preload_item(job):
+    """
+    Decode, crop and resample one file for the preloading datasets.
+
+    PARAMS
+    ------
+    job: (path, seed, max_len, or_sample_rate, sample_rate, backend, cache).
+    The random crop of files longer than max_len draws from
+    random.Random(seed), so the result does not depend on which process
+    handles the file. sample_rate None keeps the file as it is; otherwise
+    see load_resampled, with the ResampleCache built from cache = (cache_dir, dtype)
+
+    RETURNS
+    -------
+    (wav of shape (1, T), sample rate of the file)
+    """
+    path, seed, max_len, or_sample_rate, sample_rate, backend, cache = job
+    rng = random.Random(seed)
+    if sample_rate is None:
+        wav, sr = torchaudio.load(path)
+        if max_len and wav.shape[1] > max_len:
+            wav = wav[:, :rng.randint(5*sr, max_len)]
+        return wav, sr
+    return load_resampled(ResampleCache(*cache), path, max_len, or_sample_rate, sample_rate, backend, rng)
+
+
+def preload_wavs(paths, num_workers=0, max_len=0, or_sample_rate=None, sample_rate=None, backend="torchaudio",
+                 description="Preloading", cache=(None, "float32")):
+    """
+    Decode (and crop / resample, see _preload_item) every file of a dataset,
+    fanned out over num_workers processes (0: one per core, 1: in this
+    process). The output follows the order of paths, and the random crops
+    are seeded per file from the global `random` state, so the result is the
+    same for any num_workers.
+
+    RETURNS
+    -------
+    list of (wav, sample rate of the file)
+    """
+    return list(iter_wavs(paths, num_workers, max_len, or_sample_rate, sample_rate, backend, description, cache))
+
+
+def iter_wavs(paths, num_workers=0, max_len=0, or_sample_rate=None, sample_rate=None, backend="torchaudio",
+              description="Preloading", cache=(None, "float32")):
+    """ preload_wavs as a generator, for consumers that do not keep every file in memory """
+    jobs = [(path, random.getrandbits(32), max_len, or_sample_rate, sample_rate, backend, cache) for path in paths]
+    if num_workers <= 0:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(jobs))
+    if num_workers <= 1:
+        for job in track(jobs, description=description):
+            yield _preload_item(job)
+        return
+    with ProcessPoolExecutor(num_workers, initializer=_init_preload_worker) as pool:
+        chunksize = max(1, min(64, len(jobs) // (num_workers * 8)))
+        loaded = pool.map(_preload_item_numpy, jobs, chunksize=chunksize)
+        for wav, sr in track(loaded, total=len(jobs), description=description):
+            yield torch.from_numpy(wav), sr
+
+
+def _preload_item_numpy(job):
+    # arrays are pickled by value; tensors would go through torch's shared memory, one file descriptor each
+    wav, sr = _preload_item(job)
+    return wav.numpy(), sr
+
+
+def preload_workers(train_config):
+    return train_config.get("loader", {}).get("preload_workers", 0)
+
+
+def preload_dtype(train_config):
+    return train_config.get("loader", {}).get("preload_dtype", "float32")
+
+
+def resample_cache(train_config):
+    """ (cache_dir, dtype) of the ResampleCache; cache_dir None falls back to SVD_RESAMPLE_CACHE, "" (or neither set) disables it """
+    loader = train_config.get("loader", {})
+    return loader.get("resample_cache"), loader.get("resample_cache_dtype", "float32")
+
+
+class bucket_sampler(Sampler):
+    """
+    Batch sampler grouping utterances of similar length, so that padded
+    batches (pad_collate) waste little compute on padding.
+
+    Each epoch the dataset is shuffled and cut into pools of
+    batch_size * pool_batches items; every pool is sorted by length and cut
+    into batches, and the batches of all pools are shuffled. pool_batches 0
+    sorts the whole dataset at once (least padding, but then the batches of
+    an epoch are the same up to order). Draws from the global `random` state.
+    """
+    def __init__(self, lengths, batch_size, pool_batches=50, shuffle=True, drop_last=False):
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.pool_batches = pool_batches
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            random.shuffle(indices)
+        pool_size = self.batch_size * self.pool_batches if self.pool_batches > 0 else len(indices)
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start:start + pool_size], key=lambda idx: self.lengths[idx])
+            batches += [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            # every pool but the last holds whole batches
+            return len(self.lengths) // self.batch_size
+        pool_size = self.batch_size * self.pool_batches if self.pool_batches > 0 else max(len(self.lengths), 1)
+        full, rest = divmod(len(self.lengths), pool_size)
+        return full * int(np.ceil(pool_size / self.batch_size)) + int(np.ceil(rest / self.batch_size))
+
+
+def pad_collate(batch):
+    """
+    collate_fn for datasets whose "matrix" is a (1, T) waveform: zero-pads
+    every example to the longest of the batch
+
+    RETURNS
+    -------
+    dict with "matrix" (B, 1, T_max), "lengths" (B,) valid samples of each
+    example, "pad_num" (B,) zeros appended to it, and the other fields of
+    the samples batched like the default collate does
+    """
+    lengths = torch.tensor([sample["matrix"].shape[-1] for sample in batch], dtype=torch.long)
+    max_len = int(lengths.max())
+    matrix = torch.zeros(len(batch), 1, max_len, dtype=batch[0]["matrix"].dtype)
+    for i, sample in enumerate(batch):
+        matrix[i, :, :lengths[i]] = sample["matrix"]
+    return {
+        "matrix": matrix,
+        "lengths": lengths,
+        "sample_rate": torch.tensor([sample["sample_rate"] for sample in batch]),
+        "patch_num": torch.tensor([sample["patch_num"] for sample in batch]),
+        "pad_num": max_len - lengths,
+        "name": [sample["name"] for sample in batch],
+    }
+
+
+MANIFEST_NAME = "manifest.tsv"
+AUDIO_PATTERNS = ["*.wav", "*.flac", "*.mp3", "*.ogg"]
+
+
+def probe_audio(path):
+    """ (num_frames, sample_rate, channels) from the header of path, None if it cannot be read """
+    try:
+        info = torchaudio.info(path)
+    except Exception:
+        return None
+    return info.num_frames, info.sample_rate, info.num_channels
+
+
+def build_manifest(dataset_path, manifest_path=None, num_workers=0):
+    """
+    Probe the headers of the audio files under dataset_path (recursively,
+    AUDIO_PATTERNS) over num_workers processes (0: one per core) and write a
+    manifest, by default dataset_path/manifest.tsv, which the datasets then
+    read instead of listing the directory (dataset_files). Files whose
+    header cannot be read, or that have no frames, are left out.
+
+    RETURNS
+    -------
+    (number of files in the manifest, paths left out)
+    """
+    manifest_path = manifest_path or os.path.join(dataset_path, MANIFEST_NAME)
+    root = os.path.dirname(os.path.abspath(manifest_path))
+    paths = sorted(fileutils.iter_find_files(dataset_path, AUDIO_PATTERNS))
+    if num_workers <= 0:
+        num_workers = os.cpu_count() or 1
+    num_workers = max(1, min(num_workers, len(paths)))
+    if num_workers == 1:
+        infos = map(probe_audio, paths)
+    else:
+        pool = ProcessPoolExecutor(num_workers, initializer=_init_preload_worker)
+        infos = pool.map(probe_audio, paths, chunksize=max(1, min(256, len(paths) // (num_workers * 8))))
+    rows, skipped = [], []
+    for path, info in track(zip(paths, infos), total=len(paths), description="Probing"):
+        if info is None or info[0] <= 0:
+            skipped.append(path)
+        else:
+            rows.append("{}\t{}\t{}\t{}\n".format(os.path.relpath(path, root), *info))
+    if num_workers > 1:
+        pool.shutdown()
+    fd, tmp_path = tempfile.mkstemp(dir=root, suffix=".tsv.tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write("# path\tnum_frames\tsample_rate\tchannels\n")
+        f.writelines(rows)
+    os.replace(tmp_path, manifest_path)
+    return len(rows), skipped
+
+
+def read_manifest(manifest_path):
+    """
+    Files of a manifest: one "<path>[<tab><num_frames><tab><sample_rate><tab><channels>]"
+    line per file, paths relative to the manifest's directory; lines
+    starting with # are skipped
+
+    RETURNS
+    -------
+    list of (path, num_frames, sample_rate, channels), None for missing fields
+    """
+    root = os.path.dirname(os.path.abspath(manifest_path))
+    files = []
+    with open(manifest_path, "r") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if not fields[0] or fields[0].startswith("#"):
+                continue
+            info = [int(field) for field in fields[1:4]]
+            files.append(tuple([os.path.join(root, fields[0])] + info + [None] * (3 - len(info))))
+    return files
+
+
+def dataset_files(dataset_path):
+    """
+    RETURNS
+    -------
+    list of (name relative to dataset_path, num_frames, sample_rate, channels):
+    from dataset_path/manifest.tsv if there is one (build_manifest.py), so the
+    header info is known without opening the files, otherwise the entries of
+    the directory with None for the header info
+    """
+    manifest_path = os.path.join(dataset_path, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        return [(os.path.relpath(path, dataset_path),) + tuple(info) for path, *info in read_manifest(manifest_path)]
+    return [(name, None, None, None) for name in os.listdir(dataset_path)]
+
+
+def list_files(dataset_path):
+    """ names of the files of a dataset directory, from its manifest if it has one """
+    return [name for name, _, _, _ in dataset_files(dataset_path)]
+
+
+SHARD_VERSION = 1
+
+
+def shard_paths(shard_dir, flag):
+    return os.path.join(shard_dir, flag + ".pcm"), os.path.join(shard_dir, flag + ".index.npz")
+
+
+def pack_shard(paths, shard_dir, flag, num_workers=0, or_sample_rate=None, sample_rate=None, cache=(None, "float32")):
+    """
+    Write the files of one dataset split, resampled from or_sample_rate to
+    sample_rate as wav_dataset does (but not cropped), into one contiguous
+    shard: <flag>.pcm holds the float32 samples back to back, and
+    <flag>.index.npz their offsets, lengths, names and source sample rates.
+
+    RETURNS
+    -------
+    total number of samples written
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    pcm_path, index_path = shard_paths(shard_dir, flag)
+    offsets, lengths, rates = [], [], []
+    offset = 0
+    tmp_path = pcm_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        for wav, sr in iter_wavs(paths, num_workers, 0, or_sample_rate, sample_rate, description="Packing " + flag, cache=cache):
+            wav = wav.reshape(-1).numpy().astype(np.float32)
+            f.write(wav.tobytes())
+            offsets.append(offset)
+            lengths.append(len(wav))
+            rates.append(sr)
+            offset += len(wav)
+    os.replace(tmp_path, pcm_path)
+    # through a file object: np.savez would append .npz to the .tmp name
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, version=SHARD_VERSION, dtype="float32", sample_rate=sample_rate,
+                 offsets=np.array(offsets, dtype=np.int64), lengths=np.array(lengths, dtype=np.int64),
+                 rates=np.array(rates, dtype=np.int64), names=np.array([os.path.basename(p) for p in paths]))
+    os.replace(tmp_path, index_path)
+    return offset
 
 
 class twod_dataset(Dataset):
@@ -44,7 +396,7 @@ class twod_dataset(Dataset):
         return sample
 
     def process_meta(self):
-        wavs = os.listdir(self.dataset_path)
+        wavs = list_files(self.dataset_path)
         return wavs
 
 
@@ -75,7 +427,7 @@ class oned_dataset(Dataset):
         return sample
 
     def process_meta(self):
-        wavs = os.listdir(self.dataset_path)
+        wavs = list_files(self.dataset_path)
         return wavs
 
 
@@ -94,35 +446,32 @@ class mel_dataset(Dataset):
         # self.stft = STFT(n_fft, hop_length)
 
         sr = process_config["audio"]["or_sample_rate"]
-        self.resample = torchaudio.transforms.Resample(sr,self.sample_rate)
-        self.sample_list = []
-        for idx in range(len(self.wavs)):
-            audio_name = self.wavs[idx]
-            # import pdb
-            # pdb.set_trace()
-            wav, sr = torchaudio.load(os.path.join(self.dataset_path, audio_name))
-            if wav.shape[1] > self.max_len:
-                cuted_len = random.randint(5*sr, self.max_len)
-                wav = wav[:, :cuted_len]
-            wav = self.resample(wav[0,:].view(1,-1))
-            # wav = wav[:,:self.max_len]
-            sample = {
-                "matrix": wav,
-                "sample_rate": sr,
-                "patch_num": 0,
-                "pad_num": 0,
-                "name": audio_name
-            }
-            self.sample_list.append(sample)
+        loaded = preload_wavs([os.path.join(self.dataset_path, audio_name) for audio_name in self.wavs],
+                              preload_workers(train_config), self.max_len, sr, self.sample_rate,
+                              cache=resample_cache(train_config))
+        # wav = wav[:,:self.max_len]
+        # stored as in wav_dataset
+        self.rates = np.array([sr for _, sr in loaded], dtype=np.int64)
+        wavs = [wav for wav, _ in loaded]
+        del loaded
+        self.audio = shared_wavs(wavs, preload_dtype(train_config))
+        self.wavs = np.array(self.wavs)
     
     def __len__(self):
         return len(self.wavs)
 
     def __getitem__(self, idx):
-        return self.sample_list[idx]
+        sample = {
+            "matrix": self.audio[idx],
+            "sample_rate": int(self.rates[idx]),
+            "patch_num": 0,
+            "pad_num": 0,
+            "name": str(self.wavs[idx])
+        }
+        return sample
 
     def process_meta(self):
-        wavs = os.listdir(self.dataset_path)
+        wavs = list_files(self.dataset_path)
         return wavs
 
 
@@ -163,7 +512,7 @@ class mel_dataset_test(Dataset):
         # wavs = os.listdir(self.dataset_path)
         # return wavs
         wav_files = []
-        for filename in os.listdir(self.dataset_path):
+        for filename in list_files(self.dataset_path):
             if filename.endswith('.wav'):
                 wav_files.append(filename)
         return wav_files
@@ -204,7 +553,7 @@ class mel_dataset_test_2(Dataset):
         # wavs = os.listdir(self.dataset_path)
         # return wavs
         wav_files = []
-        for filename in os.listdir(self.dataset_path):
+        for filename in list_files(self.dataset_path):
             if filename.endswith('.wav'):
                 wav_files.append(filename)
         return wav_files
@@ -239,12 +588,59 @@ class load_numpy_mel(Dataset):
 
     def process_meta(self):
         wav_files = []
-        for filename in os.listdir(self.dataset_path):
+        for filename in list_files(self.dataset_path):
             if filename.endswith('.npy'):
                 wav_files.append(filename)
         return wav_files
 
 
+class shared_wavs():
+    """
+    Preloaded waveforms stored back to back in one flat tensor in shared
+    memory, indexed by NumPy arrays of offsets, frame counts and channel
+    counts. DataLoader workers map that one segment, where a list of
+    per-file tensors would be shared as one segment (and file descriptor)
+    per file.
+
+    PARAMS
+    ------
+    wavs: list of float waveforms of shape (C, T), emptied as they are copied
+    in, so that (the shared pages being touched only when written) the peak
+    memory stays about one copy of the corpus
+    dtype: "float32", or "int16" for half the memory: each item is scaled by
+    its own peak to the int16 range (quantization noise ~96 dB below the
+    peak) and converted back to float32 in __getitem__
+    """
+    def __init__(self, wavs, dtype="float32"):
+        assert dtype in ("float32", "int16"), "unknown preload dtype {}".format(dtype)
+        self.dtype = dtype
+        self.channels = np.array([wav.shape[0] for wav in wavs], dtype=np.int64)
+        self.lengths = np.array([wav.shape[1] for wav in wavs], dtype=np.int64)
+        self.scales = np.ones(len(wavs), dtype=np.float32)
+        sizes = self.channels * self.lengths
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
+        self.pcm = torch.empty(int(sizes.sum()), dtype=getattr(torch, dtype)).share_memory_()
+        for i in range(len(wavs)):
+            wav = wavs[i].reshape(-1)
+            if dtype == "int16":
+                # empty items keep scale 1.0
+                if wav.numel():
+                    self.scales[i] = max(wav.abs().max().item(), 1e-8) / 32767
+                wav = torch.round(wav / float(self.scales[i])).to(torch.int16)
+            self.pcm[self.offsets[i]:self.offsets[i] + sizes[i]] = wav
+            wavs[i] = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        offset, channels, length = self.offsets[idx], self.channels[idx], self.lengths[idx]
+        wav = self.pcm[offset:offset + channels * length].view(channels, length)
+        if self.dtype == "int16":
+            wav = wav.float() * float(self.scales[idx])
+        return wav
+
+
 # pre-load dataset and resample to 22.05KHz
 class wav_dataset(Dataset):
     def __init__(self, process_config, train_config, flag='train'):
@@ -262,34 +658,164 @@ class wav_dataset(Dataset):
         # self.stft = STFT(n_fft, hop_length)
 
         sr = process_config["audio"]["or_sample_rate"]
-        self.resample = torchaudio.transforms.Resample(sr,self.sample_rate)
-        self.sample_list = []
-        for idx in range(len(self.wavs)):
-            audio_name = self.wavs[idx]
-            wav, sr = torchaudio.load(os.path.join(self.dataset_path, audio_name))
-            if wav.shape[1] > self.max_len:
-                cuted_len = random.randint(5*sr, self.max_len)
-                wav = wav[:, :cuted_len]
-            wav = self.resample(wav[0,:].view(1,-1))
-            sample = {
-                "matrix": wav,
-                "sample_rate": sr,
-                "patch_num": 0,
-                "pad_num": 0,
-                "name": audio_name,
-            }
-            self.sample_list.append(sample)
+        loaded = preload_wavs([os.path.join(self.dataset_path, audio_name) for audio_name in self.wavs],
+                              preload_workers(train_config), self.max_len, sr, self.sample_rate,
+                              cache=resample_cache(train_config))
+        # one shared tensor and NumPy metadata, not a list of dicts: DataLoader workers do not copy them
+        self.rates = np.array([sr for _, sr in loaded], dtype=np.int64)
+        wavs = [wav for wav, _ in loaded]
+        del loaded
+        self.audio = shared_wavs(wavs, preload_dtype(train_config))
+        self.wavs = np.array(self.wavs)
+        # samples per item, for bucket_sampler
+        self.lengths = self.audio.lengths
     
     def __len__(self):
         return len(self.wavs)
 
     def __getitem__(self, idx):
-        return self.sample_list[idx]
+        sample = {
+            "matrix": self.audio[idx],
+            "sample_rate": int(self.rates[idx]),
+            "patch_num": 0,
+            "pad_num": 0,
+            "name": str(self.wavs[idx]),
+        }
+        return sample
 
     def process_meta(self):
-        wavs = os.listdir(self.dataset_path)
+        wavs = list_files(self.dataset_path)
         return wavs
 
+# wav_dataset served from a shard written by pack_dataset.py
+class shard_dataset(Dataset):
+    """
+    Items are slices of one np.memmap of the split's shard, so there is no
+    per-file open/decode and no startup cost beyond reading the index. The
+    mapping is opened lazily in each process (it is dropped when the dataset
+    is pickled to DataLoader workers) and the pages are shared through the
+    page cache. Files longer than max_len are cut like in wav_dataset, once
+    per dataset, by shortening the slice.
+    """
+    def __init__(self, process_config, train_config, flag='train'):
+        self.dataset_name = train_config["dataset"]
+        self.shard_dir = train_config["path"]["shard_path"]
+        self.sample_rate = process_config["audio"]["sample_rate"]
+        self.max_wav_value = process_config["audio"]["max_wav_value"]
+        self.win_len = process_config["audio"]["win_len"]
+        self.max_len = process_config["audio"]["max_len"]
+        self.pcm_path, index_path = shard_paths(self.shard_dir, flag)
+        with np.load(index_path) as index:
+            assert int(index["version"]) == SHARD_VERSION, "shard {} is from another version, repack it".format(index_path)
+            assert int(index["sample_rate"]) == self.sample_rate, "shard {} was packed at {} Hz".format(index_path, int(index["sample_rate"]))
+            self.dtype = str(index["dtype"])
+            self.offsets = index["offsets"]
+            self.lengths = index["lengths"].copy()
+            self.rates = index["rates"]
+            self.wavs = [str(name) for name in index["names"]]
+        # the cut of wav_dataset, with the same seeds as preload_wavs
+        for idx in range(len(self.wavs)):
+            rng = random.Random(random.getrandbits(32))
+            self.lengths[idx] = cut_length(self.lengths[idx], int(self.rates[idx]), self.sample_rate, self.max_len, rng)
+        self._pcm = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pcm"] = None
+        return state
+
+    @property
+    def pcm(self):
+        if self._pcm is None:
+            # copy-on-write: writable for torch.from_numpy, never written back
+            self._pcm = np.memmap(self.pcm_path, dtype=self.dtype, mode='c')
+        return self._pcm
+
+    def __len__(self):
+        return len(self.wavs)
+
+    def __getitem__(self, idx):
+        offset, length = self.offsets[idx], self.lengths[idx]
+        wav = torch.from_numpy(self.pcm[offset:offset + length]).view(1, -1)
+        sample = {
+            "matrix": wav,
+            "sample_rate": int(self.rates[idx]),
+            "patch_num": 0,
+            "pad_num": 0,
+            "name": self.wavs[idx],
+        }
+        return sample
+
+
+WM_INDEX_VERSION = 1
+
+
+def parse_wm_line(line):
+    """
+    One line of a watermark assignment list: the file name (path and
+    extension dropped) followed by its bits, as "0 1 1 ...", "[0, 1, 1, ...]",
+    "0110..." or with -1/1 values
+
+    RETURNS
+    -------
+    (name, list of 0/1 bits), or None for a blank line
+    """
+    tokens = [token for token in re.split(r"[\s,:;\[\]]+", line.strip()) if token]
+    if not tokens:
+        return None
+    name = os.path.splitext(os.path.basename(tokens[0]))[0]
+    values = tokens[1:]
+    if len(values) == 1 and len(values[0]) > 1 and set(values[0]) <= set("01"):
+        values = list(values[0])
+    return name, [1 if int(value) > 0 else 0 for value in values]
+
+
+def load_wm_index(list_path, msg_length=None):
+    """
+    Parse a watermark assignment list once into a name -> row index and a
+    bit matrix. The result is kept next to the list as <list_path>.npz
+    (names and np.packbits of the bits), and reused while the list keeps
+    its size and mtime.
+
+    RETURNS
+    -------
+    (dict name -> row, torch.FloatTensor of shape (N, msg_length) in {-1, 1})
+    """
+    stat = os.stat(list_path)
+    index_path = list_path + ".npz"
+    if os.path.exists(index_path):
+        with np.load(index_path) as index:
+            if (int(index["version"]), int(index["size"]), int(index["mtime_ns"])) == (WM_INDEX_VERSION, stat.st_size, stat.st_mtime_ns):
+                names = [name.decode() for name in index["names"]]
+                bits = np.unpackbits(index["bits"], axis=1, count=int(index["msg_length"]))
+                return _wm_index(names, bits, msg_length, list_path)
+    names, rows = [], []
+    with open(list_path, "r") as f:
+        for line in f:
+            parsed = parse_wm_line(line)
+            if parsed is not None:
+                names.append(parsed[0])
+                rows.append(parsed[1])
+    assert len(set(len(row) for row in rows)) <= 1, "watermarks of different lengths in {}".format(list_path)
+    bits = np.array(rows, dtype=np.uint8).reshape(len(rows), -1)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(index_path)), suffix=".npz.tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, version=WM_INDEX_VERSION, size=stat.st_size, mtime_ns=stat.st_mtime_ns, names=np.array([name.encode() for name in names]),
+                     msg_length=bits.shape[1], bits=np.packbits(bits, axis=1))
+        os.replace(tmp_path, index_path)
+    except OSError:
+        pass
+    return _wm_index(names, bits, msg_length, list_path)
+
+
+def _wm_index(names, bits, msg_length, list_path):
+    assert msg_length is None or bits.shape[1] == msg_length, \
+        "{} holds {}-bit watermarks, expected {}".format(list_path, bits.shape[1], msg_length)
+    rows = {name: row for row, name in enumerate(names)}
+    return rows, torch.from_numpy(bits.astype(np.float32))*2 - 1
+
+
 class finetune_vocoder_dataset(Dataset):
     def __init__(self, process_config, train_config, flag='train'):
         self.dataset_name = train_config["dataset"]
@@ -309,9 +835,8 @@ class finetune_vocoder_dataset(Dataset):
         # self.resample = torchaudio.transforms.Resample(sr,self.sample_rate)
         self.sample_list = []
         self.before_vocoded_path = ""
-        f = open('', 'r')
-        self.wmplist = f.readlines()
-        f.close()
+        # watermark of each source file, looked up by the first 10 characters of the vocoded file name
+        self.wm_rows, self.wm_bits = load_wm_index(train_config["watermark"]["assignments"], train_config["watermark"]["length"])
     
     def __len__(self):
         return len(self.wavs)
@@ -329,14 +854,7 @@ class finetune_vocoder_dataset(Dataset):
             cuted_len = random.randint(5*sr, self.max_len)
             vocoded_wav = vocoded_wav[:, :cuted_len]
         # wav = self.resample(wav[0,:].view(1,-1))
-        wm = []
-        for wm_info in self.wmplist:
-            if audio_name[:10] in wm_info:
-                for i in range(10):
-                    wm.append(int(wm_info[-21+(i*2)]))
-                break
-        wm = np.array([wm])
-        wm = torch.from_numpy(wm).float()*2 - 1
+        wm = self.wm_bits[self.wm_rows[audio_name[:10]]].view(1, -1)
 
         sample = {
             "matrix": wav,
@@ -351,7 +869,7 @@ class finetune_vocoder_dataset(Dataset):
         # return self.sample_list[idx]
 
     def process_meta(self):
-        wavs = os.listdir(self.dataset_path)
+        wavs = list_files(self.dataset_path)
         return wavs
 
 class wav_dataset_wopreload(Dataset):
@@ -369,8 +887,8 @@ class wav_dataset_wopreload(Dataset):
         # hop_length = process_config["mel"]["hop_length"]
         # self.stft = STFT(n_fft, hop_length)
 
-        sr = process_config["audio"]["or_sample_rate"]
-        self.resample = torchaudio.transforms.Resample(sr,self.sample_rate)
+        self.or_sample_rate = process_config["audio"]["or_sample_rate"]
+        self.cache = ResampleCache(*resample_cache(train_config))
     
     def __len__(self):
         return len(self.wavs)
@@ -379,11 +897,8 @@ class wav_dataset_wopreload(Dataset):
         audio_name = self.wavs[idx]
         # import pdb
         # pdb.set_trace()
-        wav, sr = torchaudio.load(os.path.join(self.dataset_path, audio_name))
-        if wav.shape[1] > self.max_len:
-            cuted_len = random.randint(5*sr, self.max_len)
-            wav = wav[:, :cuted_len]
-        wav = self.resample(wav[0,:].view(1,-1))
+        wav, sr = load_resampled(self.cache, os.path.join(self.dataset_path, audio_name), self.max_len,
+                                 self.or_sample_rate, self.sample_rate, "torchaudio", random)
         # wav = wav[:,:self.max_len]
         sample = {
             "matrix": wav,
@@ -395,10 +910,161 @@ class wav_dataset_wopreload(Dataset):
         return sample
 
     def process_meta(self):
-        wavs = os.listdir(self.dataset_path)
+        wavs = list_files(self.dataset_path)
         return wavs
     
 
+# wav_dataset with a fresh random crop on every access, read straight from the files
+class wav_dataset_crop(Dataset):
+    """
+    Only the header of each file (frame count and rate) is read up front,
+    or taken from the directory's manifest. Every __getitem__ draws a new crop of files longer than max_len and
+    decodes just that (read_crop), then resamples it from the file's own
+    rate. So the crops differ from epoch to epoch and nothing is held in
+    memory. Files up to max_len are read whole, as in wav_dataset.
+    """
+    def __init__(self, process_config, train_config, flag='train'):
+        self.dataset_name = train_config["dataset"]
+        raw_dataset_path = train_config["path"]["raw_path"]
+        self.dataset_path = os.path.join(raw_dataset_path, flag)
+        self.sample_rate = process_config["audio"]["sample_rate"]
+        self.max_wav_value = process_config["audio"]["max_wav_value"]
+        self.win_len = process_config["audio"]["win_len"]
+        self.max_len = process_config["audio"]["max_len"]
+        self.wavs, self.num_frames, self.rates = [], [], []
+        for audio_name, num_frames, sr, _ in dataset_files(self.dataset_path):
+            if num_frames is None:
+                info = torchaudio.info(os.path.join(self.dataset_path, audio_name))
+                num_frames, sr = info.num_frames, info.sample_rate
+            self.wavs.append(audio_name)
+            self.num_frames.append(num_frames)
+            self.rates.append(sr)
+
+        # one resampler per source rate, as in wav_stream_dataset
+        self._resamplers = {}
+        # longest crop of each item at sample_rate, for bucket_sampler
+        self.lengths = [int(np.ceil(min(frames, self.max_len or frames) * self.sample_rate / sr))
+                        for frames, sr in zip(self.num_frames, self.rates)]
+
+    def __len__(self):
+        return len(self.wavs)
+
+    def __getitem__(self, idx):
+        audio_name = self.wavs[idx]
+        wav, sr = read_crop(os.path.join(self.dataset_path, audio_name), self.num_frames[idx], self.rates[idx], self.max_len, random)
+        if sr != self.sample_rate:
+            if sr not in self._resamplers:
+                self._resamplers[sr] = torchaudio.transforms.Resample(sr, self.sample_rate)
+            wav = self._resamplers[sr](wav)
+        sample = {
+            "matrix": wav,
+            "sample_rate": sr,
+            "patch_num": 0,
+            "pad_num": 0,
+            "name": audio_name
+        }
+        return sample
+
+    def process_meta(self):
+        wavs = list_files(self.dataset_path)
+        return wavs
+
+
+def shard_info():
+    """ (rank, world size) of this training process, from torch.distributed or the RANK / WORLD_SIZE variables """
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+
+# streams the files of a corpus with on-the-fly resampling and cropping, in constant memory
+class wav_stream_dataset(IterableDataset):
+    """
+    The files come from loader.manifest ("{flag}" in the path is replaced
+    by the split), else from the manifest of raw_path/<flag> if it has one
+    (build_manifest.py), else from a recursive search of raw_path/<flag>.
+    Only their paths (and header info) are kept.
+
+    Each epoch (set_epoch) the files are shuffled with a seed shared by all
+    processes, dealt out to the processes by rank and then to the DataLoader
+    workers of each process, so every file is read once per epoch. Each
+    worker reads its files in order, crops long ones at random (read_crop),
+    resamples them to sample_rate, and yields them through a shuffle buffer
+    of loader.shuffle_buffer items. The random state derives from the seed,
+    the epoch and the shard only, so a run is reproducible for a given
+    number of processes and workers.
+    """
+    def __init__(self, process_config, train_config, flag='train'):
+        self.dataset_name = train_config["dataset"]
+        raw_dataset_path = train_config["path"]["raw_path"]
+        self.dataset_path = os.path.join(raw_dataset_path, flag)
+        self.sample_rate = process_config["audio"]["sample_rate"]
+        self.max_wav_value = process_config["audio"]["max_wav_value"]
+        self.win_len = process_config["audio"]["win_len"]
+        self.max_len = process_config["audio"]["max_len"]
+        loader = train_config.get("loader", {})
+        self.buffer_size = loader.get("shuffle_buffer", 256)
+        manifest = loader.get("manifest", "").format(flag=flag)
+        if not manifest and os.path.exists(os.path.join(self.dataset_path, MANIFEST_NAME)):
+            manifest = os.path.join(self.dataset_path, MANIFEST_NAME)
+        if manifest:
+            self.files = read_manifest(manifest)
+        else:
+            self.files = [(path, None, None, None) for path in sorted(fileutils.iter_find_files(self.dataset_path, AUDIO_PATTERNS))]
+        # drawn from the global state, which train.py seeds the same in every process
+        self.seed = random.getrandbits(32)
+        self.epoch = 0
+        self._resamplers = {}
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        # files of this process
+        rank, world_size = shard_info()
+        return len(range(rank, len(self.files), world_size))
+
+    def shard(self):
+        """ indices into self.files read by this process and DataLoader worker in the current epoch """
+        order = list(range(len(self.files)))
+        random.Random("{}-{}".format(self.seed, self.epoch)).shuffle(order)
+        rank, world_size = shard_info()
+        worker = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        return order[rank::world_size][worker_id::num_workers], "{}-{}-{}-{}".format(self.seed, self.epoch, rank, worker_id)
+
+    def __iter__(self):
+        indices, shard_seed = self.shard()
+        rng = random.Random(shard_seed)
+        buffer = []
+        for idx in indices:
+            buffer.append(self.load(idx, rng))
+            if len(buffer) >= max(self.buffer_size, 1):
+                yield buffer.pop(rng.randrange(len(buffer)))
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+    def load(self, idx, rng):
+        path, num_frames, sr, _ = self.files[idx]
+        if num_frames is None:
+            info = torchaudio.info(path)
+            num_frames, sr = info.num_frames, info.sample_rate
+        wav, sr = read_crop(path, num_frames, sr, self.max_len, rng)
+        if sr != self.sample_rate:
+            if sr not in self._resamplers:
+                self._resamplers[sr] = torchaudio.transforms.Resample(sr, self.sample_rate)
+            wav = self._resamplers[sr](wav)
+        sample = {
+            "matrix": wav,
+            "sample_rate": sr,
+            "patch_num": 0,
+            "pad_num": 0,
+            "name": os.path.basename(path)
+        }
+        return sample
+
+
 class wav_dataset_test(Dataset):
     def __init__(self, process_config, train_config, flag='train', path=None):
         self.dataset_name = train_config["dataset"]
@@ -415,36 +1081,34 @@ class wav_dataset_test(Dataset):
         # hop_length = process_config["mel"]["hop_length"]
         # self.stft = STFT(n_fft, hop_length)
 
-        sr = process_config["audio"]["or_sample_rate"]
-        self.resample = torchaudio.transforms.Resample(sr,self.sample_rate)
-        self.sample_list = []
-        for idx in range(len(self.wavs)):
-            audio_name = self.wavs[idx]
-            # import pdb
-            # pdb.set_trace()
-            wav, sr = torchaudio.load(os.path.join(path, audio_name))
-            # if wav.shape[1] > self.max_len:
-            #     cuted_len = random.randint(5*sr, self.max_len)
-            #     wav = wav[:, :cuted_len]
-            # wav = self.resample(wav[0,:].view(1,-1))
-            # wav = wav[:,:self.max_len]
-            sample = {
-                "matrix": wav,
-                "sample_rate": sr,
-                "patch_num": 0,
-                "pad_num": 0,
-                "name": audio_name
-            }
-            self.sample_list.append(sample)
+        loaded = preload_wavs([os.path.join(path, audio_name) for audio_name in self.wavs], preload_workers(train_config))
+        # if wav.shape[1] > self.max_len:
+        #     cuted_len = random.randint(5*sr, self.max_len)
+        #     wav = wav[:, :cuted_len]
+        # wav = self.resample(wav[0,:].view(1,-1))
+        # wav = wav[:,:self.max_len]
+        # as in wav_dataset, shared by the DataLoader workers
+        self.rates = np.array([sr for _, sr in loaded], dtype=np.int64)
+        wavs = [wav for wav, _ in loaded]
+        del loaded
+        self.audio = shared_wavs(wavs, preload_dtype(train_config))
+        self.wavs = np.array(self.wavs)
     
     def __len__(self):
         return len(self.wavs)
 
     def __getitem__(self, idx):
-        return self.sample_list[idx]
+        sample = {
+            "matrix": self.audio[idx],
+            "sample_rate": int(self.rates[idx]),
+            "patch_num": 0,
+            "pad_num": 0,
+            "name": str(self.wavs[idx])
+        }
+        return sample
 
     def process_meta(self):
-        wavs = os.listdir(self.dataset_path)
+        wavs = list_files(self.dataset_path)
         return wavs
 
 
@@ -468,16 +1132,10 @@ class wav_dataset_librosa(Dataset):
         sr = process_config["audio"]["or_sample_rate"]
         # self.resample = torchaudio.transforms.Resample(sr,self.sample_rate)
         self.sample_list = []
-        for idx in range(len(self.wavs)):
-            audio_name = self.wavs[idx]
-            # import pdb
-            # pdb.set_trace()
-            # wav, sr = torchaudio.load(os.path.join(self.dataset_path, audio_name))
-            wav, sr2 = librosa.load(os.path.join(self.dataset_path, audio_name), sr=self.sample_rate)
-            wav = torch.Tensor(wav).unsqueeze(0)
-            if wav.shape[1] > self.max_len:
-                cuted_len = random.randint(5*sr, self.max_len)
-                wav = wav[:, :cuted_len]
+        loaded = preload_wavs([os.path.join(self.dataset_path, audio_name) for audio_name in self.wavs],
+                              preload_workers(train_config), self.max_len, sr, self.sample_rate, backend="librosa",
+                              cache=resample_cache(train_config))
+        for audio_name, (wav, sr) in zip(self.wavs, loaded):
             # wav = self.resample(wav[0,:].view(1,-1))
             # wav = wav[:,:self.max_len]
             sample = {
@@ -496,5 +1154,5 @@ class wav_dataset_librosa(Dataset):
         return self.sample_list[idx]
 
     def process_meta(self):
-        wavs = os.listdir(self.dataset_path)
+        wavs = list_files(self.dataset_path)
         return wavs
@@ -0,0 +1,105 @@
+import os
+import hashlib
+import logging
+import tempfile
+import numpy as np
+import torch
+import torchaudio
+import librosa
+
+# The on-disk cache is opt-in: it is used only when a directory is given, in
+# train.yaml (loader.resample_cache) or in SVD_RESAMPLE_CACHE. It has no size
+# limit: about 88 KB per second of audio at 22.05 kHz in float32, half in int16.
+CACHE_VERSION = 1
+
+_resamplers = {}
+
+
+def default_cache_dir():
+    """ SVD_RESAMPLE_CACHE, "" (no cache) if unset """
+    return os.environ.get("SVD_RESAMPLE_CACHE", "")
+
+
+def resample(wav, or_sample_rate, sample_rate):
+    """ first channel of wav, resampled with torchaudio from or_sample_rate to sample_rate """
+    key = (or_sample_rate, sample_rate)
+    if key not in _resamplers:
+        _resamplers[key] = torchaudio.transforms.Resample(or_sample_rate, sample_rate)
+    return _resamplers[key](wav[0,:].view(1,-1))
+
+
+def _resample(path, or_sample_rate, sample_rate, resampler):
+    """
+    RETURNS
+    -------
+    (whole file resampled to sample_rate, of shape (1, T), sample rate of the file)
+    """
+    if resampler == "librosa":
+        # librosa resamples from the file's own rate
+        wav, _ = librosa.load(path, sr=sample_rate)
+        return torch.Tensor(wav).unsqueeze(0), or_sample_rate
+    wav, sr = torchaudio.load(path)
+    return resample(wav, or_sample_rate, sample_rate), sr
+
+
+class ResampleCache():
+    """
+    On-disk cache of resampled audio.
+
+    Entries are keyed by the file's absolute path, size and mtime, the
+    source and target rates and the resampler, so editing or replacing a file
+    makes its entry unreachable instead of stale. Each entry is one .npz with
+    the resampled PCM (float32, or int16 scaled by 32767 when dtype="int16",
+    half the size but no longer bit-exact) and the file's sample rate.
+    Writes go through a temporary file and os.replace, so concurrent
+    DataLoader / preload workers never read partial entries.
+    """
+    def __init__(self, cache_dir=None, dtype="float32"):
+        self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        self.dtype = dtype
+
+    def key(self, path, or_sample_rate, sample_rate, resampler):
+        stat = os.stat(path)
+        fields = (CACHE_VERSION, os.path.abspath(path), stat.st_size, stat.st_mtime_ns,
+                  or_sample_rate, sample_rate, resampler, self.dtype)
+        return hashlib.sha1(repr(fields).encode()).hexdigest()
+
+    def load(self, path, or_sample_rate, sample_rate, resampler="torchaudio"):
+        """
+        RETURNS
+        -------
+        (whole file resampled from or_sample_rate to sample_rate, of shape (1, T),
+        sample rate of the file), from the cache if possible
+        """
+        if not self.cache_dir:
+            return _resample(path, or_sample_rate, sample_rate, resampler)
+        key = self.key(path, or_sample_rate, sample_rate, resampler)
+        entry = os.path.join(self.cache_dir, key[:2], key + ".npz")
+        if os.path.exists(entry):
+            try:
+                with np.load(entry) as f:
+                    wav, sr = f["wav"], int(f["sr"])
+                if wav.dtype == np.int16:
+                    wav = wav.astype(np.float32) / 32767
+                return torch.from_numpy(wav), sr
+            except Exception as e:
+                logging.warning("ignoring unreadable resample cache entry {}: {}".format(entry, e))
+        wav, sr = _resample(path, or_sample_rate, sample_rate, resampler)
+        wav = wav.numpy()
+        if self.dtype == "int16":
+            wav = np.round(np.clip(wav, -1, 1) * 32767).astype(np.int16)
+        self._write(entry, wav, sr)
+        if wav.dtype == np.int16:
+            # what later hits will return
+            wav = wav.astype(np.float32) / 32767
+        return torch.from_numpy(wav), sr
+
+    def _write(self, entry, wav, sr):
+        try:
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(entry), suffix=".npz.tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, wav=wav, sr=sr)
+            os.replace(tmp_path, entry)
+        except OSError as e:
+            logging.warning("could not write resample cache to {}: {}".format(self.cache_dir, e))
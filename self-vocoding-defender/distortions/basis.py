@@ -0,0 +1,207 @@
+import os
+import logging
+import tempfile
+import threading
+import numpy as np
+import torch
+import librosa
+from scipy.signal import get_window
+from librosa.util import pad_center
+from librosa.filters import mel as librosa_mel_fn
+
+# Set SVD_BASIS_CACHE to an empty string to disable the on-disk cache.
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "self-vocoding-defender", "bases")
+CACHE_VERSION = 1
+
+
+def build_stft_basis(filter_length, hop_length, win_length, window):
+    """
+    Build the windowed forward/inverse Fourier bases used by the conv STFTs.
+
+    RETURNS
+    -------
+    dict of np.float32 arrays: forward_basis and inverse_basis of shape
+    (filter_length + 2, 1, filter_length), fft_window of shape (filter_length,)
+    """
+    scale = filter_length / hop_length
+    fourier_basis = np.fft.fft(np.eye(filter_length))
+
+    cutoff = int((filter_length / 2 + 1))
+    fourier_basis = np.vstack([np.real(fourier_basis[:cutoff, :]),
+                               np.imag(fourier_basis[:cutoff, :])])
+
+    forward_basis = fourier_basis[:, None, :].astype(np.float32)
+    inverse_basis = np.linalg.pinv(scale * fourier_basis).T[:, None, :].astype(np.float32)
+
+    if window is not None:
+        assert(filter_length >= win_length)
+        # get window and zero center pad it to filter_length
+        fft_window = get_window(window, win_length, fftbins=True)
+        fft_window = pad_center(fft_window, size=filter_length).astype(np.float32)
+
+        # window the bases
+        forward_basis *= fft_window
+        inverse_basis *= fft_window
+    else:
+        fft_window = np.ones(filter_length, dtype=np.float32)
+
+    return {"forward_basis": forward_basis, "inverse_basis": inverse_basis, "fft_window": fft_window}
+
+
+def build_mel_basis(sampling_rate, filter_length, n_mel_channels, mel_fmin, mel_fmax):
+    """
+    Build the mel filterbank and its pseudo-inverse used by TacotronSTFT.
+
+    RETURNS
+    -------
+    dict of np.float32 arrays: mel_basis of shape (n_mel_channels, filter_length/2 + 1)
+    and mel_to_linear_basis of shape (filter_length/2 + 1, n_mel_channels)
+    """
+    mel_basis = librosa_mel_fn(
+        sr=sampling_rate, n_fft=filter_length, n_mels=n_mel_channels, fmin=mel_fmin, fmax=mel_fmax)
+    mel_basis = torch.from_numpy(mel_basis).float()
+    mel_to_linear_basis = torch.linalg.pinv(mel_basis)
+    return {"mel_basis": mel_basis.numpy(), "mel_to_linear_basis": mel_to_linear_basis.numpy()}
+
+
+class BasisRegistry():
+    """
+    Process-wide store of STFT and mel bases.
+
+    Bases are built once per geometry and handed out as the same CPU tensors to
+    every module that asks for them; `share` extends this to device copies so
+    that e.g. the Encoder, Decoder, Discriminator and distortion layer hold a
+    single forward/inverse basis on the GPU. Built bases are also written to
+    `cache_dir` as .npz files, so a cold start only has to read them back
+    instead of running the pinv.
+
+    STFT bases are keyed by (n_fft, hop, win, window) and mel bases by
+    (sr, n_fft, n_mels, fmin, fmax); together these cover every parameter the
+    bases depend on.
+    """
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.environ.get("SVD_BASIS_CACHE", DEFAULT_CACHE_DIR)
+        self.cache_dir = cache_dir
+        self._bases = {}
+        self._shared = {}
+        self._lock = threading.RLock()
+
+    def stft_basis(self, filter_length, hop_length, win_length, window):
+        key = ("stft", filter_length, hop_length, win_length, window)
+        return self._get(key, lambda: build_stft_basis(filter_length, hop_length, win_length, window))
+
+    def mel_basis(self, sampling_rate, filter_length, n_mel_channels, mel_fmin, mel_fmax):
+        # the filterbank itself depends on the librosa release
+        key = ("mel", sampling_rate, filter_length, n_mel_channels, float(mel_fmin),
+               None if mel_fmax is None else float(mel_fmax), librosa.__version__)
+        return self._get(key, lambda: build_mel_basis(sampling_rate, filter_length, n_mel_channels, mel_fmin, mel_fmax))
+
+    def share(self, key, name, tensor):
+        """
+        Return the registry's copy of buffer `name` of basis `key` with the
+        device and dtype of `tensor`, registering `tensor` as that copy if
+        there is none yet.
+        """
+        shared_key = (key, name, str(tensor.device), tensor.dtype)
+        with self._lock:
+            return self._shared.setdefault(shared_key, tensor)
+
+    def lookup(self, key, name, tensor):
+        """ Like share, but returns None instead of registering `tensor` """
+        with self._lock:
+            return self._shared.get((key, name, str(tensor.device), tensor.dtype))
+
+    def clear(self):
+        with self._lock:
+            self._bases.clear()
+            self._shared.clear()
+
+    def _get(self, key, build):
+        with self._lock:
+            if key not in self._bases:
+                arrays = self._read(key)
+                if arrays is None:
+                    arrays = build()
+                    self._write(key, arrays)
+                tensors = {name: torch.from_numpy(array) for name, array in arrays.items()}
+                for name, tensor in tensors.items():
+                    self._shared[(key, name, str(tensor.device), tensor.dtype)] = tensor
+                self._bases[key] = tensors
+            return key, self._bases[key]
+
+    def _path(self, key):
+        name = "_".join(str(k) for k in key).replace(os.sep, "-")
+        return os.path.join(self.cache_dir, "v{}_{}.npz".format(CACHE_VERSION, name))
+
+    def _read(self, key):
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as f:
+                return {name: f[name] for name in f.files}
+        except Exception as e:
+            logging.warning("ignoring unreadable basis cache {}: {}".format(path, e))
+            return None
+
+    def _write(self, key, arrays):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".npz.tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logging.warning("could not write basis cache to {}: {}".format(self.cache_dir, e))
+
+
+basis_registry = BasisRegistry()
+
+
+class SharedBasisMixin():
+    """
+    Mixin for nn.Modules whose buffers come from `basis_registry`.
+
+    Subclasses set `_basis_key` (as returned by the registry) and
+    `_basis_names`. After .to()/.cuda()/.half() the buffers are re-pointed at
+    the registry's copy for the new device and dtype, so modules with the same
+    geometry keep sharing memory instead of each holding its own copy.
+    load_state_dict never writes into the shared tensors: a checkpoint whose
+    bases differ (e.g. saved with another librosa) gets private buffers.
+    """
+    _basis_key = None
+    _basis_names = ()
+    # buffers loaded from a checkpoint with different values, no longer shared
+    _private_bases = frozenset()
+
+    def _apply(self, fn, *args, **kwargs):
+        module = super()._apply(fn, *args, **kwargs)
+        if self._basis_key is not None:
+            for name in self._basis_names:
+                if name not in self._private_bases and self._buffers.get(name) is not None:
+                    self._buffers[name] = basis_registry.share(self._basis_key, name, self._buffers[name])
+        return module
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        loaded = []
+        for name in self._basis_names:
+            buffer = self._buffers.get(name)
+            if buffer is not None and prefix + name in state_dict:
+                # nn.Module copies in place: load into a private copy, not the registry's tensor
+                loaded.append(name)
+                self._buffers[name] = buffer.clone()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        for name in loaded:
+            buffer = self._buffers[name]
+            shared = basis_registry.lookup(self._basis_key, name, buffer)
+            if shared is not None and torch.equal(buffer, shared):
+                # same values as the registry's: go back to sharing
+                self._buffers[name] = shared
+                self._private_bases = self._private_bases - {name}
+            else:
+                self._private_bases = self._private_bases | {name}
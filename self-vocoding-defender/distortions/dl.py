@@ -22,7 +22,7 @@ class distortion(nn.Module):
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         self.band_lowpass = julius.LowPassFilter(2000/SAMPLE_RATE).to(device)
         self.band_highpass = julius.HighPassFilter(500/SAMPLE_RATE).to(device)
-        self.stft = fixed_STFT(process_config["mel"]["n_fft"], process_config["mel"]["hop_length"], process_config["mel"]["win_length"]).to(self.device)
+        self.stft = fixed_STFT(process_config["mel"]["n_fft"], process_config["mel"]["hop_length"], process_config["mel"]["win_length"], backend=process_config["mel"].get("stft_backend", "conv")).to(self.device)
     
     def none(self, x):
         return x
@@ -138,10 +138,9 @@ class distortion(nn.Module):
     
     def modify_mel(self, y, ratio=50):
         num_samples = y.shape[2]
-        spect, phase = self.stft.transform(y)
+        spect, phasor = self.stft.transform_phasor(y)
         spect = spect*ratio/100
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(spect.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse_phasor(spect.squeeze(1), phasor, num_samples)
         return y
     
     def crop_mel_front(self, y, ratio=50):
@@ -162,22 +161,20 @@ class distortion(nn.Module):
     
     def crop_mel_wave_front(self, y, ratio=50):
         num_samples = y.shape[2]
-        spect, phase = self.stft.transform(y)
+        spect, phasor = self.stft.transform_phasor(y)
         _, fre_len, time_len = spect.shape
         cut_len = int(fre_len*(ratio/100))
         spect = spect*(torch.cat([torch.zeros(_,cut_len,time_len),torch.ones(_,fre_len-cut_len,time_len)], dim=1).to(self.device))
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(spect.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse_phasor(spect.squeeze(1), phasor, num_samples)
         return y
     
     def crop_mel_wave_back(self, y, ratio=50):
         num_samples = y.shape[2]
-        spect, phase = self.stft.transform(y)
+        spect, phasor = self.stft.transform_phasor(y)
         _, fre_len, time_len = spect.shape
         cut_len = int(fre_len*(ratio/100))
         spect = spect*(torch.cat([torch.ones(_,fre_len-cut_len,time_len),torch.zeros(_,cut_len,time_len)], dim=1).to(self.device))
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(spect.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse_phasor(spect.squeeze(1), phasor, num_samples)
         return y
     
     def crop_mel_position(self, y, ratio=1):
@@ -194,14 +191,13 @@ class distortion(nn.Module):
     def crop_mel_wave_position(self, y, ratio=1):
         num_samples = y.shape[2]
         assert ratio >= 1 and ratio <= 10, "a must be an integer between 1 and 10"
-        spect, phase = self.stft.transform(y)
+        spect, phasor = self.stft.transform_phasor(y)
         _, fre_len, time_len = spect.shape
         # cut_len = int(fre_len*(ratio/100))
         cut_len = int(fre_len*(1/10))
         left, right = (ratio - 1) * cut_len, ratio * cut_len
         spect[:, left:right, :] = 0
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(spect.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse_phasor(spect.squeeze(1), phasor, num_samples)
         return y
     
 
@@ -219,14 +215,13 @@ class distortion(nn.Module):
     def crop_mel_wave_position_5(self, y, ratio=1):
         num_samples = y.shape[2]
         assert ratio >= 1 and ratio <= 20, "a must be an integer between 1 and 20"
-        spect, phase = self.stft.transform(y)
+        spect, phasor = self.stft.transform_phasor(y)
         _, fre_len, time_len = spect.shape
         # cut_len = int(fre_len*(ratio/100))
         cut_len = int(fre_len*(1/20))
         left, right = (ratio - 1) * cut_len, ratio * cut_len
         spect[:, left:right, :] = 0
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(spect.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse_phasor(spect.squeeze(1), phasor, num_samples)
         return y
     
     def crop_mel_position_20(self, y, ratio=1):
@@ -243,14 +238,13 @@ class distortion(nn.Module):
     def crop_mel_wave_position_20(self, y, ratio=1):
         num_samples = y.shape[2]
         assert ratio >= 1 and ratio <= 5, "a must be an integer between 1 and 5"
-        spect, phase = self.stft.transform(y)
+        spect, phasor = self.stft.transform_phasor(y)
         _, fre_len, time_len = spect.shape
         # cut_len = int(fre_len*(ratio/100))
         cut_len = int(fre_len*(1/5))
         left, right = (ratio - 1) * cut_len, ratio * cut_len
         spect[:, left:right, :] = 0
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(spect.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse_phasor(spect.squeeze(1), phasor, num_samples)
         return y
     
     
@@ -256,14 +256,18 @@ class tacotron_mel():
 
 
 #################################################################### tacotron2's mel-frequency-spectrum ####################################################################
+import threading
+import warnings
+from collections import OrderedDict
 import torch
 from scipy.signal import get_window
-from librosa.util import pad_center, tiny
+from librosa.util import tiny
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 import librosa.util as librosa_util
-from librosa.filters import mel as librosa_mel_fn
 import pdb
+from distortions.basis import basis_registry, SharedBasisMixin
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -335,47 +339,239 @@ def window_sumsquare(window, n_frames, hop_length=200, win_length=800,
         x[sample:min(n, sample + n_fft)] += win_sq[:max(0, min(n_fft, n - sample))]
     return x
 
-class STFT(torch.nn.Module):
+
+def inverse_window_envelope(window, n_frames, hop_length=200, win_length=800,
+                            n_fft=800, device=None):
+    """
+    Vectorized replacement for the window_sumsquare -> np.where -> divide
+    sequence used by the inverse STFTs below.
+
+    The sum-square envelope is the overlap-add of the squared window, i.e. a
+    single conv_transpose1d of a ones vector against win_sq, computed directly
+    on `device`. Returned is the multiplicative correction applied after the
+    overlap-add: 1 / envelope where the envelope is above `tiny`, 1 elsewhere,
+    already scaled by the hop ratio n_fft / hop_length.
+
+    RETURNS
+    -------
+    torch.FloatTensor of shape (n_fft + hop_length * (n_frames - 1),)
+    """
+    win_sq = squared_window(window, win_length, n_fft, device)
+
+    window_sum = F.conv_transpose1d(
+        torch.ones(1, 1, n_frames, device=device),
+        win_sq.view(1, 1, -1),
+        stride=hop_length).view(-1)
+
+    return envelope_correction(window_sum, hop_length, n_fft)
+
+
+def squared_window(window, win_length, n_fft, device=None):
+    """squared analysis window, zero-padded to n_fft, as a tensor on `device`"""
+    if win_length is None:
+        win_length = n_fft
+
+    win_sq = get_window(window, win_length, fftbins=True)
+    win_sq = librosa_util.normalize(win_sq, norm=None)**2
+    win_sq = librosa_util.pad_center(win_sq, n_fft)
+    return torch.from_numpy(win_sq.astype(np.float32)).to(device)
+
+
+def envelope_correction(window_sum, hop_length, n_fft):
+    # remove modulation effects only where the envelope is non-negligible
+    eps = tiny(np.float32(1))
+    correction = torch.where(window_sum > eps, 1. / window_sum.clamp(min=eps),
+                             torch.ones_like(window_sum))
+    # scale by hop ratio
+    return correction * (float(n_fft) / hop_length)
+
+
+class WindowEnvelopeCache():
+    """
+    LRU cache of the inverse-STFT normalization envelope.
+
+    Entries are keyed by (window, n_frames, hop_length, win_length, n_fft,
+    device) and hold the output of inverse_window_envelope as a device tensor,
+    so repeated inverses of the same length (every Encoder forward, every
+    Griffin-Lim iteration) skip both the envelope construction and the
+    host-to-device copy.
+    """
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, window, n_frames, hop_length, win_length, n_fft, device):
+        key = (window, n_frames, hop_length, win_length, n_fft, str(device))
+        with self._lock:
+            envelope = self._entries.get(key)
+            if envelope is not None:
+                self._entries.move_to_end(key)
+                return envelope
+
+        envelope = inverse_window_envelope(
+            window, n_frames, hop_length=hop_length, win_length=win_length,
+            n_fft=n_fft, device=device)
+
+        with self._lock:
+            self._entries[key] = envelope
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return envelope
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+window_envelope_cache = WindowEnvelopeCache()
+
+
+STFT_BACKENDS = ('conv', 'fft')
+
+
+def unit_phasor(real_part, imag_part, magnitude, detach=True):
+    """
+    cos/sin of the STFT phase computed as real/|X| and imag/|X| rather than
+    through atan2. Bins with zero magnitude get phase 0 (cos 1, sin 0), as
+    atan2(0, 0) does, and by default the result is detached like the phase
+    returned by transform.
+    """
+    eps = torch.finfo(magnitude.dtype).tiny
+    silent = magnitude.detach() == 0
+    if detach:
+        real_part, imag_part, magnitude = real_part.detach(), imag_part.detach(), magnitude.detach()
+        inv_magnitude = 1. / magnitude.clamp(min=eps)
+    else:
+        # the gradient of 1/|X| overflows for near-silent bins, so floor |X| at 1e-6 there
+        inv_magnitude = torch.rsqrt((real_part**2 + imag_part**2).clamp(min=1e-12))
+    cos_phase = (real_part * inv_magnitude).masked_fill_(silent, 1.)
+    sin_phase = (imag_part * inv_magnitude).masked_fill_(silent, 0.)
+    return cos_phase, sin_phase
+
+
+def fft_forward(input_data, filter_length, hop_length, fft_window):
+    """
+    FFT counterpart of the strided conv1d against forward_basis.
+
+    PARAMS
+    ------
+    input_data: reflect-padded signal of shape (B, T)
+    fft_window: window zero-padded to filter_length
+
+    RETURNS
+    -------
+    real_part, imag_part: torch.FloatTensor of shape (B, filter_length/2 + 1, n_frames)
+    """
+    spec = torch.stft(input_data, filter_length, hop_length=hop_length,
+                      win_length=filter_length, window=fft_window,
+                      center=False, return_complex=True)
+    return spec.real, spec.imag
+
+
+def fft_inverse(real_part, imag_part, filter_length, hop_length, fft_window):
+    """
+    FFT counterpart of the conv_transpose1d against inverse_basis.
+
+    The pinv of the stacked real/imag Fourier basis is exactly irfft (the
+    imaginary parts of the DC and Nyquist bins are ignored), so each frame is
+    irfft'd, windowed, divided by the hop ratio like the pinv basis, and
+    overlap-added with fold. The envelope correction is left to the caller.
+
+    RETURNS
+    -------
+    torch.FloatTensor of shape (B, 1, filter_length + hop_length * (n_frames - 1))
+    """
+    frames = torch.fft.irfft(torch.complex(real_part, imag_part), n=filter_length, dim=1)
+    frames = frames * (fft_window * (float(hop_length) / filter_length)).view(1, -1, 1)
+    n_frames = frames.size(-1)
+    inverse_transform = F.fold(
+        frames,
+        output_size=(1, filter_length + hop_length * (n_frames - 1)),
+        kernel_size=(1, filter_length),
+        stride=(1, hop_length))
+    return inverse_transform.view(frames.size(0), 1, -1)
+
+
+def default_num_samples(stft, n_frames):
+    """
+    Fallback for inverse() calls that omit num_samples: warn, then use the
+    deprecated num_samples attribute if the caller still sets it, else the
+    length left once the filter_length/2 reflect padding is trimmed from both
+    ends, i.e. hop_length * (n_frames - 1).
+    """
+    warnings.warn(
+        "{}.inverse() without num_samples is deprecated; pass the target "
+        "length explicitly".format(type(stft).__name__),
+        DeprecationWarning, stacklevel=3)
+    num_samples = getattr(stft, 'num_samples', None)
+    if num_samples is None:
+        num_samples = stft.hop_length * (n_frames - 1)
+    return num_samples
+
+
+class STFT(SharedBasisMixin, torch.nn.Module):
     """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft"""
     def __init__(self, filter_length=800, hop_length=200, win_length=800,
-                 window='hann'):
+                 window='hann', backend='conv'):
         super(STFT, self).__init__()
         self.filter_length = filter_length
         self.hop_length = hop_length
         self.win_length = win_length
         self.window = window
         self.forward_transform = None
-        scale = self.filter_length / self.hop_length
-        fourier_basis = np.fft.fft(np.eye(self.filter_length))
 
-        cutoff = int((self.filter_length / 2 + 1))
-        fourier_basis = np.vstack([np.real(fourier_basis[:cutoff, :]),
-                                   np.imag(fourier_basis[:cutoff, :])])
+        assert backend in STFT_BACKENDS, "unknown STFT backend: {}".format(backend)
+        self.backend = backend
+        # windowed Fourier bases, shared with every other STFT of the same geometry
+        self._basis_key, basis = basis_registry.stft_basis(filter_length, hop_length, win_length, window)
+        self._basis_names = ('forward_basis', 'inverse_basis', 'fft_window')
+        self.register_buffer('forward_basis', basis['forward_basis']) # register_buffer requires_grad is False
+        self.register_buffer('inverse_basis', basis['inverse_basis'])
+        # only used by the fft backend; kept out of the state_dict so checkpoints are unchanged
+        self.register_buffer('fft_window', basis['fft_window'], persistent=False)
 
-        forward_basis = torch.FloatTensor(fourier_basis[:, None, :])
-        inverse_basis = torch.FloatTensor(
-            np.linalg.pinv(scale * fourier_basis).T[:, None, :])
+    def transform(self, input_data):
+        real_part, imag_part = self._analyze(input_data)
+
+        magnitude = torch.sqrt(real_part**2 + imag_part**2)
+        phase = torch.autograd.Variable(
+            torch.atan2(imag_part.data, real_part.data))
 
-        if window is not None:
-            assert(filter_length >= win_length)
-            # get window and zero center pad it to filter_length
-            fft_window = get_window(window, win_length, fftbins=True)
-            fft_window = pad_center(fft_window, filter_length)
-            fft_window = torch.from_numpy(fft_window).float()
+        return magnitude, phase
 
-            # window the bases
-            forward_basis *= fft_window
-            inverse_basis *= fft_window
+    def transform_phasor(self, input_data):
+        """Like transform, but returns the phase as a (cos, sin) unit phasor instead of an angle"""
+        real_part, imag_part = self._analyze(input_data)
 
-        self.register_buffer('forward_basis', forward_basis.float()) # register_buffer requires_grad is False
-        self.register_buffer('inverse_basis', inverse_basis.float())
+        magnitude = torch.sqrt(real_part**2 + imag_part**2)
+        return magnitude, unit_phasor(real_part, imag_part, magnitude)
 
-    def transform(self, input_data):
+    def inverse(self, magnitude, phase, num_samples=None):
+        if num_samples is None:
+            num_samples = default_num_samples(self, magnitude.size(-1))
+        return self._synthesize(
+            magnitude*torch.cos(phase), magnitude*torch.sin(phase), num_samples)
+
+    def inverse_phasor(self, magnitude, phasor, num_samples=None):
+        if num_samples is None:
+            num_samples = default_num_samples(self, magnitude.size(-1))
+        cos_phase, sin_phase = phasor
+        return self._synthesize(magnitude*cos_phase, magnitude*sin_phase, num_samples)
+
+    def forward(self, input_data):
+        magnitude, phase = self.transform(input_data)
+        reconstruction = self.inverse(magnitude, phase, input_data.size(-1))
+        return reconstruction
+
+    def _analyze(self, input_data):
         num_batches = input_data.size(0)
         num_samples = input_data.size(1)
 
-        self.num_samples = num_samples
-
         # similar to librosa, reflect-pad the input
         input_data = input_data.view(num_batches, 1, num_samples)
         input_data = F.pad(
@@ -384,6 +580,14 @@ class STFT(torch.nn.Module):
             mode='reflect')
         input_data = input_data.squeeze(1)
 
+        return self._analyze_frames(input_data)
+
+    def _analyze_frames(self, input_data):
+        # input_data: already padded signal of shape (B, 1, T)
+        if self.backend == 'fft':
+            return fft_forward(
+                input_data.squeeze(1), self.filter_length, self.hop_length, self.fft_window)
+
         forward_transform = F.conv1d(
             input_data,
             Variable(self.forward_basis, requires_grad=False),
@@ -391,52 +595,56 @@ class STFT(torch.nn.Module):
             padding=0)
 
         cutoff = int((self.filter_length / 2) + 1)
-        real_part = forward_transform[:, :cutoff, :]
-        imag_part = forward_transform[:, cutoff:, :]
+        return forward_transform[:, :cutoff, :], forward_transform[:, cutoff:, :]
 
-        magnitude = torch.sqrt(real_part**2 + imag_part**2)
-        phase = torch.autograd.Variable(
-            torch.atan2(imag_part.data, real_part.data))
+    def _synthesize(self, real_part, imag_part, num_samples):
+        inverse_transform = self._overlap_add(real_part, imag_part)
 
-        return magnitude, phase
+        if self.window is not None:
+            # remove modulation effects and scale by hop ratio
+            inverse_transform = inverse_transform * window_envelope_cache.get(
+                self.window, real_part.size(-1), self.hop_length,
+                self.win_length, self.filter_length, inverse_transform.device)
 
-    def inverse(self, magnitude, phase):
-        recombine_magnitude_phase = torch.cat(
-            [magnitude*torch.cos(phase), magnitude*torch.sin(phase)], dim=1)
+        inverse_transform = inverse_transform[:, :, int(self.filter_length/2):]
+        inverse_transform = inverse_transform[:, :, :num_samples]
 
-        inverse_transform = F.conv_transpose1d(
-            recombine_magnitude_phase,
+        return inverse_transform
+
+    def _overlap_add(self, real_part, imag_part):
+        # raw overlap-add of the frames, before the window envelope correction
+        if self.backend == 'fft':
+            return fft_inverse(
+                real_part, imag_part, self.filter_length, self.hop_length, self.fft_window)
+
+        return F.conv_transpose1d(
+            torch.cat([real_part, imag_part], dim=1),
             Variable(self.inverse_basis, requires_grad=False),
             stride=self.hop_length,
             padding=0)
+    
+    
+def length_mask(lengths, max_len, device=None):
+    """
+    RETURNS
+    -------
+    torch.FloatTensor of shape (B, max_len), 1 for the first lengths[b] samples and 0 after
+    """
+    lengths = torch.as_tensor(lengths, device=device)
+    positions = torch.arange(max_len, device=lengths.device)
+    return (positions[None, :] < lengths[:, None]).float()
 
-        if self.window is not None:
-            window_sum = window_sumsquare(
-                self.window, magnitude.size(-1), hop_length=self.hop_length,
-                win_length=self.win_length, n_fft=self.filter_length,
-                dtype=np.float32)
-            # remove modulation effects
-            approx_nonzero_indices = torch.from_numpy(
-                np.where(window_sum > tiny(window_sum))[0])
-            window_sum = torch.autograd.Variable(
-                torch.from_numpy(window_sum), requires_grad=False)
-            window_sum = window_sum.cuda() if magnitude.is_cuda else window_sum
-            inverse_transform[:, :, approx_nonzero_indices] /= window_sum[approx_nonzero_indices]
-
-            # scale by hop ratio
-            inverse_transform *= float(self.filter_length) / self.hop_length
 
-        inverse_transform = inverse_transform[:, :, int(self.filter_length/2):]
-        inverse_transform = inverse_transform[:, :, :-int(self.filter_length/2):]
+def valid_frames(lengths, hop_length):
+    """
+    Number of STFT frames centred on one of the first lengths[b] samples:
+    frame t is centred on sample t * hop_length, so a length that is a
+    multiple of hop_length does not count the frame centred on the padding
+    right after it.
+    """
+    return (torch.as_tensor(lengths) - 1) // hop_length + 1
 
-        return inverse_transform
 
-    def forward(self, input_data):
-        self.magnitude, self.phase = self.transform(input_data)
-        reconstruction = self.inverse(self.magnitude, self.phase)
-        return reconstruction
-    
-    
 def _mel_to_linear_matrix(sr, n_fft, n_mels, mel_fmin, mel_fmax):
     m = librosa.filters.mel(sr, n_fft, n_mels, mel_fmin, mel_fmax)
     m_t = np.transpose(m)
@@ -445,22 +653,22 @@ def _mel_to_linear_matrix(sr, n_fft, n_mels, mel_fmin, mel_fmax):
     return np.matmul(m_t, np.diag(d))
 
 
-class TacotronSTFT(torch.nn.Module):
+class TacotronSTFT(SharedBasisMixin, torch.nn.Module):
     def __init__(self, filter_length=1024, hop_length=256, win_length=1024,
                  n_mel_channels=80, sampling_rate=22050, mel_fmin=0.0,
-                 mel_fmax=8000.0):
+                 mel_fmax=8000.0, backend='conv'):
         super(TacotronSTFT, self).__init__()
         self.n_mel_channels = n_mel_channels
         self.sampling_rate = sampling_rate
-        self.stft_fn = STFT(filter_length, hop_length, win_length)
-        mel_basis = librosa_mel_fn(
+        self.stft_fn = STFT(filter_length, hop_length, win_length, backend=backend)
+        # mel filterbank and its pinv, shared with every other TacotronSTFT of the same configuration
+        self._basis_key, basis = basis_registry.mel_basis(
             sampling_rate, filter_length, n_mel_channels, mel_fmin, mel_fmax)
-        mel_basis = torch.from_numpy(mel_basis).float()
-        self.register_buffer('mel_basis', mel_basis) # 
+        self._basis_names = ('mel_basis', 'mel_to_linear_basis')
+        self.register_buffer('mel_basis', basis['mel_basis']) # 
         # mel_to_linear_basis = _mel_to_linear_matrix(sampling_rate, filter_length, n_mel_channels, mel_fmin, mel_fmax)
         # mel_to_linear_basis = torch.from_numpy(mel_to_linear_basis).float()
-        mel_to_linear_basis = torch.linalg.pinv(self.mel_basis)
-        self.register_buffer('mel_to_linear_basis', mel_to_linear_basis) # register_buffer requires_grad is False
+        self.register_buffer('mel_to_linear_basis', basis['mel_to_linear_basis']) # register_buffer requires_grad is False
         
 
     def spectral_normalize(self, magnitudes):
@@ -471,57 +679,139 @@ class TacotronSTFT(torch.nn.Module):
         output = dynamic_range_decompression(magnitudes)
         return output
 
-    def mel_spectrogram(self, y):
+    def mel_spectrogram(self, y, lengths=None):
         """Computes mel-spectrograms from a batch of waves
         PARAMS
         ------
         y: Variable(torch.FloatTensor) with shape (B, T) in range [-1, 1]
+        lengths: valid samples of each example for zero-padded batches, or None
 
         RETURNS
         -------
         mel_output: torch.FloatTensor of shape (B, n_mel_channels, T)
         """
         # add by chave luv
-        y = self.wav_norm(y)
-        
-        try:
-            assert(torch.min(y.data) >= -1)
-            assert(torch.max(y.data) <= 1)
-        except Exception as e:
-            print("y after normalization:{},{}".format(torch.min(y.data), torch.max(y.data)))
-            
+        y = self.wav_norm(y, lengths)
+
         magnitudes, phases = self.stft_fn.transform(y)
         # magnitudes = magnitudes.data
         mel_output = torch.matmul(self.mel_basis, magnitudes)
         mel_output = self.spectral_normalize(mel_output)
         return mel_output
     
-    def griffin_lim(self, magnitudes, n_iters=60):
+    def griffin_lim(self, magnitudes, n_iters=60, momentum=0., tol=0., init_phase=None, lengths=None,
+                    grad_iters=0, checkpoint_segments=0):
         """
+        (Fast) Griffin-Lim reconstruction of a batch of mel-spectrograms
+
+        The phase estimates are detached, so by default the gradient w.r.t.
+        magnitudes flows only through the final inverse and the iterations run
+        under no_grad. grad_iters > 0 backpropagates through the phase updates
+        of the last grad_iters iterations as well (truncated backprop through
+        the loop); their intermediates can be recomputed during backward instead
+        of stored by splitting them into checkpoint_segments checkpoints.
+
         PARAMS
         ------
-        magnitudes: spectrogram magnitudes
-        stft_fn: STFT class with transform (STFT) and inverse (ISTFT) methods
+        magnitudes: mel-spectrograms as returned by mel_spectrogram
+        n_iters: maximum number of iterations
+        momentum: 0 for plain Griffin-Lim; Fast Griffin-Lim (Perraudin et al.,
+            2013) otherwise, which typically needs far fewer iterations at 0.99
+        tol: stop once the spectral convergence ||  |STFT(x)| - S || / || S ||
+            of every example drops below tol; 0 runs all n_iters. Checking it
+            synchronizes with the device once per iteration, and it only
+            applies to the iterations before the last grad_iters.
+        init_phase: warm-start phase of the linear spectrogram, either angles
+            or a (cos, sin) phasor as returned by STFT.transform_phasor; random
+            phases, drawn on the device, if None
+        lengths: valid samples of each example; the reconstruction is kept
+            silent past them and normalized over them only
+        grad_iters: number of final iterations to backpropagate through
+        checkpoint_segments: number of checkpoints the grad_iters iterations
+            are split into, 0 to store all their intermediates
         """
         # add by chave luv
         magnitudes = torch.matmul(self.mel_to_linear_basis, self.spectral_de_normalize(magnitudes))
-        
-        angles = np.angle(np.exp(2j * np.pi * np.random.rand(*magnitudes.size())))
-        angles = angles.astype(np.float32)
-        angles = torch.autograd.Variable(torch.from_numpy(angles)).to(device)
-        signal = self.stft_fn.inverse(magnitudes, angles).squeeze(1)
 
-        for i in range(n_iters):
-            _, angles = self.stft_fn.transform(signal)
-            signal = self.stft_fn.inverse(magnitudes, angles).squeeze(1)
-        signal = self.wav_norm(signal)        
+        if init_phase is None:
+            angles = 2 * np.pi * torch.rand(magnitudes.size(), device=magnitudes.device)
+            phasor = (torch.cos(angles), torch.sin(angles))
+        elif isinstance(init_phase, (tuple, list)):
+            phasor = tuple(init_phase)
+        else:
+            phasor = (torch.cos(init_phase), torch.sin(init_phase))
+
+        mask = None
+        if lengths is not None:
+            num_samples = (magnitudes.size(-1) - 1) * self.stft_fn.hop_length
+            mask = length_mask(lengths, num_samples, magnitudes.device)
+
+        beta = momentum / (1 + momentum)
+        grad_iters = min(grad_iters, n_iters) if torch.is_grad_enabled() else 0
+        # (cos, sin, previous real part, previous imag part)
+        state = phasor + (None, None)
+        converged = False
+        with torch.no_grad():
+            state, converged = self._griffin_lim_iterations(
+                magnitudes, state, n_iters - grad_iters, beta, mask, tol)
+
+        if grad_iters > 0 and not converged:
+            if checkpoint_segments > 0:
+                bounds = np.linspace(0, grad_iters, min(checkpoint_segments, grad_iters) + 1).astype(int)
+                for n in np.diff(bounds):
+                    state = checkpoint(
+                        lambda *state, n=n: self._griffin_lim_iterations(
+                            magnitudes, state, n, beta, mask, detach=False)[0],
+                        *state, use_reentrant=False)
+            else:
+                state, _ = self._griffin_lim_iterations(
+                    magnitudes, state, grad_iters, beta, mask, detach=False)
+
+        signal = self.stft_fn.inverse_phasor(
+            magnitudes, state[:2], num_samples=(magnitudes.size(-1) - 1) * self.stft_fn.hop_length).squeeze(1)
+        if mask is not None:
+            signal = signal * mask
+        signal = self.wav_norm(signal, lengths)
         # return signal, magnitudes
         return signal
 
+    def _griffin_lim_iterations(self, magnitudes, state, n_iters, beta, mask, tol=0., detach=True):
+        cos_phase, sin_phase, prev_real, prev_imag = state
+        num_samples = (magnitudes.size(-1) - 1) * self.stft_fn.hop_length
+        for i in range(n_iters):
+            signal = self.stft_fn.inverse_phasor(magnitudes, (cos_phase, sin_phase), num_samples=num_samples).squeeze(1)
+            if mask is not None:
+                signal = signal * mask
+            real_part, imag_part = self.stft_fn._analyze(signal)
+            if detach:
+                real_part, imag_part = real_part.detach(), imag_part.detach()
+
+            if tol > 0:
+                rebuilt = torch.sqrt(real_part**2 + imag_part**2)
+                convergence = torch.norm((rebuilt - magnitudes).flatten(1), dim=1) / \
+                    torch.norm(magnitudes.flatten(1), dim=1).clamp(min=tiny(np.float32(1)))
+                if convergence.max().item() < tol:
+                    return (cos_phase, sin_phase, prev_real, prev_imag), True
+
+            if beta > 0 and prev_real is not None:
+                accel_real = real_part - beta * prev_real
+                accel_imag = imag_part - beta * prev_imag
+            else:
+                accel_real, accel_imag = real_part, imag_part
+            prev_real, prev_imag = real_part, imag_part
+
+            cos_phase, sin_phase = unit_phasor(
+                accel_real, accel_imag, torch.sqrt(accel_real**2 + accel_imag**2), detach=detach)
+        return (cos_phase, sin_phase, prev_real, prev_imag), False
+
     
-    def wav_norm(self, y):
-        max_value = torch.max(torch.abs(y))
-        y = y/max_value
+    def wav_norm(self, y, lengths=None):
+        """peak-normalize each example of y (B, T) over its first lengths[b] samples"""
+        y_abs = torch.abs(y)
+        if lengths is not None:
+            y_abs = y_abs * length_mask(lengths, y.size(-1), y.device)
+        max_value = torch.amax(y_abs, dim=-1, keepdim=True)
+        y = y/max_value.clamp(min=tiny(np.float32(1)))
         return y
     # def wav_norm(self, y):
     #     max_value = torch.max(torch.abs(y))
@@ -530,56 +820,91 @@ class TacotronSTFT(torch.nn.Module):
     #     return y
 
 
-class fixed_STFT(torch.nn.Module):
+class fixed_STFT(SharedBasisMixin, torch.nn.Module):
     """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft"""
     def __init__(self, filter_length=800, hop_length=200, win_length=800,
-                 window='hann'):
+                 window='hann', backend='conv'):
         super(fixed_STFT, self).__init__()
         self.filter_length = filter_length
         self.hop_length = hop_length
         self.win_length = win_length
         self.window = window
         self.forward_transform = None
-        scale = self.filter_length / self.hop_length
-        fourier_basis = np.fft.fft(np.eye(self.filter_length))
 
-        cutoff = int((self.filter_length / 2 + 1))
-        fourier_basis = np.vstack([np.real(fourier_basis[:cutoff, :]),
-                                   np.imag(fourier_basis[:cutoff, :])])
+        assert backend in STFT_BACKENDS, "unknown STFT backend: {}".format(backend)
+        self.backend = backend
+        # windowed Fourier bases, shared with every other STFT of the same geometry
+        self._basis_key, basis = basis_registry.stft_basis(filter_length, hop_length, win_length, window)
+        self._basis_names = ('forward_basis', 'inverse_basis', 'fft_window')
+        self.register_buffer('forward_basis', basis['forward_basis']) # register_buffer requires_grad is False
+        self.register_buffer('inverse_basis', basis['inverse_basis'])
+        # only used by the fft backend; kept out of the state_dict so checkpoints are unchanged
+        self.register_buffer('fft_window', basis['fft_window'], persistent=False)
+
+    def transform(self, input_data):
+        real_part, imag_part = self._analyze(input_data)
+
+        magnitude = torch.sqrt(real_part**2 + imag_part**2)
+        phase = torch.autograd.Variable(
+            torch.atan2(imag_part.data, real_part.data))
 
-        forward_basis = torch.FloatTensor(fourier_basis[:, None, :])
-        inverse_basis = torch.FloatTensor(
-            np.linalg.pinv(scale * fourier_basis).T[:, None, :])
+        return magnitude, phase
 
-        if window is not None:
-            assert(filter_length >= win_length)
-            # get window and zero center pad it to filter_length
-            fft_window = get_window(window, win_length, fftbins=True)
-            fft_window = pad_center(fft_window, filter_length)
-            fft_window = torch.from_numpy(fft_window).float()
+    def transform_phasor(self, input_data):
+        """
+        Like transform, but returns the phase as a unit phasor (cos, sin)
+        computed from the real/imaginary parts, skipping the atan2 here and the
+        cos/sin in inverse_phasor. Use it when the phase is only carried over
+        to a resynthesis.
+        """
+        real_part, imag_part = self._analyze(input_data)
 
-            # window the bases
-            forward_basis *= fft_window
-            inverse_basis *= fft_window
+        magnitude = torch.sqrt(real_part**2 + imag_part**2)
+        return magnitude, unit_phasor(real_part, imag_part, magnitude)
 
-        self.register_buffer('forward_basis', forward_basis.float()) # register_buffer requires_grad is False
-        self.register_buffer('inverse_basis', inverse_basis.float())
+    def inverse(self, magnitude, phase, num_samples=None):
+        """
+        PARAMS
+        ------
+        num_samples: length of the reconstructed signal, normally the length of
+            the input to transform. Omitting it is deprecated: it warns and
+            falls back to the num_samples attribute, then to
+            hop_length * (n_frames - 1), like STFT.inverse.
+        """
+        if num_samples is None:
+            num_samples = default_num_samples(self, magnitude.size(-1))
 
-    def transform(self, input_data):
-        # num_batches = input_data.size(0)
-        # num_samples = input_data.size(1)
+        return self._synthesize(
+            magnitude*torch.cos(phase), magnitude*torch.sin(phase), num_samples)
 
-        # self.num_samples = num_samples
+    def inverse_phasor(self, magnitude, phasor, num_samples=None):
+        """Inverse of transform_phasor: phasor is the (cos, sin) pair it returned"""
+        if num_samples is None:
+            num_samples = default_num_samples(self, magnitude.size(-1))
+        cos_phase, sin_phase = phasor
+        return self._synthesize(magnitude*cos_phase, magnitude*sin_phase, num_samples)
 
-        # # similar to librosa, reflect-pad the input
-        # input_data = input_data.view(num_batches, 1, num_samples)
-        
+    def forward(self, input_data):
+        magnitude, phase = self.transform(input_data)
+        reconstruction = self.inverse(magnitude, phase, input_data.size(-1))
+        return reconstruction
+
+    def _analyze(self, input_data):
+        # similar to librosa, reflect-pad the input
         input_data = F.pad(
             input_data.unsqueeze(1),
             (int(self.filter_length / 2), int(self.filter_length / 2), 0, 0),
             mode='reflect')
         input_data = input_data.squeeze(1)
 
+        return self._analyze_frames(input_data)
+
+    def _analyze_frames(self, input_data):
+        # input_data: already padded signal of shape (B, 1, T)
+        if self.backend == 'fft':
+            return fft_forward(
+                input_data.squeeze(1), self.filter_length, self.hop_length, self.fft_window)
+
         forward_transform = F.conv1d(
             input_data,
             Variable(self.forward_basis, requires_grad=False),
@@ -587,49 +912,206 @@ class fixed_STFT(torch.nn.Module):
             padding=0)
 
         cutoff = int((self.filter_length / 2) + 1)
-        real_part = forward_transform[:, :cutoff, :]
-        imag_part = forward_transform[:, cutoff:, :]
+        return forward_transform[:, :cutoff, :], forward_transform[:, cutoff:, :]
 
-        magnitude = torch.sqrt(real_part**2 + imag_part**2)
-        phase = torch.autograd.Variable(
-            torch.atan2(imag_part.data, real_part.data))
+    def _synthesize(self, real_part, imag_part, num_samples):
+        inverse_transform = self._overlap_add(real_part, imag_part)
 
-        return magnitude, phase
+        if self.window is not None:
+            # remove modulation effects and scale by hop ratio
+            inverse_transform = inverse_transform * window_envelope_cache.get(
+                self.window, real_part.size(-1), self.hop_length,
+                self.win_length, self.filter_length, inverse_transform.device)
 
-    def inverse(self, magnitude, phase):
-        recombine_magnitude_phase = torch.cat(
-            [magnitude*torch.cos(phase), magnitude*torch.sin(phase)], dim=1)
+        inverse_transform = inverse_transform[:, :, int(self.filter_length/2):]
+        inverse_transform = inverse_transform[:, :, :num_samples]
+
+        return inverse_transform
+
+    def _overlap_add(self, real_part, imag_part):
+        # raw overlap-add of the frames, before the window envelope correction
+        if self.backend == 'fft':
+            return fft_inverse(
+                real_part, imag_part, self.filter_length, self.hop_length, self.fft_window)
 
-        inverse_transform = F.conv_transpose1d(
-            recombine_magnitude_phase,
+        return F.conv_transpose1d(
+            torch.cat([real_part, imag_part], dim=1),
             Variable(self.inverse_basis, requires_grad=False),
             stride=self.hop_length,
             padding=0)
+    
 
-        if self.window is not None:
-            window_sum = window_sumsquare(
-                self.window, magnitude.size(-1), hop_length=self.hop_length,
-                win_length=self.win_length, n_fft=self.filter_length,
-                dtype=np.float32)
-            # remove modulation effects
-            approx_nonzero_indices = torch.from_numpy(
-                np.where(window_sum > tiny(window_sum))[0])
-            window_sum = torch.autograd.Variable(
-                torch.from_numpy(window_sum), requires_grad=False)
-            window_sum = window_sum.cuda() if magnitude.is_cuda else window_sum
-            inverse_transform[:, :, approx_nonzero_indices] /= window_sum[approx_nonzero_indices]
-
-            # scale by hop ratio
-            inverse_transform *= float(self.filter_length) / self.hop_length
+class StreamingSTFT():
+    """
+    Block-wise STFT/ISTFT with the geometry, bases and backend of `stft` (an
+    STFT or fixed_STFT), for signals too long to transform in one piece.
+
+    transform() takes PCM blocks of any size, shape (B, n) or (B, 1, n), and
+    returns the magnitude/phase frames completed by that block; the last
+    n_fft - hop samples are carried over to the next call. The start of the
+    stream is reflect-padded like the batch transform, and flush() pads the
+    end and returns the remaining frames.
+
+    inverse() takes frames and returns the samples no later frame can
+    contribute to, keeping the overlap-add tail and its window envelope;
+    finish() returns the tail. Analysis and synthesis have separate state, so
+    a stream can be analysed, modified and resynthesized block by block:
+
+        stream = StreamingSTFT(stft)
+        for block in blocks:
+            magnitude, phase = stream.transform(block)
+            out.append(stream.inverse(magnitude * gain, phase))
+        magnitude, phase = stream.flush()
+        out.append(stream.inverse(magnitude * gain, phase))
+        out.append(stream.finish(num_samples))
+
+    Concatenated, the frames and samples equal those of the batch
+    transform/inverse up to float rounding. Call reset() between streams.
+    """
+    def __init__(self, stft):
+        self.stft = stft
+        self.filter_length = stft.filter_length
+        self.hop_length = stft.hop_length
+        self.pad = int(stft.filter_length / 2)
+        self._win_sq = None
+        self.reset()
+
+    def reset(self):
+        # analysis
+        self._pending = None    # samples not yet covered by a complete frame
+        self._last = None       # last pad + 1 input samples, for the end reflection
+        self._started = False   # front reflection applied
+        # synthesis
+        self._tail = None       # overlap-add tail, shape (B, 1, n_fft - hop)
+        self._tail_sum = None   # window envelope of the tail
+        self._to_trim = self.pad
+        self._emitted = 0
+
+    def transform(self, block):
+        real_part, imag_part = self._analyze(block)
+        magnitude = torch.sqrt(real_part**2 + imag_part**2)
+        phase = torch.atan2(imag_part.data, real_part.data)
+        return magnitude, phase
 
-        inverse_transform = inverse_transform[:, :, int(self.filter_length/2):]
-        # inverse_transform = inverse_transform[:, :, :-int(self.filter_length/2):]
-        inverse_transform = inverse_transform[:, :, :self.num_samples]
+    def transform_phasor(self, block):
+        real_part, imag_part = self._analyze(block)
+        magnitude = torch.sqrt(real_part**2 + imag_part**2)
+        return magnitude, unit_phasor(real_part, imag_part, magnitude)
 
-        return inverse_transform
+    def flush(self):
+        """frames of the reflect-padded end of the stream; ends the analysis side"""
+        real_part, imag_part = self._analyze(None, final=True)
+        magnitude = torch.sqrt(real_part**2 + imag_part**2)
+        phase = torch.atan2(imag_part.data, real_part.data)
+        return magnitude, phase
 
-    def forward(self, input_data):
-        self.magnitude, self.phase = self.transform(input_data)
-        reconstruction = self.inverse(self.magnitude, self.phase)
-        return reconstruction
-    
\ No newline at end of file
+    def flush_phasor(self):
+        real_part, imag_part = self._analyze(None, final=True)
+        magnitude = torch.sqrt(real_part**2 + imag_part**2)
+        return magnitude, unit_phasor(real_part, imag_part, magnitude)
+
+    def inverse(self, magnitude, phase):
+        return self._synthesize(magnitude*torch.cos(phase), magnitude*torch.sin(phase))
+
+    def inverse_phasor(self, magnitude, phasor):
+        cos_phase, sin_phase = phasor
+        return self._synthesize(magnitude*cos_phase, magnitude*sin_phase)
+
+    def finish(self, num_samples=None):
+        """
+        Remaining samples of the synthesis side.
+
+        PARAMS
+        ------
+        num_samples: total length of the reconstructed stream, normally the
+            number of samples fed to transform. If None, the last n_fft/2
+            samples are dropped like STFT.inverse does.
+        """
+        if self._tail is None:
+            return None
+        out = self._normalize(self._tail, self._tail_sum)
+        out = out[:, :, self._to_trim:]
+        if num_samples is None:
+            out = out[:, :, :max(out.size(-1) - self.pad, 0)]
+        else:
+            out = out[:, :, :max(num_samples - self._emitted, 0)]
+        self._emitted += out.size(-1)
+        self._tail = self._tail_sum = None
+        return out
+
+    def _analyze(self, block, final=False):
+        pending = self._pending
+        if block is not None:
+            block = block.reshape(block.size(0), -1)
+            pending = block if pending is None else torch.cat([pending, block], dim=1)
+            last = block if self._last is None else torch.cat([self._last, block], dim=1)
+            self._last = last[:, -(self.pad + 1):]
+        if pending is None:
+            raise ValueError("StreamingSTFT: no samples to analyze")
+
+        if not self._started and (final or pending.size(1) > self.pad):
+            # similar to librosa, reflect-pad the input
+            pending = F.pad(pending.unsqueeze(1), (self.pad, 0), mode='reflect').squeeze(1)
+            self._started = True
+        if final:
+            pending = torch.cat([pending, self._last[:, :-1].flip(1)], dim=1)
+
+        n_frames = 0
+        if self._started and pending.size(1) >= self.filter_length:
+            n_frames = (pending.size(1) - self.filter_length) // self.hop_length + 1
+        if n_frames == 0:
+            self._pending = pending
+            empty = pending.new_zeros(pending.size(0), self.pad + 1, 0)
+            return empty, empty
+
+        used = (n_frames - 1) * self.hop_length + self.filter_length
+        real_part, imag_part = self.stft._analyze_frames(pending[:, :used].unsqueeze(1))
+        self._pending = pending[:, n_frames * self.hop_length:]
+        if final:
+            self._pending = self._last = None
+            self._started = False
+        return real_part, imag_part
+
+    def _synthesize(self, real_part, imag_part):
+        n_frames = real_part.size(-1)
+        if n_frames == 0:
+            return real_part.new_zeros(real_part.size(0), 1, 0)
+
+        inverse_transform = self.stft._overlap_add(real_part, imag_part)
+        window_sum = None
+        if self.stft.window is not None:
+            if self._win_sq is None or self._win_sq.device != inverse_transform.device:
+                self._win_sq = squared_window(self.stft.window, self.stft.win_length,
+                                              self.filter_length, inverse_transform.device)
+            window_sum = F.conv_transpose1d(
+                torch.ones(1, 1, n_frames, device=inverse_transform.device),
+                self._win_sq.view(1, 1, -1),
+                stride=self.hop_length).view(-1)
+
+        if self._tail is not None:
+            overlap = self._tail.size(-1)
+            inverse_transform = torch.cat(
+                [inverse_transform[:, :, :overlap] + self._tail, inverse_transform[:, :, overlap:]], dim=-1)
+            if window_sum is not None:
+                window_sum = torch.cat([window_sum[:overlap] + self._tail_sum, window_sum[overlap:]])
+
+        # samples before the start of the next frame are final
+        ready = n_frames * self.hop_length
+        out, self._tail = inverse_transform[:, :, :ready], inverse_transform[:, :, ready:]
+        if window_sum is not None:
+            out_sum, self._tail_sum = window_sum[:ready], window_sum[ready:]
+        else:
+            out_sum = None
+        out = self._normalize(out, out_sum)
+
+        trim = min(self._to_trim, out.size(-1))
+        out = out[:, :, trim:]
+        self._to_trim -= trim
+        self._emitted += out.size(-1)
+        return out
+
+    def _normalize(self, inverse_transform, window_sum):
+        if window_sum is None:
+            return inverse_transform
+        # remove modulation effects and scale by hop ratio
+        return inverse_transform * envelope_correction(window_sum, self.hop_length, self.filter_length)
@@ -1,49 +1,33 @@
 import torch
 import torch.nn.functional as F
-import numpy as np
 from torch.autograd import Variable
-from scipy.signal import get_window
-from librosa.util import pad_center, tiny
 # import sys
 # sys.path.append('../distortions')
 # print(sys.path)
-from distortions.frequency import window_sumsquare
+from distortions.basis import basis_registry, SharedBasisMixin
+from distortions.frequency import window_envelope_cache, STFT_BACKENDS, fft_forward, fft_inverse, default_num_samples
 
 
-class STFT(torch.nn.Module):
+class STFT(SharedBasisMixin, torch.nn.Module):
     """adapted from Prem Seetharaman's https://github.com/pseeth/pytorch-stft"""
     def __init__(self, filter_length=800, hop_length=200, win_length=800,
-                 window='hann'):
+                 window='hann', backend='conv'):
         super(STFT, self).__init__()
         self.filter_length = filter_length
         self.hop_length = hop_length
         self.win_length = win_length
         self.window = window
         self.forward_transform = None
-        scale = self.filter_length / self.hop_length
-        fourier_basis = np.fft.fft(np.eye(self.filter_length))
 
-        cutoff = int((self.filter_length / 2 + 1))
-        fourier_basis = np.vstack([np.real(fourier_basis[:cutoff, :]),
-                                   np.imag(fourier_basis[:cutoff, :])])
-
-        forward_basis = torch.FloatTensor(fourier_basis[:, None, :])
-        inverse_basis = torch.FloatTensor(
-            np.linalg.pinv(scale * fourier_basis).T[:, None, :])
-
-        if window is not None:
-            assert(filter_length >= win_length)
-            # get window and zero center pad it to filter_length
-            fft_window = get_window(window, win_length, fftbins=True)
-            fft_window = pad_center(fft_window, filter_length)
-            fft_window = torch.from_numpy(fft_window).float()
-
-            # window the bases
-            forward_basis *= fft_window
-            inverse_basis *= fft_window
-
-        self.register_buffer('forward_basis', forward_basis.float()) # register_buffer requires_grad is False
-        self.register_buffer('inverse_basis', inverse_basis.float())
+        assert backend in STFT_BACKENDS, "unknown STFT backend: {}".format(backend)
+        self.backend = backend
+        # windowed Fourier bases, shared with every other STFT of the same geometry
+        self._basis_key, basis = basis_registry.stft_basis(filter_length, hop_length, win_length, window)
+        self._basis_names = ('forward_basis', 'inverse_basis', 'fft_window')
+        self.register_buffer('forward_basis', basis['forward_basis']) # register_buffer requires_grad is False
+        self.register_buffer('inverse_basis', basis['inverse_basis'])
+        # only used by the fft backend; kept out of the state_dict so checkpoints are unchanged
+        self.register_buffer('fft_window', basis['fft_window'], persistent=False)
 
     def transform(self, input_data):
 
@@ -56,15 +40,19 @@ class STFT(torch.nn.Module):
             mode='reflect')
         input_data = input_data.squeeze(1)
 
-        forward_transform = F.conv1d(
-            input_data,
-            Variable(self.forward_basis, requires_grad=False),
-            stride=self.hop_length,
-            padding=0)
+        if self.backend == 'fft':
+            real_part, imag_part = fft_forward(
+                input_data.squeeze(1), self.filter_length, self.hop_length, self.fft_window)
+        else:
+            forward_transform = F.conv1d(
+                input_data,
+                Variable(self.forward_basis, requires_grad=False),
+                stride=self.hop_length,
+                padding=0)
 
-        cutoff = int((self.filter_length / 2) + 1)
-        real_part = forward_transform[:, :cutoff, :]
-        imag_part = forward_transform[:, cutoff:, :]
+            cutoff = int((self.filter_length / 2) + 1)
+            real_part = forward_transform[:, :cutoff, :]
+            imag_part = forward_transform[:, cutoff:, :]
 
         magnitude = torch.sqrt(real_part**2 + imag_part**2)
         phase = torch.autograd.Variable(
@@ -72,58 +60,64 @@ class STFT(torch.nn.Module):
 
         return magnitude, phase
 
-    def inverse(self, magnitude, phase):
-        recombine_magnitude_phase = torch.cat(
-            [magnitude*torch.cos(phase), magnitude*torch.sin(phase)], dim=1)
-
-        inverse_transform = F.conv_transpose1d(
-            recombine_magnitude_phase,
-            Variable(self.inverse_basis, requires_grad=False),
-            stride=self.hop_length,
-            padding=0)
+    def inverse(self, magnitude, phase, num_samples=None):
+        """
+        PARAMS
+        ------
+        num_samples: length of the reconstructed signal, normally the length of
+            the input to transform. Omitting it is deprecated: it warns and
+            falls back to the num_samples attribute, then to
+            hop_length * (n_frames - 1), like STFT.inverse.
+        """
+        if num_samples is None:
+            num_samples = default_num_samples(self, magnitude.size(-1))
+
+        if self.backend == 'fft':
+            inverse_transform = fft_inverse(
+                magnitude*torch.cos(phase), magnitude*torch.sin(phase),
+                self.filter_length, self.hop_length, self.fft_window)
+        else:
+            recombine_magnitude_phase = torch.cat(
+                [magnitude*torch.cos(phase), magnitude*torch.sin(phase)], dim=1)
+
+            inverse_transform = F.conv_transpose1d(
+                recombine_magnitude_phase,
+                Variable(self.inverse_basis, requires_grad=False),
+                stride=self.hop_length,
+                padding=0)
 
         if self.window is not None:
-            window_sum = window_sumsquare(
-                self.window, magnitude.size(-1), hop_length=self.hop_length,
-                win_length=self.win_length, n_fft=self.filter_length,
-                dtype=np.float32)
-            # remove modulation effects
-            approx_nonzero_indices = torch.from_numpy(
-                np.where(window_sum > tiny(window_sum))[0])
-            window_sum = torch.autograd.Variable(
-                torch.from_numpy(window_sum), requires_grad=False)
-            window_sum = window_sum.cuda() if magnitude.is_cuda else window_sum
-            inverse_transform[:, :, approx_nonzero_indices] /= window_sum[approx_nonzero_indices]
-
-            # scale by hop ratio
-            inverse_transform *= float(self.filter_length) / self.hop_length
+            # remove modulation effects and scale by hop ratio
+            inverse_transform = inverse_transform * window_envelope_cache.get(
+                self.window, magnitude.size(-1), self.hop_length,
+                self.win_length, self.filter_length, inverse_transform.device)
 
         inverse_transform = inverse_transform[:, :, int(self.filter_length/2):]
         # inverse_transform = inverse_transform[:, :, :-int(self.filter_length/2):]
-        inverse_transform = inverse_transform[:, :, :self.num_samples]
+        inverse_transform = inverse_transform[:, :, :num_samples]
 
         return inverse_transform
 
     def forward(self, input_data):
-        self.magnitude, self.phase = self.transform(input_data)
-        reconstruction = self.inverse(self.magnitude, self.phase)
+        magnitude, phase = self.transform(input_data)
+        reconstruction = self.inverse(magnitude, phase, input_data.size(-1))
         return reconstruction
 
 
 
-from distortions.frequency import librosa_mel_fn, dynamic_range_compression, dynamic_range_decompression
-class TacotronSTFT(torch.nn.Module):
+from distortions.frequency import dynamic_range_compression, dynamic_range_decompression
+class TacotronSTFT(SharedBasisMixin, torch.nn.Module):
     def __init__(self, filter_length=1024, hop_length=256, win_length=1024,
                  n_mel_channels=80, sampling_rate=22050, mel_fmin=0.0,
-                 mel_fmax=8000.0):
+                 mel_fmax=8000.0, backend='conv'):
         super(TacotronSTFT, self).__init__()
         self.n_mel_channels = n_mel_channels
         self.sampling_rate = sampling_rate
-        self.stft_fn = STFT(filter_length, hop_length, win_length)
-        mel_basis = librosa_mel_fn(
+        self.stft_fn = STFT(filter_length, hop_length, win_length, backend=backend)
+        self._basis_key, basis = basis_registry.mel_basis(
             sampling_rate, filter_length, n_mel_channels, mel_fmin, mel_fmax)
-        mel_basis = torch.from_numpy(mel_basis).float()
-        self.register_buffer('mel_basis', mel_basis)
+        self._basis_names = ('mel_basis',)
+        self.register_buffer('mel_basis', basis['mel_basis'])
 
     def spectral_normalize(self, magnitudes):
         output = dynamic_range_compression(magnitudes)
@@ -1,7 +1,9 @@
 from .models import Generator
+from .chunked import ChunkedGenerator
+from .fast import FastGenerator, optimize_generator
 
 
 class AttrDict(dict):
     def __init__(self, *args, **kwargs):
         super(AttrDict, self).__init__(*args, **kwargs)
-        self.__dict__ = self
\ No newline at end of file
+        self.__dict__ = self
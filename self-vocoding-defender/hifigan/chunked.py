@@ -0,0 +1,101 @@
+import math
+import torch
+
+
+def receptive_field(h):
+    """
+    Half-width of the Generator's receptive field, in mel frames: an output
+    sample only depends on the input frames within this distance of the frame
+    it belongs to. Computed from the layer geometry in config h.
+    """
+    frames = 3  # conv_pre, kernel 7
+    rate = 1
+    for u, k in zip(h.upsample_rates, h.upsample_kernel_sizes):
+        # transposed conv: every output sample sees at most ceil(k / u) inputs
+        frames += math.ceil(k / u) / rate
+        rate *= u
+        resblock = max(sum((kernel - 1) * d // 2 + (kernel - 1) // 2 for d in dilation)
+                       for kernel, dilation in zip(h.resblock_kernel_sizes, h.resblock_dilation_sizes))
+        frames += resblock / rate
+    frames += 3 / rate  # conv_post, kernel 7
+    return int(math.ceil(frames))
+
+
+class ChunkedGenerator(torch.nn.Module):
+    """
+    Chunked inference around hifigan.Generator for long inputs.
+
+    The mel is cut into chunks of `chunk_frames` frames. Each chunk is vocoded
+    together with `context_frames` frames of its neighbours on both sides, and
+    the context is trimmed off again; consecutive outputs overlap by
+    `crossfade` samples and are stitched with linear fades. With the default
+    context (the receptive field) every kept sample sees exactly the input the
+    one-shot Generator gives it, so the result matches the one-shot output up
+    to float rounding, while the activations only ever cover
+    `batch_size` windows of chunk_frames + 2 * context_frames frames.
+    """
+    def __init__(self, generator, chunk_frames=256, context_frames=None, crossfade=None, batch_size=1, h=None):
+        super(ChunkedGenerator, self).__init__()
+        self.generator = generator
+        # the config; pass it for generators that do not carry it (e.g. scripted ones)
+        h = generator.h if h is None else h
+        self.hop_length = int(math.prod(h.upsample_rates))
+        self.chunk_frames = chunk_frames
+        self.context_frames = receptive_field(h) if context_frames is None else context_frames
+        # the fades live inside the context, where both neighbours are valid
+        max_crossfade = min(2 * self.context_frames, chunk_frames) * self.hop_length
+        self.crossfade = min(self.hop_length if crossfade is None else crossfade, max_crossfade)
+        self.batch_size = batch_size
+
+    def remove_weight_norm(self):
+        self.generator.remove_weight_norm()
+
+    def forward(self, x):
+        """
+        PARAMS
+        ------
+        x: mel-spectrogram of shape (B, n_mel_channels, N)
+
+        RETURNS
+        -------
+        waveform of shape (B, 1, N * hop_length), as returned by the Generator
+        """
+        n_frames = x.shape[2]
+        if n_frames <= self.chunk_frames:
+            return self.generator(x)
+        hop, ctx, half = self.hop_length, self.context_frames, self.crossfade // 2
+
+        # (start, end) of the frames each window vocodes and of the samples it keeps
+        starts = list(range(0, n_frames, self.chunk_frames))
+        if (n_frames - starts[-1]) * hop < self.crossfade:
+            # too short to fade into, the previous chunk takes it
+            starts.pop()
+        windows = []
+        for i, start in enumerate(starts):
+            end = starts[i + 1] if i + 1 < len(starts) else n_frames
+            keep_start = 0 if start == 0 else start * hop - half
+            keep_end = n_frames * hop if end == n_frames else end * hop + (self.crossfade - half)
+            windows.append((max(start - ctx, 0), min(end + ctx, n_frames), keep_start, keep_end))
+
+        ramp = (torch.arange(self.crossfade, device=x.device, dtype=x.dtype) + 0.5) / max(self.crossfade, 1)
+        out = x.new_zeros(x.shape[0], 1, n_frames * hop)
+        # windows of equal length (all but the edge ones) are vocoded batch_size at a time
+        by_length = {}
+        for window in windows:
+            by_length.setdefault(window[1] - window[0], []).append(window)
+        for group in by_length.values():
+            for i in range(0, len(group), self.batch_size):
+                batch = group[i:i + self.batch_size]
+                audio = self.generator(torch.cat([x[..., w[0]:w[1]] for w in batch], dim=0))
+                for j, (w_start, _, keep_start, keep_end) in enumerate(batch):
+                    offset = keep_start - w_start * hop
+                    piece = audio[j * x.shape[0]:(j + 1) * x.shape[0], :, offset:offset + keep_end - keep_start]
+                    if self.crossfade > 0:
+                        fade = torch.ones(piece.shape[-1], device=x.device, dtype=x.dtype)
+                        if keep_start > 0:
+                            fade[:self.crossfade] = ramp
+                        if keep_end < n_frames * hop:
+                            fade[-self.crossfade:] = fade[-self.crossfade:] * ramp.flip(0)
+                        piece = piece * fade
+                    out[..., keep_start:keep_end] += piece
+        return out
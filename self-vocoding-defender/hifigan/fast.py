@@ -0,0 +1,156 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn import Conv1d
+from .models import Generator, ResBlock, LRELU_SLOPE
+
+
+class FusedResBlocks(nn.Module):
+    """
+    The num_kernels parallel ResBlocks of one upsample stage as a single
+    stack of grouped convolutions.
+
+    Branch b lives in channel group b of a (B, num_kernels * C, T) tensor.
+    Step j of all branches is one grouped Conv1d whose kernels are zero-padded
+    to the largest kernel size; odd kernels padded on both sides keep their
+    taps where they were, so the result is that of the separate ResBlocks.
+    Needs the same dilations in every branch (true for all HiFi-GAN configs).
+    """
+    def __init__(self, resblocks):
+        super(FusedResBlocks, self).__init__()
+        self.num_kernels = len(resblocks)
+        self.slope = LRELU_SLOPE
+        self.channels = resblocks[0].convs1[0].in_channels
+        kernel_size = max(block.convs1[0].kernel_size[0] for block in resblocks)
+        self.convs1 = nn.ModuleList([self._fuse([block.convs1[j] for block in resblocks], kernel_size)
+                                     for j in range(len(resblocks[0].convs1))])
+        self.convs2 = nn.ModuleList([self._fuse([block.convs2[j] for block in resblocks], kernel_size)
+                                     for j in range(len(resblocks[0].convs2))])
+
+    @staticmethod
+    def _fuse(convs, kernel_size):
+        dilation = convs[0].dilation[0]
+        assert all(conv.dilation[0] == dilation for conv in convs), "branches with different dilations"
+        channels = convs[0].in_channels
+        fused = Conv1d(channels * len(convs), channels * len(convs), kernel_size, 1, dilation=dilation,
+                       padding=(kernel_size - 1) * dilation // 2, groups=len(convs))
+        weight = torch.zeros_like(fused.weight)
+        for b, conv in enumerate(convs):
+            shift = (kernel_size - conv.kernel_size[0]) // 2
+            weight[b * channels:(b + 1) * channels, :, shift:shift + conv.kernel_size[0]] = conv.weight.detach()
+        fused.weight.data.copy_(weight)
+        fused.bias.data.copy_(torch.cat([conv.bias.detach() for conv in convs]))
+        return fused
+
+    def forward(self, x):
+        xs = x.repeat(1, self.num_kernels, 1)
+        for c1, c2 in zip(self.convs1, self.convs2):
+            xt = F.leaky_relu(xs, self.slope)
+            xt = c1(xt)
+            xt = F.leaky_relu(xt, self.slope)
+            xt = c2(xt)
+            xs = xt + xs
+        return xs.view(x.shape[0], self.num_kernels, self.channels, -1).mean(1)
+
+
+class SequentialResBlocks(nn.Module):
+    """ the parallel ResBlocks of one upsample stage, run one after the other as in Generator """
+    def __init__(self, resblocks):
+        super(SequentialResBlocks, self).__init__()
+        self.num_kernels = len(resblocks)
+        self.slope = LRELU_SLOPE
+        self.convs1 = nn.ModuleList([conv for block in resblocks for conv in block.convs1])
+        self.convs2 = nn.ModuleList([conv for block in resblocks for conv in block.convs2])
+
+    def forward(self, x):
+        xs = torch.zeros_like(x)
+        # convs1/convs2 hold the steps of all branches back to back
+        steps = len(self.convs1) // self.num_kernels
+        # the first activation is the same in every branch
+        x_act = F.leaky_relu(x, self.slope)
+        branch = x
+        for i, (c1, c2) in enumerate(zip(self.convs1, self.convs2)):
+            if i % steps == 0:
+                branch = x
+                xt = x_act
+            else:
+                xt = F.leaky_relu(branch, self.slope)
+            xt = c1(xt)
+            xt = F.leaky_relu(xt, self.slope)
+            xt = c2(xt)
+            branch = xt + branch
+            if i % steps == steps - 1:
+                xs = xs + branch
+        return xs / self.num_kernels
+
+
+class FastGenerator(nn.Module):
+    """
+    Inference-only HiFi-GAN Generator built from a trained hifigan.Generator:
+    weight norm is folded into the weights, and each stage's parallel
+    ResBlocks can run as one FusedResBlocks (fuse=True). The forward has no
+    data-dependent Python control flow, so it can be scripted or compiled
+    (see optimize_generator).
+    """
+    def __init__(self, generator, fuse=False):
+        super(FastGenerator, self).__init__()
+        # a fresh copy: deepcopy fails on modules that still carry weight norm
+        weight_norm = hasattr(generator.conv_pre, "weight_g")
+        state_dict = generator.state_dict()
+        device = generator.conv_post.bias.device
+        generator = Generator(generator.h).to(device)
+        if not weight_norm:
+            generator.remove_weight_norm()
+        generator.load_state_dict(state_dict)
+        if weight_norm:
+            generator.remove_weight_norm()
+        self.h = generator.h
+        self.slope = LRELU_SLOPE
+        self.conv_pre = generator.conv_pre
+        self.ups = generator.ups
+        num_kernels = generator.num_kernels
+        stages = [list(generator.resblocks[i * num_kernels:(i + 1) * num_kernels]) for i in range(len(self.ups))]
+        # SequentialResBlocks / FusedResBlocks follow the convs1 + convs2 layout of ResBlock
+        assert all(isinstance(block, ResBlock) and hasattr(block, "convs2") for block in generator.resblocks), \
+            "FastGenerator needs ResBlock stages with convs1 / convs2"
+        self.resblocks = nn.ModuleList([FusedResBlocks(blocks) if fuse else SequentialResBlocks(blocks)
+                                        for blocks in stages])
+        self.conv_post = generator.conv_post
+        self.eval()
+        for param in self.parameters():
+            param.requires_grad = False
+
+    def forward(self, x):
+        x = self.conv_pre(x)
+        for up, resblocks in zip(self.ups, self.resblocks):
+            x = F.leaky_relu(x, self.slope)
+            x = resblocks(up(x))
+        x = F.leaky_relu(x)
+        x = self.conv_post(x)
+        return torch.tanh(x)
+
+
+def optimize_generator(generator, mode="script", fuse=False):
+    """
+    Inference graph for a hifigan.Generator
+
+    PARAMS
+    ------
+    mode: "script" for a frozen TorchScript module (optimize_for_inference,
+    which also folds conv + bias and lays out convs for MKL-DNN on CPU),
+    "compile" for torch.compile(dynamic=True), "eager" for the plain FastGenerator
+    fuse: run the parallel ResBlocks of each stage as grouped convolutions.
+    Fewer, larger kernels: the padding to the largest kernel adds ~60% FLOPs,
+    which made it slower on CPU (benchmark.py hifigan)
+
+    RETURNS
+    -------
+    a frozen module mapping mels (B, n_mel_channels, N) to waveforms (B, 1, N * hop)
+    """
+    model = FastGenerator(generator, fuse=fuse)
+    if mode == "script":
+        return torch.jit.optimize_for_inference(torch.jit.script(model))
+    if mode == "compile":
+        return torch.compile(model, dynamic=True)
+    assert mode == "eager", "unknown mode {}".format(mode)
+    return model
@@ -0,0 +1,47 @@
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from .fast import FastGenerator
+
+
+def quantize_generator(generator, calibration_mels, backend="fbgemm"):
+    """
+    Static post-training INT8 quantization of a hifigan.Generator for CPU.
+
+    Dynamic quantization only covers Linear/LSTM layers, and the Generator is
+    all (transposed) convolutions, so weights and activations are quantized
+    statically: observers are placed on the FX graph of the FastGenerator
+    (weight norm folded), the calibration mels are run through it to collect
+    activation ranges, and the result is converted to quantized kernels.
+    Transposed convs get per-tensor, convs per-channel weight scales (the
+    defaults of the backend).
+
+    PARAMS
+    ------
+    calibration_mels: iterable of mels of shape (B, n_mel_channels, N)
+    backend: quantized engine, "fbgemm" (or "x86", slower in our runs) on x86 CPUs, "qnnpack" on ARM
+
+    RETURNS
+    -------
+    the quantized generator, a CPU-only module mapping mels to waveforms (B, 1, N * hop)
+    """
+    torch.backends.quantized.engine = backend
+    model = FastGenerator(generator).cpu().eval()
+    example = next(iter(calibration_mels))
+    prepared = prepare_fx(model, get_default_qconfig_mapping(backend), example_inputs=(example.cpu(),))
+    with torch.no_grad():
+        for mel in calibration_mels:
+            prepared(mel.cpu())
+    return convert_fx(prepared)
+
+
+def save_quantized(path, quantized):
+    torch.jit.save(torch.jit.script(quantized), path)
+
+
+def load_quantized(path, backend="fbgemm"):
+    # the kernels are those of the engine that is active when the model runs
+    torch.backends.quantized.engine = backend
+    quantized = torch.jit.load(path, map_location="cpu")
+    quantized.eval()
+    return quantized
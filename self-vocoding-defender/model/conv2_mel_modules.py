@@ -3,11 +3,11 @@ import torch
 import torch.nn as nn
 from torch.nn import LeakyReLU, Tanh
 from .blocks import FCBlock, PositionalEncoding, Mish, Conv1DBlock, Conv2Encoder, WatermarkEmbedder, WatermarkExtracter, ReluBlock
-from distortions.frequency import TacotronSTFT, fixed_STFT, tacotron_mel
+from distortions.frequency import TacotronSTFT, fixed_STFT, tacotron_mel, length_mask, valid_frames
 from distortions.dl import distortion
+from .surrogate import load_surrogate
+from .vocoders import vocoder_zoo
 import pdb
-import hifigan
-import json
 import torchaudio
 
 import librosa
@@ -80,20 +80,25 @@ def save_waveform(a_tensor, flag='original'):
 
 
 
-def get_vocoder(device, vocoder_type):
-    if vocoder_type == 'hifigan':
-        with open("hifigan/config.json", "r") as f:
-            config = json.load(f)
-        config = hifigan.AttrDict(config)
-        vocoder = hifigan.Generator(config)
-        ckpt = torch.load("./hifigan/model/VCTK_V1/generator_v1")
-        vocoder.load_state_dict(ckpt["generator"])
-        vocoder.eval()
-        vocoder.remove_weight_norm()
-        vocoder.to(device)
-        freeze_model_and_submodules(vocoder)
-        return vocoder
-    
+def get_vocoder(device, vocoder_type, **config):
+    """
+    the vocoder `vocoder_type` from the process-wide zoo (model/vocoders.py),
+    loaded on first use and shared with every other caller in the process;
+    config goes to its loader, e.g. chunk_frames / optimize for 'hifigan'
+    """
+    return vocoder_zoo.get(vocoder_type, device, **config)
+
+
+def frame_mean(x, frame_lengths=None):
+    """
+    mean of x (B, C, N) over its frames, each example over its first
+    frame_lengths[b] only, so the frames of zero-padding do not count
+    """
+    if frame_lengths is None:
+        return torch.mean(x, dim=2, keepdim=True)
+    mask = length_mask(frame_lengths, x.size(2), x.device).unsqueeze(1)
+    return torch.sum(x * mask, dim=2, keepdim=True) / mask.sum(dim=2, keepdim=True)
+
 
 def freeze_model_and_submodules(model):
     for param in model.parameters():
@@ -120,15 +125,16 @@ class Encoder(nn.Module):
         self.msg_linear_in = FCBlock(msg_length, win_dim, activation=LeakyReLU(inplace=True))
 
         #stft transform
-        self.stft = fixed_STFT(process_config["mel"]["n_fft"], process_config["mel"]["hop_length"], process_config["mel"]["win_length"])
+        self.stft = fixed_STFT(process_config["mel"]["n_fft"], process_config["mel"]["hop_length"], process_config["mel"]["win_length"], backend=process_config["mel"].get("stft_backend", "conv"))
 
         self.ENc = Conv2Encoder(input_channel=1, hidden_dim = model_config["conv2"]["hidden_dim"], block=self.block, n_layers=self.layers_CE)
 
         self.EM = WatermarkEmbedder(input_channel=self.EM_input_dim, hidden_dim = model_config["conv2"]["hidden_dim"], block=self.block, n_layers=self.layers_EM)
 
-    def forward(self, x, msg, global_step):
+    def forward(self, x, msg, global_step, lengths=None):
+        """ lengths: valid samples of each example of a zero-padded batch (dataset.data.pad_collate), or None """
         num_samples = x.shape[2]
-        spect, phase = self.stft.transform(x)
+        spect, phasor = self.stft.transform_phasor(x)
         # print("spect, phase", spect, phase)
         
         # for param in self.ENc.parameters():
@@ -144,14 +150,16 @@ class Encoder(nn.Module):
         # print("carrier_wateramrked", carrier_wateramrked)
 
         
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse_phasor(carrier_wateramrked.squeeze(1), phasor, num_samples)
+        if lengths is not None:
+            # the padding stays silent
+            y = y * length_mask(lengths, num_samples, y.device).unsqueeze(1)
         return y, carrier_wateramrked
     
     def test_forward(self, x, msg):
         num_samples = x.shape[2]
         # print("x.shape:", x.shape)                      # [1, 1, 109023]
-        spect, phase = self.stft.transform(x)
+        spect, phasor = self.stft.transform_phasor(x)
         # print("spect:", spect.shape)                    # [1, 513, 426]
         
         carrier_encoded = self.ENc(spect.unsqueeze(1)) 
@@ -161,9 +169,8 @@ class Encoder(nn.Module):
         carrier_wateramrked = self.EM(concatenated_feature)  
         # print("WMed spect:", carrier_wateramrked.shape) # [1, 1, 513, 426]
         
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1))
-        y_pure_WM = self.stft.inverse(watermark_encoded.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse_phasor(carrier_wateramrked.squeeze(1), phasor, num_samples)
+        y_pure_WM = self.stft.inverse_phasor(watermark_encoded.squeeze(1), phasor, num_samples)
         return y, carrier_wateramrked, y_pure_WM
     
     def save_forward(self, x, msg):
@@ -181,41 +188,85 @@ class Encoder(nn.Module):
         carrier_wateramrked = self.EM(concatenated_feature)  
         save_spectrum(carrier_wateramrked.squeeze(1), phase, 'wmed_linear')
         
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1), num_samples)
         save_waveform(y.squeeze().squeeze(), 'wmed')
         return y, carrier_wateramrked
 
 
 class Decoder(nn.Module):
-    def __init__(self, process_config, model_config, msg_length, win_dim, embedding_dim, nlayers_decoder=6, transformer_drop=0.1, attention_heads=8):
+    def __init__(self, process_config, model_config, msg_length, win_dim, embedding_dim, nlayers_decoder=6, transformer_drop=0.1, attention_heads=8, load_vocoder=True):
         super(Decoder, self).__init__()
         self.robust = model_config["robust"]
         if self.robust:
             self.dl = distortion()
 
-        self.mel_transform = TacotronSTFT(filter_length=process_config["mel"]["n_fft"], hop_length=process_config["mel"]["hop_length"], win_length=process_config["mel"]["win_length"])
+        self.mel_transform = TacotronSTFT(filter_length=process_config["mel"]["n_fft"], hop_length=process_config["mel"]["hop_length"], win_length=process_config["mel"]["win_length"], backend=process_config["mel"].get("stft_backend", "conv"))
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.vocoder = get_vocoder(device, 'hifigan')
+        # HiFi-GAN is loaded on first use (see the vocoder property); load_vocoder=False forbids it altogether
+        self.load_vocoder = load_vocoder
+        self.vocoder_type = model_config.get("vocoder", {}).get("name", "hifigan")
+        self.hifigan_loss = model_config.get("vocoder", {}).get("hifigan_loss", 0)
+        self.vocoder_chunk_frames = model_config.get("vocoder", {}).get("chunk_frames", 0)
         self.vocoder_step = model_config["structure"]["vocoder_step"]
+        self.griffin_lim_config = model_config.get("griffin_lim", {})
+        # distilled surrogate of the vocoding simulation (train_surrogate.py), replaces mel -> Griffin-Lim when set.
+        # Frozen and kept out of the module tree like the vocoder: not in state_dict() or parameters(), moved in _apply
+        surrogate = None
+        if model_config.get("surrogate", {}).get("path"):
+            surrogate = load_surrogate(model_config["surrogate"]["path"], device, backend=process_config["mel"].get("stft_backend", "conv"))
+        object.__setattr__(self, "surrogate", surrogate)
 
         win_dim = int((process_config["mel"]["n_fft"] / 2) + 1)
         self.block = model_config["conv2"]["block"]
         self.EX = WatermarkExtracter(input_channel=1, hidden_dim=model_config["conv2"]["hidden_dim"], block=self.block)
-        self.stft = fixed_STFT(process_config["mel"]["n_fft"], process_config["mel"]["hop_length"], process_config["mel"]["win_length"])
+        self.stft = fixed_STFT(process_config["mel"]["n_fft"], process_config["mel"]["hop_length"], process_config["mel"]["win_length"], backend=process_config["mel"].get("stft_backend", "conv"))
         self.msg_linear_out = FCBlock(win_dim, msg_length)
 
 
-    def forward(self, y, global_step):
+    def _apply(self, fn, *args, **kwargs):
+        # .to() / .cuda() / .half() also reach the surrogate, which is not a submodule
+        if self.surrogate is not None:
+            self.surrogate._apply(fn, *args, **kwargs)
+        return super(Decoder, self)._apply(fn, *args, **kwargs)
+
+    @property
+    def vocoder(self):
+        """
+        The frozen vocoder on the Decoder's device, from the process-wide zoo:
+        loaded on first access and shared with other Decoders. It is not a
+        submodule, so it is not part of state_dict() and is not moved by .to()
+        """
+        if not self.load_vocoder:
+            raise RuntimeError("this Decoder was built with load_vocoder=False")
+        config = {"chunk_frames": self.vocoder_chunk_frames} if self.vocoder_chunk_frames else {}
+        return get_vocoder(next(self.parameters()).device, self.vocoder_type, **config)
+
+    def griffin_lim(self, y_mel, init_phase=None, lengths=None):
+        config = self.griffin_lim_config
+        return self.mel_transform.griffin_lim(
+            magnitudes=y_mel,
+            n_iters=config.get("n_iters", 60),
+            momentum=config.get("momentum", 0.),
+            tol=config.get("tol", 0.),
+            init_phase=init_phase,
+            lengths=lengths,
+            grad_iters=config.get("grad_iters", 0),
+            checkpoint_segments=config.get("checkpoint_segments", 0))
+
+    def forward(self, y, global_step, init_phase=None, lengths=None):
         
         y_identity = y.clone()
+        y_mel = None
         # pdb.set_trace()
-        if global_step > self.vocoder_step:
-            y_mel = self.mel_transform.mel_spectrogram(y.squeeze(1))
+        if global_step > self.vocoder_step and self.surrogate is not None:
+            y_d = self.mel_transform.wav_norm(self.surrogate(y).squeeze(1), lengths).unsqueeze(1)
+        elif global_step > self.vocoder_step:
+            y_mel = self.mel_transform.mel_spectrogram(y.squeeze(1), lengths)
+            if init_phase is None and self.griffin_lim_config.get("warm_start", False):
+                # phase of the watermarked signal, i.e. (close to) that of the Encoder input
+                _, init_phase = self.mel_transform.stft_fn.transform_phasor(y.squeeze(1))
             # y = self.vocoder(y_mel)
-            y_d = (self.mel_transform.griffin_lim(magnitudes=y_mel)).unsqueeze(1)
-            y_mel_hifigan = y_mel.clone()
-            y_d_hifigan = self.vocoder(y_mel_hifigan)
+            y_d = (self.griffin_lim(y_mel, init_phase, lengths)).unsqueeze(1)
         else:
             y_d = y
 
@@ -225,15 +276,28 @@ class Decoder(nn.Module):
             y_d_d = y_d
         # print("2.", y_d_d.shape)    # [1, 1, wav_len]
         spect, phase = self.stft.transform(y_d_d)
+        # frames centred on valid samples
+        frame_lengths = None if lengths is None else valid_frames(lengths, self.stft.hop_length)
 
         extracted_wm = self.EX(spect.unsqueeze(1)).squeeze(1)
-        msg = torch.mean(extracted_wm,dim=2, keepdim=True).transpose(1,2)
+        msg = frame_mean(extracted_wm, frame_lengths).transpose(1,2)
         msg = self.msg_linear_out(msg)
 
         spect_identity, phase_identity = self.stft.transform(y_identity)
         extracted_wm_identity = self.EX(spect_identity.unsqueeze(1)).squeeze(1)
-        msg_identity = torch.mean(extracted_wm_identity,dim=2, keepdim=True).transpose(1,2)
+        msg_identity = frame_mean(extracted_wm_identity, frame_lengths).transpose(1,2)
         msg_identity = self.msg_linear_out(msg_identity)
+
+        if self.hifigan_loss and global_step > self.vocoder_step:
+            # message from HiFi-GAN-vocoded audio, a third term for Loss_identity
+            if y_mel is None:
+                y_mel = self.mel_transform.mel_spectrogram(y.squeeze(1), lengths)
+            y_hifigan = self.mel_transform.wav_norm(self.vocoder(y_mel).squeeze(1), lengths).unsqueeze(1)
+            spect_hifigan, _ = self.stft.transform(y_hifigan)
+            extracted_wm_hifigan = self.EX(spect_hifigan.unsqueeze(1)).squeeze(1)
+            msg_hifigan = frame_mean(extracted_wm_hifigan, frame_lengths).transpose(1,2)
+            msg_hifigan = self.msg_linear_out(msg_hifigan)
+            return msg, msg_identity, msg_hifigan
         return msg, msg_identity
     
     def test_forward(self, y, name=None):
@@ -309,7 +373,7 @@ class Discriminator(nn.Module):
                 nn.AdaptiveAvgPool2d(output_size=(1, 1))
                 )
         self.linear = nn.Linear(64,1)
-        self.stft = fixed_STFT(process_config["mel"]["n_fft"], process_config["mel"]["hop_length"], process_config["mel"]["win_length"])
+        self.stft = fixed_STFT(process_config["mel"]["n_fft"], process_config["mel"]["hop_length"], process_config["mel"]["win_length"], backend=process_config["mel"].get("stft_backend", "conv"))
 
     def forward(self, x):
         spect, phase = self.stft.transform(x)
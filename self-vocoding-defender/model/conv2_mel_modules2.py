@@ -122,8 +122,7 @@ class Encoder(nn.Module):
         carrier_wateramrked = self.EM(concatenated_feature)  
 
         
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1), num_samples)
         return y, carrier_wateramrked
     
     def test_forward(self, x, msg, strength_factor=1.0):
@@ -135,8 +134,7 @@ class Encoder(nn.Module):
         concatenated_feature = torch.cat((carrier_encoded, watermark_encoded*strength_factor), dim=1)  
         carrier_wateramrked = self.EM(concatenated_feature)  
         
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1), num_samples)
         return y, carrier_wateramrked
 
 
@@ -99,8 +99,7 @@ class Encoder(nn.Module):
         concatenated_feature = torch.cat((carrier_encoded, spect.unsqueeze(1), weight*watermark_encoded), dim=1)  
         carrier_wateramrked = self.EM(concatenated_feature)  
         
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1), num_samples)
         return y, carrier_wateramrked
     
     def test_forward(self, x, msg, weight):
@@ -112,8 +111,7 @@ class Encoder(nn.Module):
         concatenated_feature = torch.cat((carrier_encoded, spect.unsqueeze(1), weight*watermark_encoded), dim=1)  
         carrier_wateramrked = self.EM(concatenated_feature)  
         
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1), num_samples)
         return y, carrier_wateramrked
     
     def save_forward(self, x, msg):
@@ -129,8 +127,7 @@ class Encoder(nn.Module):
         concatenated_feature = torch.cat((carrier_encoded, spect.unsqueeze(1), watermark_encoded), dim=1)  
         carrier_wateramrked = self.EM(concatenated_feature)  
         
-        self.stft.num_samples = num_samples
-        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1))
+        y = self.stft.inverse(carrier_wateramrked.squeeze(1), phase.squeeze(1), num_samples)
         return y, carrier_wateramrked
 
 
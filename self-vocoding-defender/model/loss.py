@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from distortions.frequency import fixed_STFT, length_mask
 
 
 class Loss(nn.Module):
@@ -20,9 +21,17 @@ class Loss_identity(nn.Module):
         # self.msg_loss = nn.CrossEntropyLoss()
         self.embedding_loss = nn.MSELoss()
     
-    def en_de_loss(self, x, w_x, msg, rec_msg):
-        embedding_loss = self.embedding_loss(x, w_x)
+    def en_de_loss(self, x, w_x, msg, rec_msg, lengths=None):
+        """ lengths: valid samples of each example of a zero-padded batch; the padding is left out of embedding_loss """
+        if lengths is None:
+            embedding_loss = self.embedding_loss(x, w_x)
+        else:
+            mask = length_mask(lengths, x.size(-1), x.device).unsqueeze(1)
+            embedding_loss = torch.sum((x - w_x)**2 * mask) / (mask.sum() * x.size(1))
         msg_loss = self.msg_loss(msg, rec_msg[0]) + self.msg_loss(msg, rec_msg[1])
+        # extra decoded messages, e.g. from HiFi-GAN-vocoded audio (model.yaml vocoder.hifigan_loss)
+        for rec in rec_msg[2:]:
+            msg_loss = msg_loss + self.msg_loss(msg, rec)
         # msg_loss = self.msg_loss(msg, rec_msg[0])
         # msg_loss = self.msg_loss(msg, rec_msg[0]) + self.msg_loss(msg, rec_msg[1]) + self.msg_loss(msg, rec_msg[2])
         return embedding_loss, msg_loss
@@ -105,3 +114,23 @@ class Lossex(nn.Module):
         msg_loss = self.msg_loss(msg, rec_msg)
         no_msg_loss = self.msg_loss(no_msg, no_decoded)
         return embedding_loss, msg_loss, no_msg_loss
+
+class MultiResolutionSTFTLoss(nn.Module):
+    """ spectral convergence + log-magnitude L1, averaged over several STFT resolutions """
+    def __init__(self, resolutions=((512, 128), (1024, 256), (2048, 512))):
+        super(MultiResolutionSTFTLoss, self).__init__()
+        self.stfts = nn.ModuleList([fixed_STFT(n_fft, hop, n_fft, backend='fft') for n_fft, hop in resolutions])
+
+    def magnitude(self, stft, y):
+        # clamped before the sqrt, whose gradient is infinite at silent bins
+        real_part, imag_part = stft._analyze(y)
+        return torch.sqrt(torch.clamp(real_part**2 + imag_part**2, min=1e-7))
+
+    def forward(self, y_hat, y):
+        loss = 0
+        for stft in self.stfts:
+            mag_hat = self.magnitude(stft, y_hat)
+            mag = self.magnitude(stft, y)
+            loss = loss + torch.norm(mag - mag_hat) / torch.norm(mag).clamp(min=1e-5)
+            loss = loss + torch.mean(torch.abs(torch.log(mag.clamp(min=1e-5)) - torch.log(mag_hat.clamp(min=1e-5))))
+        return loss / len(self.stfts)
@@ -85,8 +85,7 @@ class Encoder(nn.Module):
     def forward(self, x, w):
         encoded_msg, encoder_out, p_x, phase, num_samples, spect = self.forward_encode_msg(x, w)
         wav_out = self.forward_decode_wav(encoded_msg, encoder_out, p_x)
-        self.stft.num_samples = num_samples
-        noised_wav = self.stft.inverse(wav_out.transpose(1,2), phase)
+        noised_wav = self.stft.inverse(wav_out.transpose(1,2), phase, num_samples)
         # noised_wav = self.stft.inverse(wav_out.transpose(1,2)+spect, phase)
         return noised_wav
 
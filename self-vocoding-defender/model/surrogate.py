@@ -0,0 +1,80 @@
+import torch
+import torch.nn as nn
+from torch.nn import LeakyReLU
+from distortions.frequency import TacotronSTFT, fixed_STFT
+
+
+class VocoderSurrogate(nn.Module):
+    """
+    Small differentiable stand-in for the self-vocoding simulation (mel ->
+    Griffin-Lim or HiFi-GAN) used in Decoder.forward.
+
+    The watermark is extracted from STFT magnitudes, so the surrogate only
+    models what vocoding does to them. The fixed part is the mel round trip
+    every vocoder input goes through (mel_basis, then its pinv, which also
+    removes everything above mel_fmax); on top of it a 1D conv net over the
+    log-mel frames predicts a per-band log-gain, spread over the linear bins
+    with the mel filter weights. The result is resynthesized with the input
+    phase. The last layer starts at zero, so an untrained surrogate is the
+    plain mel round trip.
+    """
+    def __init__(self, n_fft=1024, hop_length=256, win_length=1024, hidden_dim=128, n_layers=3,
+                 kernel_size=5, n_mel_channels=80, sampling_rate=22050, mel_fmin=0.0, mel_fmax=8000.0,
+                 backend='conv'):
+        super(VocoderSurrogate, self).__init__()
+        self.config = {"n_fft": n_fft, "hop_length": hop_length, "win_length": win_length,
+                       "hidden_dim": hidden_dim, "n_layers": n_layers, "kernel_size": kernel_size,
+                       "n_mel_channels": n_mel_channels, "sampling_rate": sampling_rate,
+                       "mel_fmin": mel_fmin, "mel_fmax": mel_fmax}
+        self.stft = fixed_STFT(n_fft, hop_length, win_length, backend=backend)
+        self.mel = TacotronSTFT(n_fft, hop_length, win_length, n_mel_channels, sampling_rate,
+                                mel_fmin, mel_fmax, backend=backend)
+
+        layers = []
+        channels = n_mel_channels
+        for i in range(n_layers - 1):
+            layers += [nn.Conv1d(channels, hidden_dim, kernel_size, padding=kernel_size // 2), LeakyReLU(0.2)]
+            channels = hidden_dim
+        self.net = nn.Sequential(*layers)
+        self.gain = nn.Conv1d(channels, n_mel_channels, kernel_size, padding=kernel_size // 2)
+        nn.init.zeros_(self.gain.weight)
+        nn.init.zeros_(self.gain.bias)
+
+    def forward(self, y):
+        """
+        PARAMS
+        ------
+        y: waveform of shape (B, 1, T)
+
+        RETURNS
+        -------
+        "self-vocoded" waveform of shape (B, 1, T)
+        """
+        num_samples = y.shape[2]
+        spect, phasor = self.stft.transform_phasor(y)
+        mel = torch.matmul(self.mel.mel_basis, spect)
+        spect = torch.relu(torch.matmul(self.mel.mel_to_linear_basis, mel))
+
+        log_gain = self.gain(self.net(self.mel.spectral_normalize(mel)))
+        # spread each band's gain over its bins, weighted by the mel filters
+        weights = self.mel.mel_basis
+        log_gain = torch.matmul(weights.t(), log_gain) / weights.sum(0).clamp(min=1e-8).unsqueeze(-1)
+        return self.stft.inverse_phasor(spect * torch.exp(log_gain), phasor, num_samples)
+
+
+def save_surrogate(path, surrogate, **info):
+    torch.save({"surrogate": surrogate.state_dict(), "config": surrogate.config, "info": info}, path)
+
+
+def load_surrogate(path, device, backend='conv'):
+    """
+    Load a surrogate written by train_surrogate.py, in eval mode and with its
+    parameters frozen: it only passes gradients through to the Encoder.
+    """
+    ckpt = torch.load(path, map_location=device)
+    surrogate = VocoderSurrogate(backend=backend, **ckpt["config"])
+    surrogate.load_state_dict(ckpt["surrogate"])
+    surrogate.eval()
+    for param in surrogate.parameters():
+        param.requires_grad = False
+    return surrogate.to(device)
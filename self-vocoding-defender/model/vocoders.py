@@ -0,0 +1,138 @@
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+import torch
+import hifigan
+
+
+# name -> loader(device, **config) returning a frozen, eval-mode vocoder mel (B, 80, N) -> wav (B, 1, T)
+VOCODER_LOADERS = {}
+
+
+def register_vocoder(name):
+    """
+    Decorator adding a loader to the zoo, e.g. for the other vocoders of the
+    self-vocoding evaluation (cargan, diffwave, istftnet, waveflow, wavernn)
+    """
+    def register(loader):
+        VOCODER_LOADERS[name] = loader
+        return loader
+    return register
+
+
+def _freeze(vocoder):
+    vocoder.eval()
+    for param in vocoder.parameters():
+        param.requires_grad = False
+    return vocoder
+
+
+def _hifigan_config(config):
+    with open(config, "r") as f:
+        return hifigan.AttrDict(json.load(f))
+
+
+@register_vocoder("hifigan")
+def load_hifigan(device, checkpoint="./hifigan/model/VCTK_V1/generator_v1", config="hifigan/config.json",
+                 chunk_frames=0, optimize=""):
+    """
+    chunk_frames > 0 vocodes long mels chunk by chunk (hifigan.ChunkedGenerator),
+    which bounds the memory of the activations on multi-minute inputs.
+    optimize ("eager", "script" or "compile") swaps in the inference graph of
+    hifigan.optimize_generator, meant for evaluation-time vocoding
+    """
+    h = _hifigan_config(config)
+    vocoder = hifigan.Generator(h)
+    ckpt = torch.load(checkpoint, map_location=device)
+    vocoder.load_state_dict(ckpt["generator"])
+    vocoder.eval()
+    vocoder.remove_weight_norm()
+    vocoder = _freeze(vocoder.to(device))
+    if optimize:
+        vocoder = hifigan.optimize_generator(vocoder, mode=optimize)
+    if chunk_frames > 0:
+        vocoder = hifigan.ChunkedGenerator(vocoder, chunk_frames=chunk_frames, h=h)
+    return vocoder
+
+
+@register_vocoder("hifigan_int8")
+def load_hifigan_int8(device, checkpoint="./hifigan/model/VCTK_V1/generator_v1_int8.pt", config="hifigan/config.json",
+                      chunk_frames=0):
+    # written by quantize_hifigan.py; quantized kernels only run on CPU
+    assert device.type == "cpu", "the INT8 HiFi-GAN runs on CPU only"
+    from hifigan.quantize import load_quantized
+    vocoder = load_quantized(checkpoint)
+    if chunk_frames > 0:
+        vocoder = hifigan.ChunkedGenerator(vocoder, chunk_frames=chunk_frames, h=_hifigan_config(config))
+    return vocoder
+
+
+def module_bytes(module):
+    tensors = {t.data_ptr(): t.numel() * t.element_size()
+               for t in list(module.parameters()) + list(module.buffers())}
+    return sum(tensors.values())
+
+
+class VocoderZoo():
+    """
+    Process-wide cache of loaded vocoders.
+
+    Vocoders are loaded on demand by name and loader config and handed out as
+    the same module to every caller, so all Decoders (and evaluation scripts)
+    in a process share one copy of each checkpoint per device. At most
+    `max_resident` vocoders, and at most `memory_budget_mb` MB of their
+    weights, stay loaded; beyond that the least recently used ones are
+    dropped, and loaded again if asked for later. Callers should hold on to
+    a vocoder only for as long as they use it, otherwise an evicted one stays
+    in memory.
+
+    Defaults come from SVD_VOCODER_MAX_RESIDENT and SVD_VOCODER_BUDGET_MB;
+    0 means no limit.
+    """
+    def __init__(self, max_resident=None, memory_budget_mb=None):
+        if max_resident is None:
+            max_resident = int(os.environ.get("SVD_VOCODER_MAX_RESIDENT", 2))
+        if memory_budget_mb is None:
+            memory_budget_mb = float(os.environ.get("SVD_VOCODER_BUDGET_MB", 0))
+        self.max_resident = max_resident
+        self.memory_budget_mb = memory_budget_mb
+        self._resident = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, name, device, **config):
+        if name not in VOCODER_LOADERS:
+            raise KeyError("unknown vocoder {}, known: {}".format(name, sorted(VOCODER_LOADERS)))
+        device = torch.device(device)
+        key = (name, str(device), tuple(sorted(config.items())))
+        with self._lock:
+            if key in self._resident:
+                self._resident.move_to_end(key)
+                return self._resident[key][0]
+            vocoder = VOCODER_LOADERS[name](device, **config)
+            self._resident[key] = (vocoder, module_bytes(vocoder))
+            logging.info("loaded vocoder {} on {} ({:.1f} MB)".format(name, device, self._resident[key][1] / 2**20))
+            self._evict(keep=key)
+            return vocoder
+
+    def resident(self):
+        with self._lock:
+            return [(key, size) for key, (_, size) in self._resident.items()]
+
+    def clear(self):
+        with self._lock:
+            self._resident.clear()
+
+    def _evict(self, keep):
+        budget = self.memory_budget_mb * 2**20
+        while len(self._resident) > 1:
+            total = sum(size for _, size in self._resident.values())
+            if not ((self.max_resident and len(self._resident) > self.max_resident) or (budget and total > budget)):
+                break
+            key = next(k for k in self._resident if k != keep)
+            del self._resident[key]
+            logging.info("evicted vocoder {} on {}".format(key[0], key[1]))
+
+
+vocoder_zoo = VocoderZoo()
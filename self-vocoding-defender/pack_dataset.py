@@ -0,0 +1,45 @@
+import os
+import yaml
+import logging
+import argparse
+from dataset.data import pack_shard, resample_cache, list_files
+
+
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+
+def main(args, configs):
+    process_config, train_config = configs
+    shard_dir = args.out or train_config["path"]["shard_path"]
+    assert shard_dir, "set path.shard_path in train.yaml or pass --out"
+    workers = args.workers if args.workers is not None else train_config.get("loader", {}).get("preload_workers", 0)
+    for flag in args.flags:
+        # same files, in the same order, as wav_dataset.process_meta
+        split_path = os.path.join(train_config["path"]["raw_path"], flag)
+        paths = [os.path.join(split_path, name) for name in list_files(split_path)]
+        num_samples = pack_shard(paths, shard_dir, flag, workers,
+                                 process_config["audio"]["or_sample_rate"], process_config["audio"]["sample_rate"],
+                                 cache=resample_cache(train_config))
+        logging.info("{}: {} files, {:.1f} h at {} Hz -> {}".format(
+            flag, len(paths), num_samples / process_config["audio"]["sample_rate"] / 3600,
+            process_config["audio"]["sample_rate"], shard_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="pack dataset splits into memory-mapped shards for shard_dataset")
+    parser.add_argument(
+        "-p",
+        "--process_config",
+        type=str,
+        default="config/process.yaml",
+        help="path to process.yaml",
+    )
+    parser.add_argument("-t", "--train_config", type=str, default="config/train.yaml", help="path to train.yaml")
+    parser.add_argument("--flags", nargs="+", default=["train", "val"], help="splits under path.raw_path to pack")
+    parser.add_argument("--out", type=str, default="", help="shard directory, path.shard_path if empty")
+    parser.add_argument("--workers", type=int, default=None, help="decoding processes, loader.preload_workers if not given")
+    args = parser.parse_args()
+
+    process_config = yaml.load(open(args.process_config, "r"), Loader=yaml.FullLoader)
+    train_config = yaml.load(open(args.train_config, "r"), Loader=yaml.FullLoader)
+    main(args, (process_config, train_config))
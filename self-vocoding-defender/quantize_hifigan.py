@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import torch
+import yaml
+import random
+import logging
+import argparse
+import numpy as np
+from rich.progress import track
+from torch.utils.data import DataLoader
+import hifigan
+from hifigan.quantize import quantize_generator, save_quantized, load_quantized
+from dataset.data import wav_dataset
+from distortions.frequency import TacotronSTFT
+
+
+# set seeds
+seed = 2022
+random.seed(seed)
+np.random.seed(seed)
+torch.manual_seed(seed)
+
+
+logging_mark = "#"*20
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+# the INT8 kernels are CPU-only, so is everything here
+device = torch.device("cpu")
+
+
+def load_generator(checkpoint):
+    with open("hifigan/config.json", "r") as f:
+        h = hifigan.AttrDict(json.load(f))
+    generator = hifigan.Generator(h)
+    generator.load_state_dict(torch.load(checkpoint, map_location=device)["generator"])
+    generator.eval()
+    generator.remove_weight_norm()
+    for param in generator.parameters():
+        param.requires_grad = False
+    return generator
+
+
+def calibration_mels(process_config, train_config, mel_transform, n_clips, segment):
+    audios = wav_dataset(process_config=process_config, train_config=train_config, flag='train')
+    indices = random.sample(range(len(audios)), min(n_clips, len(audios)))
+    mels = []
+    for idx in indices:
+        mel = mel_transform.mel_spectrogram(audios[idx]["matrix"])
+        if segment > 0 and mel.shape[2] > segment:
+            start = random.randint(0, mel.shape[2] - segment)
+            mel = mel[..., start:start + segment]
+        mels.append(mel)
+    return mels
+
+
+def load_watermark_model(process_config, model_config, train_config, path):
+    from model.conv2_mel_modules import Encoder, Decoder
+    win_dim = process_config["audio"]["win_len"]
+    embedding_dim = model_config["dim"]["embedding"]
+    msg_length = train_config["watermark"]["length"]
+    encoder = Encoder(process_config, model_config, msg_length, win_dim, embedding_dim,
+                      nlayers_encoder=model_config["layer"]["nlayers_encoder"],
+                      attention_heads=model_config["layer"]["attention_heads_encoder"]).to(device)
+    decoder = Decoder(process_config, model_config, msg_length, win_dim, embedding_dim,
+                      nlayers_decoder=model_config["layer"]["nlayers_decoder"],
+                      attention_heads=model_config["layer"]["attention_heads_decoder"], load_vocoder=False).to(device)
+    model = torch.load(path, map_location=device)
+    encoder.load_state_dict(model["encoder"])
+    decoder.load_state_dict(model["decoder"], strict=False)
+    encoder.eval()
+    decoder.eval()
+    return encoder, decoder, msg_length
+
+
+def report(args, configs, mel_transform, vocoders):
+    """
+    Self-vocode the watermarked val set with every vocoder and compare real-time
+    factor, bit accuracy of the extracted watermark and SNR to the fp32 output
+    """
+    process_config, model_config, train_config = configs
+    encoder, decoder, msg_length = load_watermark_model(process_config, model_config, train_config, args.watermark_ckpt)
+    audios = wav_dataset(process_config=process_config, train_config=train_config, flag='val')
+    audios_loader = DataLoader(audios, batch_size=1, shuffle=False)
+    sr = process_config["audio"]["sample_rate"]
+
+    stats = {name: {"time": 0., "acc": 0., "snr": 0.} for name in vocoders}
+    seconds, count = 0., 0
+    with torch.no_grad():
+        # weight prepacking etc. happens on the first call, keep it out of the timings
+        for vocoder in vocoders.values():
+            vocoder(torch.zeros(1, mel_transform.n_mel_channels, 32, device=device))
+        for sample in track(audios_loader):
+            if args.clips and count >= args.clips:
+                break
+            count += 1
+            wav_matrix = sample["matrix"].to(device)
+            msg = np.random.choice([0,1], [1, 1, msg_length])
+            msg = torch.from_numpy(msg).float()*2 - 1
+            encoded, _, _ = encoder.test_forward(wav_matrix, msg)
+            mel = mel_transform.mel_spectrogram(encoded.squeeze(1))
+            seconds += encoded.shape[2] / sr
+            reference = None
+            for name, vocoder in vocoders.items():
+                start = time.perf_counter()
+                y = vocoder(mel)
+                stats[name]["time"] += time.perf_counter() - start
+                decoded, _, _ = decoder.test_forward(y)
+                stats[name]["acc"] += ((decoded >= 0).eq(msg >= 0).sum().float() / msg.numel()).item()
+                if reference is None:
+                    reference = y
+                else:
+                    num_samples = min(y.shape[2], reference.shape[2])
+                    noise = reference[..., :num_samples] - y[..., :num_samples]
+                    stats[name]["snr"] += 10 * torch.log10(reference.pow(2).mean() / noise.pow(2).mean().clamp(min=1e-12)).item()
+
+    count = max(count, 1)
+    lines = ["{} clips, {:.1f} s of audio, {} threads".format(count, seconds, torch.get_num_threads())]
+    for i, (name, stat) in enumerate(stats.items()):
+        line = "{:<6} RTF {:.3f} - acc {:.4f}".format(name, stat["time"] / seconds, stat["acc"] / count)
+        if i > 0:
+            line += " - SNR to fp32 {:.2f} dB".format(stat["snr"] / count)
+        lines.append(line)
+    for line in lines:
+        logging.info(line)
+    if args.report_path:
+        os.makedirs(os.path.dirname(os.path.abspath(args.report_path)), exist_ok=True)
+        with open(args.report_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def main(args, configs):
+    process_config, model_config, train_config = configs
+    mel_config = process_config["mel"]
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    mel_transform = TacotronSTFT(mel_config["n_fft"], mel_config["hop_length"], mel_config["win_length"],
+                                 backend=mel_config.get("stft_backend", "conv")).to(device)
+    generator = load_generator(args.checkpoint)
+
+    if args.calib_clips > 0:
+        logging.info(logging_mark + "\t" + "Calibrating on {} clips".format(args.calib_clips) + "\t" + logging_mark)
+        with torch.no_grad():
+            mels = calibration_mels(process_config, train_config, mel_transform, args.calib_clips, args.segment)
+        quantized = quantize_generator(generator, mels, backend=args.backend)
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        save_quantized(args.out, quantized)
+        logging.info("saved {}".format(args.out))
+
+    if args.watermark_ckpt:
+        logging.info(logging_mark + "\t" + "fp32 vs int8 self-vocoding" + "\t" + logging_mark)
+        vocoders = {"fp32": generator, "int8": load_quantized(args.out, backend=args.backend)}
+        report(args, configs, mel_transform, vocoders)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-p",
+        "--process_config",
+        type=str,
+        default="config/process.yaml",
+        help="path to process.yaml",
+    )
+    parser.add_argument("-m", "--model_config", type=str, default="config/model.yaml", help="path to model.yaml")
+    parser.add_argument("-t", "--train_config", type=str, default="config/train.yaml", help="path to train.yaml")
+    parser.add_argument("--checkpoint", type=str, default="./hifigan/model/VCTK_V1/generator_v1", help="fp32 HiFi-GAN generator")
+    parser.add_argument("--out", type=str, default="./hifigan/model/VCTK_V1/generator_v1_int8.pt",
+                        help="where to write (or, with --calib_clips 0, read) the INT8 generator")
+    parser.add_argument("--backend", type=str, default="fbgemm", choices=["fbgemm", "x86", "qnnpack"])
+    parser.add_argument("--calib_clips", type=int, default=64, help="train clips to calibrate on, 0 to reuse --out")
+    parser.add_argument("--segment", type=int, default=256, help="random crop of each calibration mel in frames, 0 for whole clips")
+    parser.add_argument("--watermark_ckpt", type=str, default="", help="watermark model (encoder + decoder) to report bit accuracy with")
+    parser.add_argument("--clips", type=int, default=0, help="val clips in the report, 0 for all")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads, 0 keeps the default")
+    parser.add_argument("--report_path", type=str, default="results/quantize_report.txt")
+    args = parser.parse_args()
+
+    # Read Config
+    process_config = yaml.load(
+        open(args.process_config, "r"), Loader=yaml.FullLoader
+    )
+    model_config = yaml.load(open(args.model_config, "r"), Loader=yaml.FullLoader)
+    train_config = yaml.load(open(args.train_config, "r"), Loader=yaml.FullLoader)
+    configs = (process_config, model_config, train_config)
+
+    main(args, configs)
@@ -0,0 +1,19 @@
+import torch
+from distortions.frequency import STFT, valid_frames
+
+
+def test_valid_frames_exact_multiple_of_hop():
+    hop = 256
+    lengths = torch.tensor([4 * hop, 4 * hop + 1, 4 * hop - 1, 1])
+    assert valid_frames(lengths, hop).tolist() == [4, 5, 4, 1]
+
+
+def test_valid_frames_centred_on_signal():
+    hop = 256
+    stft = STFT(1024, hop, 1024)
+    for length in (4 * hop, 4 * hop + 1, 5 * hop - 1):
+        n_frames = stft.transform(torch.randn(1, length))[0].size(-1)
+        n_valid = int(valid_frames(torch.tensor([length]), hop))
+        assert n_valid <= n_frames
+        # the last counted frame is centred inside the signal, the next one is not
+        assert (n_valid - 1) * hop < length <= n_valid * hop
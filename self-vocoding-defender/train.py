@@ -9,6 +9,7 @@ from torch.optim import Adam
 from rich.progress import track
 from torch.utils.data import DataLoader
 from model.loss import Loss_identity
+from dataset.data import bucket_sampler, pad_collate
 from utils.tools import save, log, save_op
 from utils.optimizer import ScheduledOptimMain, ScheduledOptimDisc, my_step
 from itertools import chain
@@ -39,6 +40,7 @@ def main(args, configs):
     process_config, model_config, train_config = configs
 
     pre_step = 0
+    padded_batches = False
     if model_config["structure"]["transformer"]:
         if model_config["structure"]["mel"]:
             from model.mel_modules import Encoder, Decoder
@@ -55,6 +57,8 @@ def main(args, configs):
             logging.info("use conv2mel model")
             from model.conv2_mel_modules import Encoder, Decoder, Discriminator
             from dataset.data import wav_dataset as my_dataset
+            # Encoder, Decoder and Loss_identity take the lengths of padded batches
+            padded_batches = True
         else:
             logging.info("use ablation conv2mel model")
             from model.conv2_mel_modules_ab import Encoder, Decoder, Discriminator
@@ -62,14 +66,45 @@ def main(args, configs):
     else:
         from model.conv_modules import Encoder, Decoder
         from dataset.data import oned_dataset as my_dataset
+    if my_dataset.__name__ == "wav_dataset" and train_config["path"].get("shard_path"):
+        from dataset.data import shard_dataset as my_dataset
+    random_crop = train_config.get("loader", {}).get("random_crop")
+    streaming = train_config.get("loader", {}).get("streaming")
+    wav_files = my_dataset.__name__ in ("wav_dataset", "shard_dataset")
+    if wav_files and random_crop and streaming:
+        raise ValueError("loader.random_crop and loader.streaming are exclusive (streaming already crops at random), set one of them")
+    if wav_files and streaming:
+        # corpora larger than RAM: files are streamed, resampled and cropped by the loader workers
+        from dataset.data import wav_stream_dataset as train_dataset
+    elif wav_files and random_crop:
+        # a new crop of the long files every epoch; validation keeps its fixed crops
+        from dataset.data import wav_dataset_crop as train_dataset
+    else:
+        train_dataset = my_dataset
+    if train_dataset is not my_dataset and not padded_batches and train_config["optimize"]["batch_size"] > 1:
+        # their items have random lengths, which only the padded batches of the conv2mel model handle
+        raise ValueError("loader.random_crop / loader.streaming need batch_size 1 with this model "
+                         "(its Encoder/Decoder take no lengths), got {}".format(train_config["optimize"]["batch_size"]))
     # ---------------- get train dataset
-    audios = my_dataset(process_config=process_config, train_config=train_config, flag='train')
+    audios = train_dataset(process_config=process_config, train_config=train_config, flag='train')
     val_audios = my_dataset(process_config=process_config, train_config=train_config, flag='val')
 
     batch_size = train_config["optimize"]["batch_size"]
     assert batch_size < len(audios)
-    audios_loader = DataLoader(audios, batch_size=batch_size, shuffle=True)
-    val_audios_loader = DataLoader(val_audios, batch_size=batch_size, shuffle=False)
+    if train_dataset.__name__ == "wav_stream_dataset":
+        # shuffled and sharded over the workers by the dataset itself
+        audios_loader = DataLoader(audios, batch_size=batch_size, collate_fn=pad_collate if padded_batches else None,
+                                   num_workers=train_config["loader"].get("num_workers", 0))
+    elif padded_batches:
+        # utterances of similar length are batched together and zero-padded to the longest
+        pool_batches = train_config.get("loader", {}).get("bucket_pool_batches", 50)
+        audios_loader = DataLoader(audios, batch_sampler=bucket_sampler(audios.lengths, batch_size, pool_batches), collate_fn=pad_collate)
+    else:
+        audios_loader = DataLoader(audios, batch_size=batch_size, shuffle=True)
+    if padded_batches:
+        val_audios_loader = DataLoader(val_audios, batch_sampler=bucket_sampler(val_audios.lengths, batch_size, shuffle=False), collate_fn=pad_collate)
+    else:
+        val_audios_loader = DataLoader(val_audios, batch_size=batch_size, shuffle=False)
     # ---------------- build model
     win_dim = process_config["audio"]["win_len"]
     embedding_dim = model_config["dim"]["embedding"]
@@ -142,6 +177,8 @@ def main(args, configs):
     train_len = len(audios_loader)
 
     for ep in range(1, epoch_num+1):
+        if hasattr(audios, "set_epoch"):
+            audios.set_epoch(ep)
         encoder.train()
         decoder.train()
         if train_config["adv"]:
@@ -152,16 +189,20 @@ def main(args, configs):
             global_step += 1
             step += 1
             # ---------------- build watermark
-            msg = np.random.choice([0,1], [batch_size, 1, msg_length])
-            msg = torch.from_numpy(msg).float()*2 - 1
             wav_matrix = sample["matrix"].to(device)
+            # the last batch of an epoch can be smaller than batch_size
+            cur_batch_size = wav_matrix.size(0)
+            msg = np.random.choice([0,1], [cur_batch_size, 1, msg_length])
+            msg = torch.from_numpy(msg).float()*2 - 1
             # print("wav_matrix", wav_matrix)
             msg = msg.to(device)
-            encoded, carrier_watermarked = encoder(wav_matrix, msg, global_step)
+            lengths = sample["lengths"].to(device) if "lengths" in sample else None
+            length_kwargs = {} if lengths is None else {"lengths": lengths}
+            encoded, carrier_watermarked = encoder(wav_matrix, msg, global_step, **length_kwargs)
             # print("encoded", encoded)
-            decoded = decoder(encoded, global_step)
+            decoded = decoder(encoded, global_step, **length_kwargs)
             # print("decoded", decoded)
-            losses = loss.en_de_loss(wav_matrix, encoded, msg, decoded)
+            losses = loss.en_de_loss(wav_matrix, encoded, msg, decoded, lengths=lengths)
 
             if global_step < pre_step:
                 sum_loss = lambda_m*losses[1]
@@ -173,7 +214,7 @@ def main(args, configs):
             if train_config["adv"]:
                 # lambda_a = lambda_m = train_config["optimize"]["lambda_a"] # modify weights of m and a for better convergence
                 lambda_a = train_config["optimize"]["lambda_a"]
-                g_target_label_encoded = torch.full((batch_size, 1), 1, device=device).float()
+                g_target_label_encoded = torch.full((cur_batch_size, 1), 1, device=device).float()
                 d_on_encoded_for_enc = discriminator(encoded)
                 # target label for encoded images should be 'cover', because we want to fool the discriminator
                 g_loss_adv = F.binary_cross_entropy_with_logits(d_on_encoded_for_enc, g_target_label_encoded)
@@ -184,14 +225,14 @@ def main(args, configs):
             my_step(en_de_op, lr_sched, global_step, train_len)
             
             if train_config["adv"]:
-                d_target_label_cover = torch.full((batch_size, 1), 1, device=device).float()
+                d_target_label_cover = torch.full((cur_batch_size, 1), 1, device=device).float()
                 d_on_cover = discriminator(wav_matrix)
                 # print("d_on_cover", d_on_cover)
                 d_loss_on_cover = F.binary_cross_entropy_with_logits(d_on_cover, d_target_label_cover)
                 # print("d_loss_on_cover", d_loss_on_cover)
                 d_loss_on_cover.backward()
 
-                d_target_label_encoded = torch.full((batch_size, 1), 0, device=device).float()
+                d_target_label_encoded = torch.full((cur_batch_size, 1), 0, device=device).float()
                 d_on_encoded = discriminator(encoded.detach())
                 # print("d_on_encoded", d_on_encoded)
                 # target label for encoded images should be 'encoded', because we want discriminator fight with encoder
@@ -203,7 +244,7 @@ def main(args, configs):
             if step % show_circle == 0:
                 # decoder_acc = (decoded[0] >= 0).eq(msg >= 0).sum().float() / msg.numel()
                 # decoder_acc = [((decoded[0] >= 0).eq(msg >= 0).sum().float() / msg.numel()).item(), ((decoded[1] >= 0).eq(msg >= 0).sum().float() / msg.numel()).item()]
-                decoder_acc = [((decoded[0] >= 0).eq(msg >= 0).sum().float() / msg.numel()).item(), ((decoded[1] >= 0).eq(msg >= 0).sum().float() / msg.numel()).item(), ((decoded[2] >= 0).eq(msg >= 0).sum().float() / msg.numel()).item()]
+                decoder_acc = [((rec >= 0).eq(msg >= 0).sum().float() / msg.numel()).item() for rec in decoded]
                 zero_tensor = torch.zeros(wav_matrix.shape).to(device)
                 snr = 10 * torch.log10(mse_loss(wav_matrix.detach(), zero_tensor) / mse_loss(wav_matrix.detach(), encoded.detach()))
                 # print("snr", snr)
@@ -211,13 +252,13 @@ def main(args, configs):
                 logging.info('-' * 100)
                 # print("******src******", sample["name"])
                 if train_config["adv"]:
-                    logging.info("step:{} - wav_loss:{:.8f} - msg_loss:{:.8f} - acc:[{:.8f},{:.8f},{:.8f}] - snr:{:.8f} - norm:{:.8f} - patch_num:{} - pad_num:{} - wav_len:{} - d_loss_on_encoded:{} - d_loss_on_cover:{}".format(\
-                        step, losses[0], losses[1], decoder_acc[0], decoder_acc[1], decoder_acc[2],\
-                            snr, norm2, sample["patch_num"].item(), sample["pad_num"].item(), wav_matrix.shape[2], d_loss_on_encoded, d_loss_on_cover))
+                    logging.info("step:{} - wav_loss:{:.8f} - msg_loss:{:.8f} - acc:[{}] - snr:{:.8f} - norm:{:.8f} - patch_num:{} - pad_num:{} - wav_len:{} - d_loss_on_encoded:{} - d_loss_on_cover:{}".format(\
+                        step, losses[0], losses[1], ",".join("{:.8f}".format(acc) for acc in decoder_acc),\
+                            snr, norm2, sample["patch_num"].sum().item(), sample["pad_num"].sum().item(), wav_matrix.shape[2], d_loss_on_encoded, d_loss_on_cover))
                 else:
-                    logging.info("step:{} - wav_loss:{:.8f} - msg_loss:{:.8f} - acc:[{:.8f},{:.8f}] - snr:{:.8f} - norm:{:.8f} - patch_num:{} - pad_num:{} - wav_len:{}".format(\
-                        step, losses[0], losses[1], decoder_acc[0], decoder_acc[1],\
-                            snr, norm2, sample["patch_num"].item(), sample["pad_num"].item(), wav_matrix.shape[2]))
+                    logging.info("step:{} - wav_loss:{:.8f} - msg_loss:{:.8f} - acc:[{}] - snr:{:.8f} - norm:{:.8f} - patch_num:{} - pad_num:{} - wav_len:{}".format(\
+                        step, losses[0], losses[1], ",".join("{:.8f}".format(acc) for acc in decoder_acc),\
+                            snr, norm2, sample["patch_num"].sum().item(), sample["pad_num"].sum().item(), wav_matrix.shape[2]))
 
         # if ep % save_circle == 0 or ep == 1 or ep == 2:
         if ep % save_circle == 0:
@@ -235,7 +276,7 @@ def main(args, configs):
             if train_config["adv"]:
                 discriminator.eval()
             # avg_acc = [0, 0]
-            avg_acc = [0, 0, 0]
+            avg_acc = None
             avg_snr = 0
             avg_wav_loss = 0
             avg_msg_loss = 0
@@ -245,53 +286,52 @@ def main(args, configs):
             for sample in track(val_audios_loader):
                 count += 1
                 # ---------------- build watermark
-                msg = np.random.choice([0,1], [batch_size, 1, msg_length])
-                msg = torch.from_numpy(msg).float()*2 - 1
                 wav_matrix = sample["matrix"].to(device)
+                cur_batch_size = wav_matrix.size(0)
+                msg = np.random.choice([0,1], [cur_batch_size, 1, msg_length])
+                msg = torch.from_numpy(msg).float()*2 - 1
                 msg = msg.to(device)
-                encoded, carrier_wateramrked = encoder(wav_matrix, msg, global_step)
-                decoded = decoder(encoded, global_step)
-                losses = loss.en_de_loss(wav_matrix, encoded, msg, decoded)
+                lengths = sample["lengths"].to(device) if "lengths" in sample else None
+                length_kwargs = {} if lengths is None else {"lengths": lengths}
+                encoded, carrier_wateramrked = encoder(wav_matrix, msg, global_step, **length_kwargs)
+                decoded = decoder(encoded, global_step, **length_kwargs)
+                losses = loss.en_de_loss(wav_matrix, encoded, msg, decoded, lengths=lengths)
                 # adv
                 if train_config["adv"]:
                     # lambda_a = lambda_m = train_config["optimize"]["lambda_a"]
                     lambda_a = train_config["optimize"]["lambda_a"]
-                    g_target_label_encoded = torch.full((batch_size, 1), 1, device=device).float()
+                    g_target_label_encoded = torch.full((cur_batch_size, 1), 1, device=device).float()
                     d_on_encoded_for_enc = discriminator(encoded)
                     g_loss_adv = F.binary_cross_entropy_with_logits(d_on_encoded_for_enc, g_target_label_encoded)
                 if train_config["adv"]:
-                    d_target_label_cover = torch.full((batch_size, 1), 1, device=device).float()
+                    d_target_label_cover = torch.full((cur_batch_size, 1), 1, device=device).float()
                     d_on_cover = discriminator(wav_matrix)
                     d_loss_on_cover = F.binary_cross_entropy_with_logits(d_on_cover, d_target_label_cover)
 
-                    d_target_label_encoded = torch.full((batch_size, 1), 0, device=device).float()
+                    d_target_label_encoded = torch.full((cur_batch_size, 1), 0, device=device).float()
                     d_on_encoded = discriminator(encoded.detach())
                     d_loss_on_encoded = F.binary_cross_entropy_with_logits(d_on_encoded, d_target_label_encoded)
                 
                 # decoder_acc = [((decoded[0] >= 0).eq(msg >= 0).sum().float() / msg.numel()).item(), ((decoded[1] >= 0).eq(msg >= 0).sum().float() / msg.numel()).item()]
-                decoder_acc = [((decoded[0] >= 0).eq(msg >= 0).sum().float() / msg.numel()).item(), ((decoded[1] >= 0).eq(msg >= 0).sum().float() / msg.numel()).item(), ((decoded[2] >= 0).eq(msg >= 0).sum().float() / msg.numel()).item()]
+                decoder_acc = [((rec >= 0).eq(msg >= 0).sum().float() / msg.numel()).item() for rec in decoded]
                 zero_tensor = torch.zeros(wav_matrix.shape).to(device)
                 snr = 10 * torch.log10(mse_loss(wav_matrix.detach(), zero_tensor) / mse_loss(wav_matrix.detach(), encoded.detach()))
                 # norm2=mse_loss(wav_matrix.detach(),zero_tensor)
-                avg_acc[0] += decoder_acc[0]
-                avg_acc[1] += decoder_acc[1]
-                avg_acc[2] += decoder_acc[2]
+                avg_acc = decoder_acc if avg_acc is None else [a + b for a, b in zip(avg_acc, decoder_acc)]
                 avg_snr += snr
                 avg_wav_loss += losses[0]
                 avg_msg_loss += losses[1]
                 avg_d_loss_on_cover += d_loss_on_cover
                 avg_d_loss_on_encoded += d_loss_on_encoded
-            avg_acc[0] /= count
-            avg_acc[1] /= count
-            avg_acc[2] /= count
+            avg_acc = [acc / count for acc in avg_acc]
             avg_snr /= count
             avg_wav_loss /= count
             avg_msg_loss /= count
             avg_d_loss_on_encoded /= count
             avg_d_loss_on_cover /= count
             logging.info('#e' * 60)
-            logging.info("epoch:{} - wav_loss:{:.8f} - msg_loss:{:.8f} - acc:[{:.8f},{:.8f},{:.8f}] - snr:{:.8f} - d_loss_on_encoded:{} - d_loss_on_cover:{}".format(\
-                ep, avg_wav_loss, avg_msg_loss, avg_acc[0], avg_acc[1], avg_acc[2], avg_snr, avg_d_loss_on_encoded, avg_d_loss_on_cover))
+            logging.info("epoch:{} - wav_loss:{:.8f} - msg_loss:{:.8f} - acc:[{}] - snr:{:.8f} - d_loss_on_encoded:{} - d_loss_on_cover:{}".format(\
+                ep, avg_wav_loss, avg_msg_loss, ",".join("{:.8f}".format(acc) for acc in avg_acc), avg_snr, avg_d_loss_on_encoded, avg_d_loss_on_cover))
 
 
 if __name__ == "__main__":
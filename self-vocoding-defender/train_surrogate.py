@@ -0,0 +1,180 @@
+import os
+import time
+import torch
+import yaml
+import random
+import logging
+import argparse
+import numpy as np
+from torch.optim import Adam
+from rich.progress import track
+from torch.utils.data import DataLoader
+from dataset.data import wav_dataset
+from distortions.frequency import TacotronSTFT
+from model.loss import MultiResolutionSTFTLoss
+from model.surrogate import VocoderSurrogate, save_surrogate, load_surrogate
+
+
+# set seeds
+seed = 2025
+random.seed(seed)
+np.random.seed(seed)
+torch.manual_seed(seed)
+torch.cuda.manual_seed(seed)
+
+
+logging_mark = "#"*20
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def random_crop(wav, segment):
+    if segment <= 0 or wav.shape[-1] <= segment:
+        return wav
+    start = random.randint(0, wav.shape[-1] - segment)
+    return wav[..., start:start + segment]
+
+
+class VocodingSimulation():
+    """ the expensive self-vocoding simulation the surrogate is distilled from """
+    def __init__(self, process_config, model_config, target):
+        mel_config = process_config["mel"]
+        self.mel_transform = TacotronSTFT(mel_config["n_fft"], mel_config["hop_length"], mel_config["win_length"],
+                                          backend=mel_config.get("stft_backend", "conv")).to(device)
+        self.griffin_lim_config = model_config.get("griffin_lim", {})
+        self.target = target
+        self.vocoder = None
+        if target == "hifigan":
+            from model.vocoders import vocoder_zoo
+            self.vocoder = vocoder_zoo.get('hifigan', device)
+
+    @torch.no_grad()
+    def __call__(self, y):
+        y_mel = self.mel_transform.mel_spectrogram(y.squeeze(1))
+        if self.target == "hifigan":
+            return self.mel_transform.wav_norm(self.vocoder(y_mel).squeeze(1)).unsqueeze(1)
+        config = self.griffin_lim_config
+        return self.mel_transform.griffin_lim(
+            y_mel, n_iters=config.get("n_iters", 60), momentum=config.get("momentum", 0.),
+            tol=config.get("tol", 0.)).unsqueeze(1)
+
+
+def surrogate_loss(loss_fn, mel_transform, surrogate_out, target):
+    num_samples = min(surrogate_out.shape[-1], target.shape[-1])
+    surrogate_out = mel_transform.wav_norm(surrogate_out.squeeze(1)).unsqueeze(1)
+    return loss_fn(surrogate_out[..., :num_samples], target[..., :num_samples])
+
+
+def validate(surrogate, simulation, loss_fn, val_loader, segment):
+    surrogate.eval()
+    avg_loss, avg_identity_loss, sim_time, surrogate_time, count = 0, 0, 0, 0, 0
+    with torch.no_grad():
+        for sample in track(val_loader):
+            y = random_crop(sample["matrix"].to(device), segment)
+            start = time.perf_counter()
+            target = simulation(y)
+            sim_time += time.perf_counter() - start
+            start = time.perf_counter()
+            out = surrogate(y)
+            surrogate_time += time.perf_counter() - start
+            avg_loss += surrogate_loss(loss_fn, simulation.mel_transform, out, target).item()
+            # doing nothing at all, the bar the surrogate has to clear
+            avg_identity_loss += surrogate_loss(loss_fn, simulation.mel_transform, y, target).item()
+            count += 1
+    surrogate.train()
+    count = max(count, 1)
+    logging.info("val - loss:{:.6f} - identity loss:{:.6f} - {}: {:.1f} ms/clip - surrogate: {:.1f} ms/clip".format(
+        avg_loss / count, avg_identity_loss / count, simulation.target, sim_time / count * 1000, surrogate_time / count * 1000))
+    return avg_loss / count
+
+
+def main(args, configs):
+    process_config, model_config, train_config = configs
+    mel_config = process_config["mel"]
+    surrogate_config = model_config.get("surrogate", {})
+
+    val_audios = wav_dataset(process_config=process_config, train_config=train_config, flag='val')
+    val_loader = DataLoader(val_audios, batch_size=1, shuffle=False)
+
+    simulation = VocodingSimulation(process_config, model_config, args.target)
+    loss_fn = MultiResolutionSTFTLoss().to(device)
+    if args.checkpoint:
+        surrogate = load_surrogate(args.checkpoint, device, backend=mel_config.get("stft_backend", "conv"))
+        for param in surrogate.parameters():
+            param.requires_grad = True
+    else:
+        surrogate = VocoderSurrogate(mel_config["n_fft"], mel_config["hop_length"], mel_config["win_length"],
+                                     hidden_dim=surrogate_config.get("hidden_dim", 128),
+                                     n_layers=surrogate_config.get("n_layers", 3),
+                                     backend=mel_config.get("stft_backend", "conv")).to(device)
+
+    if args.validate:
+        validate(surrogate, simulation, loss_fn, val_loader, args.segment)
+        return
+
+    audios = wav_dataset(process_config=process_config, train_config=train_config, flag='train')
+    audios_loader = DataLoader(audios, batch_size=1, shuffle=True)
+    optimizer = Adam(surrogate.parameters(), lr=args.lr)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+
+    logging.info(logging_mark + "\t" + "Begin Training surrogate ({})".format(args.target) + "\t" + logging_mark)
+    global_step, best = 0, float("inf")
+    surrogate.train()
+    while global_step < args.steps:
+        for sample in track(audios_loader):
+            global_step += 1
+            y = random_crop(sample["matrix"].to(device), args.segment)
+            target = simulation(y)
+            loss = surrogate_loss(loss_fn, simulation.mel_transform, surrogate(y), target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            if global_step % args.show_circle == 0:
+                logging.info("step:{} - loss:{:.6f}".format(global_step, loss.item()))
+            if global_step % args.val_circle == 0 or global_step == args.steps:
+                val_loss = validate(surrogate, simulation, loss_fn, val_loader, args.segment)
+                if val_loss < best:
+                    best = val_loss
+                    save_surrogate(args.out, surrogate, target=args.target, step=global_step, val_loss=val_loss)
+                    logging.info("saved {}".format(args.out))
+            if global_step >= args.steps:
+                break
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-p",
+        "--process_config",
+        type=str,
+        required=True,
+        help="path to process.yaml",
+    )
+    parser.add_argument(
+        "-m", "--model_config", type=str, required=True, help="path to model.yaml"
+    )
+    parser.add_argument(
+        "-t", "--train_config", type=str, required=True, help="path to train.yaml"
+    )
+    parser.add_argument("--target", type=str, default="griffin_lim", choices=["griffin_lim", "hifigan"],
+                        help="vocoding simulation to distill")
+    parser.add_argument("--out", type=str, default="results/surrogate/surrogate.pth", help="where to save the best surrogate")
+    parser.add_argument("--checkpoint", type=str, default="", help="surrogate to resume from or to validate")
+    parser.add_argument("--validate", action="store_true", help="only report the loss of --checkpoint on the val set")
+    parser.add_argument("--steps", type=int, default=20000)
+    parser.add_argument("--lr", type=float, default=2e-4)
+    parser.add_argument("--segment", type=int, default=65536, help="random crop length in samples, 0 for whole clips")
+    parser.add_argument("--show_circle", type=int, default=100)
+    parser.add_argument("--val_circle", type=int, default=2000)
+    args = parser.parse_args()
+
+    # Read Config
+    process_config = yaml.load(
+        open(args.process_config, "r"), Loader=yaml.FullLoader
+    )
+    model_config = yaml.load(open(args.model_config, "r"), Loader=yaml.FullLoader)
+    train_config = yaml.load(open(args.train_config, "r"), Loader=yaml.FullLoader)
+    configs = (process_config, model_config, train_config)
+
+    main(args, configs)